@@ -0,0 +1,78 @@
+"""
+Query latency of the memory-mapped flat index versus Chroma's HNSW for small collections.
+
+Both go through retrieval.search() on collections with a doc store, so the numbers
+include fetching metadata and text for the top k, as /query does. Recall is measured against an exact scan.
+
+    python benchmarks/bench_flat_index.py --sizes 1000 5000 20000 --dim 768 --k 4
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Keep the flat tier past its default cut-off so every --sizes entry is measured on it
+os.environ.setdefault("FLAT_INDEX_MAX_CHUNKS", str(10 ** 9))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "fastapi_app"))
+from chromadb import PersistentClient  # noqa: E402
+
+from retrieval import add_vectors, search  # noqa: E402
+
+
+def synthetic_corpus(n: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    """Clustered unit vectors with a decaying spectrum, roughly like text embeddings"""
+    rng = np.random.default_rng(seed)
+    spectrum = 1.0 / np.sqrt(np.arange(1, dim + 1))
+    centers = rng.normal(size=(clusters, dim)) * spectrum
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim)) * spectrum
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def measure(collection, user_db_path, queries, k):
+    latencies, results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        hits = search(collection, user_db_path, query.tolist(), k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        results.append([int(hit["id"]) for hit in hits])
+    return np.percentile(latencies, 50), np.percentile(latencies, 95), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"dim={args.dim}, k={args.k}, {args.queries} queries")
+    print(f"{'chunks':>8}{'backend':>9}{'p50 ms':>9}{'p95 ms':>9}{'recall@k':>10}")
+    for size in args.sizes:
+        data = synthetic_corpus(size + args.queries, args.dim, max(10, size // 50), args.seed)
+        corpus, queries = data[:size], data[size:]
+        scores = queries @ corpus.T
+        truth = np.argsort(-scores, axis=1)[:, :args.k]
+
+        user_db_path = tempfile.mkdtemp(prefix="bench_flat_")
+        client = PersistentClient(path=user_db_path)
+        for backend, metadata in (("hnsw", {"embedding_provider": "bench", "doc_store": "zstd"}),
+                                  ("flat", {"embedding_provider": "bench", "doc_store": "zstd", "flat_index": True})):
+            collection = client.create_collection(f"bench_{backend}", metadata=metadata)
+            for start in range(0, size, 1000):
+                ids = [str(i) for i in range(start, min(start + 1000, size))]
+                add_vectors(collection, user_db_path, ids=ids, embeddings=corpus[start:start + 1000].tolist(),
+                            documents=["chunk"] * len(ids), metadatas=[{"source": "bench.txt"}] * len(ids))
+            p50, p95, results = measure(collection, user_db_path, queries, args.k)
+            recall = np.mean([len(set(r) & set(t)) / args.k for r, t in zip(results, truth)])
+            print(f"{size:>8}{backend:>9}{p50:>9.2f}{p95:>9.2f}{recall:>10.3f}")
+        shutil.rmtree(user_db_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Recall and latency of coarse-to-fine (document centroid, then chunk) search against flat search.
+
+Builds a collection of synthetic documents, each a cluster of chunk vectors, with the
+document and HNSW indexes /embed creates. Queries go through the path large
+collections take: HNSW over every chunk (fan-out 0), or HNSW restricted to the
+chunks of the top documents for each --fan-out. Recall is measured against an exact
+scan of every chunk.
+
+    python benchmarks/bench_hierarchical.py --documents 2000 --chunks-per-document 25 --fan-out 4 8 16
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "fastapi_app"))
+from chromadb import PersistentClient  # noqa: E402
+
+from retrieval import add_vectors, search  # noqa: E402
+
+BATCH = 1000
+
+
+def synthetic_documents(documents: int, chunks_per_document: int, dim: int, spread: float, seed: int):
+    """(unit chunk vectors, source of each chunk): chunks scatter around their document's topic vector"""
+    rng = np.random.default_rng(seed)
+    spectrum = 1.0 / np.sqrt(np.arange(1, dim + 1))
+    topics = rng.normal(size=(documents, dim)) * spectrum
+    sizes = np.maximum(1, rng.poisson(chunks_per_document, documents))
+    owners = np.repeat(np.arange(documents), sizes)
+    vectors = topics[owners] + spread * rng.normal(size=(len(owners), dim)) * spectrum
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32), [f"doc-{owner}" for owner in owners]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--chunks-per-document", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--spread", type=float, default=0.6, help="chunk noise relative to topic; higher overlaps")
+    parser.add_argument("--fan-out", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus, sources = synthetic_documents(args.documents, args.chunks_per_document, args.dim, args.spread, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    picks = rng.integers(0, len(corpus), args.queries)
+    queries = corpus[picks] + 0.3 * rng.normal(size=(args.queries, args.dim)).astype(np.float32) / np.sqrt(args.dim)
+    truth = np.argsort(-(queries @ corpus.T), axis=1)[:, :args.k]
+
+    user_db_path = tempfile.mkdtemp(prefix="bench_hier_")
+    client = PersistentClient(path=user_db_path)
+    collection = client.create_collection("bench", metadata={"embedding_provider": "bench", "doc_index": True})
+    started = time.perf_counter()
+    for start in range(0, len(corpus), BATCH):
+        ids = [str(i) for i in range(start, min(start + BATCH, len(corpus)))]
+        add_vectors(collection, user_db_path, ids=ids, embeddings=corpus[start:start + BATCH].tolist(),
+                    documents=["chunk"] * len(ids), metadatas=[{"source": sources[int(i)]} for i in ids])
+    print(f"{len(corpus)} chunks in {args.documents} documents, dim={args.dim}, k={args.k}, "
+          f"built in {time.perf_counter() - started:.1f}s")
+    print(f"{'fan-out':>8}{'chunks/q':>10}{'p50 ms':>9}{'p95 ms':>9}{'recall@k':>10}")
+    average_chunks = len(corpus) / args.documents
+    for fan_out in [0] + args.fan_out:
+        latencies, recalls = [], []
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            hits = search(collection, user_db_path, query.tolist(), args.k, doc_fan_out=fan_out)
+            latencies.append((time.perf_counter() - started) * 1000)
+            recalls.append(len({int(hit["id"]) for hit in hits} & set(expected.tolist())) / args.k)
+        scanned = len(corpus) if not fan_out else round(fan_out * average_chunks)
+        print(f"{fan_out or 'hnsw':>8}{scanned:>10}{np.percentile(latencies, 50):>9.2f}"
+              f"{np.percentile(latencies, 95):>9.2f}{np.mean(recalls):>10.3f}")
+    shutil.rmtree(user_db_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Build time, index size, query latency and recall@k for Chroma HNSW parameter choices.
+
+Every (M, construction_ef) pair gets a fresh collection; each search_ef is then
+applied to the loaded index the same way /query does. Recall is measured against
+an exact scan. Use --corpus to load saved embeddings (.npy, one row per chunk)
+instead of the synthetic clustered vectors.
+
+    python benchmarks/bench_hnsw.py --sizes 10000 50000 --dim 768 --m 16 32 --search-ef 10 50 100
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "fastapi_app"))
+from chromadb import PersistentClient  # noqa: E402
+
+from index_params import hnsw_metadata, hnsw_search_ef  # noqa: E402
+
+BATCH = 1000
+
+
+def synthetic_corpus(n: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    """Clustered unit vectors with a decaying spectrum, roughly like text embeddings"""
+    rng = np.random.default_rng(seed)
+    spectrum = 1.0 / np.sqrt(np.arange(1, dim + 1))
+    centers = rng.normal(size=(clusters, dim)) * spectrum
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim)) * spectrum
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, k: int, space: str) -> np.ndarray:
+    if space == "l2":
+        scores = -(np.sum(corpus ** 2, axis=1)[None, :] - 2 * queries @ corpus.T)
+    elif space == "cosine":
+        unit = corpus / np.linalg.norm(corpus, axis=1, keepdims=True)
+        scores = queries @ unit.T
+    else:
+        scores = queries @ corpus.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def index_bytes(path: str) -> int:
+    """HNSW segment files on disk, which is what gets loaded into memory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name != "chroma.sqlite3":
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--corpus", help="saved embeddings (.npy); overrides --dim and caps --sizes")
+    parser.add_argument("--space", choices=["l2", "cosine", "ip"], default="l2")
+    parser.add_argument("--m", type=int, nargs="+", default=[16])
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=[100])
+    parser.add_argument("--search-ef", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.corpus:
+        data = np.load(args.corpus).astype(np.float32)
+        rng = np.random.default_rng(args.seed)
+        data = data[rng.permutation(len(data))]
+    print(f"space={args.space}, k={args.k}, {args.queries} queries")
+    print(f"{'chunks':>8}{'M':>5}{'c_ef':>6}{'build s':>9}{'MiB':>8}{'s_ef':>6}{'p50 ms':>9}{'p95 ms':>9}{'recall@k':>10}")
+    for size in args.sizes:
+        if not args.corpus:
+            data = synthetic_corpus(size + args.queries, args.dim, max(10, size // 50), args.seed)
+        corpus, queries = data[:min(size, len(data) - args.queries)], data[-args.queries:]
+        truth = exact_top_k(corpus, queries, args.k, args.space)
+
+        for m in args.m:
+            for construction_ef in args.construction_ef:
+                path = tempfile.mkdtemp(prefix="bench_hnsw_")
+                client = PersistentClient(path=path)
+                metadata = hnsw_metadata(args.space, m, construction_ef)
+                # Persist after every batch so the on-disk size reflects the whole index
+                metadata["hnsw:sync_threshold"] = BATCH
+                collection = client.create_collection("bench", metadata=metadata)
+                started = time.perf_counter()
+                for start in range(0, len(corpus), BATCH):
+                    collection.add(ids=[str(i) for i in range(start, min(start + BATCH, len(corpus)))],
+                                   embeddings=corpus[start:start + BATCH].tolist())
+                build_seconds = time.perf_counter() - started
+                size_mib = index_bytes(path) / 2 ** 20
+
+                for search_ef in args.search_ef:
+                    latencies, recalls = [], []
+                    for query, expected in zip(queries, truth):
+                        started = time.perf_counter()
+                        with hnsw_search_ef(collection, search_ef):
+                            result = collection.query(query_embeddings=[query.tolist()], n_results=args.k, include=[])
+                        latencies.append((time.perf_counter() - started) * 1000)
+                        found = {int(chunk_id) for chunk_id in result["ids"][0]}
+                        recalls.append(len(found & set(expected.tolist())) / args.k)
+                    print(f"{len(corpus):>8}{m:>5}{construction_ef:>6}{build_seconds:>9.1f}{size_mib:>8.1f}"
+                          f"{search_ef:>6}{np.percentile(latencies, 50):>9.2f}{np.percentile(latencies, 95):>9.2f}"
+                          f"{np.mean(recalls):>10.3f}")
+                shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
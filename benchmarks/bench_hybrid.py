@@ -0,0 +1,93 @@
+"""
+Latency and exact-term hit rate of vector, BM25 and fused hybrid retrieval.
+
+Builds a throwaway Chroma collection with a lexical index from synthetic chunks,
+each mentioning one unique error code, then asks for those codes. Hit rate is the
+share of queries whose chunk comes back in the top k.
+
+    python benchmarks/bench_hybrid.py --chunks 5000 --queries 200 --k 4
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "fastapi_app"))
+from chromadb import PersistentClient  # noqa: E402
+
+from embeddings import get_embedding_provider  # noqa: E402
+from retrieval import add_vectors, hybrid_search, lexical_search, search  # noqa: E402
+
+WORDS = ("crawler request timeout host page index vector chunk retry queue billing invoice user token "
+         "session cache worker server upload file error network proxy header status response").split()
+
+
+def synthetic_chunks(n: int, seed: int) -> list[tuple[str, str]]:
+    """(error code, text) pairs; the codes are the exact terms embeddings tend to blur"""
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        code = f"ERR_{rng.choice(['CONN', 'AUTH', 'SYNC', 'DISK'])}_{i}"
+        words = [rng.choice(WORDS) for _ in range(120)]
+        words.insert(rng.randrange(len(words)), code)
+        chunks.append((code, " ".join(words)))
+    return chunks
+
+
+def percentiles(samples: list[float]) -> tuple[float, float]:
+    return float(np.percentile(samples, 50)), float(np.percentile(samples, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--provider", default="hashing")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    chunks = synthetic_chunks(args.chunks, args.seed)
+    embedder = get_embedding_provider(args.provider)
+    user_db_path = tempfile.mkdtemp(prefix="bench_hybrid_")
+    collection = PersistentClient(path=user_db_path).create_collection(
+        "bench", metadata={"embedding_provider": args.provider, "lexical_index": True}
+    )
+    started = time.perf_counter()
+    for start in range(0, len(chunks), 500):
+        batch = chunks[start:start + 500]
+        texts = [text for _, text in batch]
+        add_vectors(collection, user_db_path, ids=[code for code, _ in batch],
+                    embeddings=embedder.embed_documents(texts), documents=texts)
+    print(f"Indexed {len(chunks)} chunks in {time.perf_counter() - started:.1f}s")
+
+    rng = random.Random(args.seed + 1)
+    targets = [code for code, _ in rng.sample(chunks, min(args.queries, len(chunks)))]
+    questions = [(code, f"What does {code} mean?") for code in targets]
+    embedded = [embedder.embed_query(question) for _, question in questions]
+
+    runs = {
+        "vector": lambda q, e: search(collection, user_db_path, e, args.k),
+        "bm25": lambda q, e: lexical_search(collection, user_db_path, q, args.k),
+        "hybrid": lambda q, e: hybrid_search(collection, user_db_path, e, q, args.k),
+    }
+    print(f"{'retrieval':<10}{'p50 ms':>9}{'p95 ms':>9}{'hit@k':>8}")
+    for name, run in runs.items():
+        latencies, hits = [], 0
+        for (code, question), embedding in zip(questions, embedded):
+            started = time.perf_counter()
+            results = run(question, embedding)
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += any(hit["id"] == code for hit in results)
+        p50, p95 = percentiles(latencies)
+        print(f"{name:<10}{p50:>9.2f}{p95:>9.2f}{hits / len(questions):>8.3f}")
+    shutil.rmtree(user_db_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Recall@k versus memory for the compact vector storage modes.
+
+Candidates come from an exact scan over the truncated index vectors (what the
+Chroma index holds in compact mode), then get re-scored against the quantized
+full-dimension sidecar vectors, exactly as retrieval.search() does.
+
+    python benchmarks/bench_quantization.py --vectors 20000 --dim 768 --k 10
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "fastapi_app"))
+from quantization import bytes_per_vector, decode, encode, truncate  # noqa: E402
+
+
+def synthetic_corpus(n: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    """Clustered unit vectors with a decaying spectrum, roughly like text embeddings"""
+    rng = np.random.default_rng(seed)
+    spectrum = 1.0 / np.sqrt(np.arange(1, dim + 1))
+    centers = rng.normal(size=(clusters, dim)) * spectrum
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim)) * spectrum
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    idx = np.argpartition(-scores, k, axis=1)[:, :k]
+    order = np.take_along_axis(scores, idx, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def run(corpus, queries, mode, index_dim, k, rescore_factor):
+    started = time.perf_counter()
+    codes, scales = encode(corpus, mode)
+    full = decode(codes, scales)
+    index = truncate(corpus, index_dim) if index_dim < corpus.shape[1] else corpus
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    q_index = truncate(queries, index_dim) if index_dim < corpus.shape[1] else queries
+    candidates = top_k(q_index @ index.T, min(k * rescore_factor, len(corpus) - 1))
+    rescored = np.einsum("qcd,qd->qc", full[candidates], queries)
+    results = np.take_along_axis(candidates, top_k(rescored, k), axis=1)
+    query_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    return results, build_seconds, query_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = synthetic_corpus(args.vectors + args.queries, args.dim, args.clusters, args.seed)
+    corpus, queries = data[:args.vectors], data[args.vectors:]
+    truth = top_k(queries @ corpus.T, args.k)
+
+    baseline = args.vectors * bytes_per_vector(args.dim, "float32")
+    print(f"{args.vectors} vectors x {args.dim} dims, k={args.k}, rescore factor={args.rescore_factor}")
+    print(f"{'storage':<9}{'index dim':>10}{'MiB':>9}{'vs f32':>8}{'recall@k':>10}{'ms/query':>10}")
+    for mode in ("float32", "float16", "int8"):
+        for index_dim in sorted({args.dim, 256, 128, 64}, reverse=True):
+            if index_dim > args.dim:
+                continue
+            results, _, query_ms = run(corpus, queries, mode, index_dim, args.k, args.rescore_factor)
+            recall = np.mean([len(set(r) & set(t)) / args.k for r, t in zip(results, truth)])
+            # Index holds float32 truncated vectors; the sidecar holds full-dim codes (none for the plain layout)
+            index_bytes = args.vectors * bytes_per_vector(index_dim, "float32")
+            sidecar = 0 if mode == "float32" and index_dim == args.dim else args.vectors * bytes_per_vector(args.dim, mode)
+            total = index_bytes + sidecar
+            print(f"{mode:<9}{index_dim:>10}{total / 2**20:>9.1f}{total / baseline:>8.2f}{recall:>10.3f}{query_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
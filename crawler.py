@@ -47,7 +47,7 @@ def fallback_scrape(url):
         traceback.print_exc()
         return ""
 
-async def crawl_url(url):
+async def crawl_url(url, output_file=OUTPUT_FILE):
     print(f"Crawling URL: {url}")
     content_to_save = ""
 
@@ -95,25 +95,25 @@ async def crawl_url(url):
 
     # Write content to file if we got valid text
     if content_to_save:
-        temp_file = f"{OUTPUT_FILE}.temp"
+        temp_file = f"{output_file}.temp"
         try:
             with open(temp_file, "w", encoding="utf-8") as f:
                 f.write(content_to_save)
 
             time.sleep(0.5)
 
-            if os.path.exists(OUTPUT_FILE):
+            if os.path.exists(output_file):
                 try:
-                    os.remove(OUTPUT_FILE)
+                    os.remove(output_file)
                 except PermissionError:
                     timestamp = int(time.time())
-                    fallback_name = f"{OUTPUT_FILE}.{timestamp}"
+                    fallback_name = f"{output_file}.{timestamp}"
                     os.rename(temp_file, fallback_name)
                     print(f"Content saved to fallback file: {fallback_name}")
                     return
 
-            os.rename(temp_file, OUTPUT_FILE)
-            print(f"Crawl succeeded. Content saved to: {OUTPUT_FILE}")
+            os.rename(temp_file, output_file)
+            print(f"Crawl succeeded. Content saved to: {output_file}")
         except Exception as write_error:
             print(f"ERROR: Failed to write content: {write_error}")
             traceback.print_exc()
@@ -126,8 +126,10 @@ if __name__ == "__main__":
         sys.exit(1)
 
     url = sys.argv[1]
+    # Optional second argument lets concurrent crawls write to separate files
+    output_file = sys.argv[2] if len(sys.argv) > 2 else OUTPUT_FILE
     try:
-        asyncio.run(crawl_url(url))
+        asyncio.run(crawl_url(url, output_file))
     except Exception as e:
         print(f"FATAL ERROR: {e}")
         traceback.print_exc()
@@ -0,0 +1,140 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# Cosine similarity a paraphrased question needs to reuse a cached answer
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?!. ")
+
+
+class _Entry:
+    __slots__ = ("scope", "question", "embedding", "response", "created")
+
+    def __init__(self, scope, question, embedding, response):
+        self.scope = scope
+        self.question = question
+        self.embedding = embedding
+        self.response = response
+        self.created = time.monotonic()
+
+
+class AnswerCache:
+    """
+    Answers to earlier /query calls, reused for the same or a paraphrased question.
+
+    Entries live in a scope: the user's database, the collection and its manifest
+    version, plus anything else that changes the answer (filters, retrieval weights).
+    Any ingest, refresh or deletion bumps the version, which drops older entries for
+    that collection on their next lookup. Lookups try the normalized question first and only
+    then compare embeddings, so exact repeats skip embedding the question as well.
+    """
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        # (user_db_path, collection) -> version last seen, for invalidation
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        return now - entry.created > self.ttl_seconds
+
+    def _check_version_locked(self, user_db_path: str, collection_name: str, version):
+        if self._versions.get((user_db_path, collection_name), version) != version:
+            stale = [key for key, entry in self._entries.items() if entry.scope[:2] == (user_db_path, collection_name)]
+            for key in stale:
+                del self._entries[key]
+        self._versions[(user_db_path, collection_name)] = version
+
+    def lookup_exact(self, scope: tuple, question: str) -> dict | None:
+        """scope is (user_db_path, collection name(s), version(s), *answer-affecting settings)"""
+        key = (scope, normalize_question(question))
+        with self._lock:
+            self._check_version_locked(*scope[:3])
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, time.monotonic()):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                # Counted here, so queries that never reach lookup_similar (no question embedding) count too
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return {**entry.response, "cached": True, "cache_match": "exact"}
+
+    def lookup_similar(self, scope: tuple, embedding: list[float]) -> dict | None:
+        """Fallback for a question lookup_exact missed; a hit takes back the miss it counted"""
+        query = _unit(embedding)
+        now = time.monotonic()
+        with self._lock:
+            candidates = [(key, entry) for key, entry in self._entries.items()
+                          if entry.scope == scope and not self._expired(entry, now)]
+            if candidates:
+                scores = np.stack([entry.embedding for _, entry in candidates]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity:
+                    key, entry = candidates[best]
+                    self._entries.move_to_end(key)
+                    self.semantic_hits += 1
+                    self.misses -= 1
+                    return {**entry.response, "cached": True, "cache_match": "semantic",
+                            "cache_similarity": round(float(scores[best]), 4)}
+            return None
+
+    def store(self, scope: tuple, question: str, embedding: list[float], response: dict):
+        key = (scope, normalize_question(question))
+        with self._lock:
+            self._entries[key] = _Entry(scope, key[1], _unit(embedding), response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_db_path: str):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry.scope[0] == user_db_path]:
+                del self._entries[key]
+            for key in [key for key in self._versions if key[0] == user_db_path]:
+                del self._versions[key]
+
+    def sweep(self):
+        """Drop expired entries"""
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if self._expired(entry, now)]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
+
+
+def _unit(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+ANSWER_CACHE = AnswerCache()
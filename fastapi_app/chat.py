@@ -0,0 +1,85 @@
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+# Previous turns shown to the model with each answer
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "3"))
+# A follow-up this similar to the previous retrieval query reuses its chunks without searching
+CHAT_REUSE_SIMILARITY = float(os.getenv("CHAT_REUSE_SIMILARITY", "0.9"))
+# Above this (but below reuse) a small search tops up the previous chunks instead of replacing them
+CHAT_EXTEND_SIMILARITY = float(os.getenv("CHAT_EXTEND_SIMILARITY", "0.75"))
+# Chunks a session carries from turn to turn at most
+CHAT_MAX_HITS = int(os.getenv("CHAT_MAX_HITS", "16"))
+
+# Openers and pronouns that only make sense against the previous turn
+_FOLLOW_UP_RE = re.compile(
+    r"^\s*(and|but|also|so|then|what about|how about|why|how come|what else)\b"
+    r"|\b(it|its|that|this|these|those|they|them|their|he|she|him|her|there|ones?)\b",
+    re.IGNORECASE,
+)
+_WORD_RE = re.compile(r"\w+")
+
+
+def is_follow_up(question: str) -> bool:
+    return len(_WORD_RE.findall(question)) <= 3 or bool(_FOLLOW_UP_RE.search(question))
+
+
+def _cosine(a, b) -> float:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / norm if norm else 0.0
+
+
+class ChatSession:
+    """
+    Conversation state for one chat socket: recent turns and the chunks retrieved for them.
+
+    Follow-ups are retrieved with the last standalone question folded in, so "what about
+    its limits?" searches for what "it" was. When the new retrieval query is close to the
+    last one the previous chunks are reused or topped up rather than fetched again.
+    """
+
+    def __init__(self):
+        self.turns = []
+        self.topic = None
+        self.hits = []
+        self.last_embedding = None
+        self.stats = Counter()
+
+    def retrieval_text(self, question: str) -> str:
+        """The question, condensed with the last standalone question when it reads as a follow-up"""
+        if self.topic is None or not is_follow_up(question):
+            return question
+        return f"{self.topic} {question}"
+
+    def plan(self, embedding) -> tuple[str, float]:
+        """("reuse" | "extend" | "search", similarity to the previous retrieval query)"""
+        if self.last_embedding is None or not self.hits:
+            return "search", 0.0
+        similarity = _cosine(embedding, self.last_embedding)
+        if similarity >= CHAT_REUSE_SIMILARITY:
+            return "reuse", similarity
+        if similarity >= CHAT_EXTEND_SIMILARITY:
+            return "extend", similarity
+        return "search", similarity
+
+    def merge(self, hits: list[dict]) -> list[dict]:
+        """New hits first, then previous ones not found again, capped at CHAT_MAX_HITS"""
+        seen = {hit["id"] for hit in hits}
+        return (hits + [hit for hit in self.hits if hit["id"] not in seen])[:CHAT_MAX_HITS]
+
+    def history(self) -> str:
+        return "\n".join(f"User: {turn['question']}\nAssistant: {turn['answer']}"
+                         for turn in self.turns[-CHAT_HISTORY_TURNS:]) or "(none)"
+
+    def record(self, question: str, answer: str, action: str, embedding=None, hits: list[dict] = None):
+        self.turns.append({"question": question, "answer": answer})
+        del self.turns[:-CHAT_HISTORY_TURNS]
+        if embedding is not None:
+            if self.topic is None or not is_follow_up(question):
+                self.topic = question
+            self.last_embedding = embedding
+            self.hits = hits
+        self.stats[action] += 1
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import re
+
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1500"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """Split text into fixed-size windows, preferring to break on whitespace"""
+    text = text.strip()
+    if not text:
+        return []
+    if len(text) <= chunk_size:
+        return [text]
+
+    overlap = min(overlap, chunk_size // 2)
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            # Back off to the last paragraph/line/space break inside the window
+            for sep in ("\n\n", "\n", " "):
+                cut = text.rfind(sep, start + chunk_size // 2, end)
+                if cut != -1:
+                    end = cut
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+CHUNKING_MODES = ("fixed", "cdc")
+CHUNKING_MODE = os.getenv("CHUNKING_MODE", "fixed")
+CDC_MIN_SIZE = int(os.getenv("CDC_MIN_SIZE", "500"))
+CDC_MAX_SIZE = int(os.getenv("CDC_MAX_SIZE", "3000"))
+# Rough characters per sentence, used to turn the target chunk size into a boundary probability
+_SENTENCE_LEN = 120
+_MASK64 = (1 << 64) - 1
+_BREAK_RE = re.compile(r"\n\s*\n|(?<=[.!?])\s+|\n")
+
+
+def _gear_table() -> list[int]:
+    # Fixed pseudo-random table so boundaries are identical across processes and runs
+    table, state = [], 0x9E3779B97F4A7C15
+    for _ in range(256):
+        state = (state * 6364136223846793005 + 1442695040888963407) & _MASK64
+        table.append(state >> 1)
+    return table
+
+
+_GEAR = _gear_table()
+
+
+def content_defined_chunks(text: str, target_size: int = CHUNK_SIZE, min_size: int = CDC_MIN_SIZE,
+                           max_size: int = CDC_MAX_SIZE) -> list[str]:
+    """
+    Split text where a rolling (gear) hash of the preceding characters hits a target pattern.
+
+    Boundaries are only considered at sentence and paragraph breaks, and the hash only
+    depends on the last ~64 characters, so an edit moves at most the boundaries next to
+    it and every chunk after the next surviving boundary keeps its exact text.
+    """
+    text = text.strip()
+    if not text:
+        return []
+    if len(text) <= min_size:
+        return [text]
+
+    divisor = max(2, target_size // _SENTENCE_LEN)
+    breaks = [(m.end(), m.group().count("\n") > 1) for m in _BREAK_RE.finditer(text)]
+
+    chunks = []
+    start = 0
+    last_break = None
+    h = 0
+    pos = 0
+    for end, is_paragraph in breaks:
+        for ch in text[pos:end].encode("utf-8", errors="ignore"):
+            h = ((h << 1) + _GEAR[ch]) & _MASK64
+        pos = end
+        size = end - start
+        if size >= max_size and last_break is not None and last_break > start:
+            # Too long without a natural boundary: cut at the previous break
+            chunks.append(text[start:last_break].strip())
+            start = last_break
+            size = end - start
+        # High bits mix the whole 64-char window; paragraph ends are four times as likely to cut
+        if size >= min_size and (h >> 32) % (max(1, divisor // 4) if is_paragraph else divisor) == 0:
+            chunks.append(text[start:end].strip())
+            start = end
+        last_break = end
+
+    while len(text) - start > max_size:
+        # No breaks at all in the tail: fall back to fixed windows
+        chunks.append(text[start:start + max_size].strip())
+        start += max_size
+    chunks.append(text[start:].strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+def split_text(text: str, mode: str = CHUNKING_MODE) -> list[str]:
+    if mode == "cdc":
+        return content_defined_chunks(text)
+    return chunk_text(text)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
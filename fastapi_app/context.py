@@ -0,0 +1,128 @@
+import math
+import os
+import re
+from collections import Counter
+
+from lexical import tokenize
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_MAX_PASSAGE_TOKENS = int(os.getenv("CONTEXT_MAX_PASSAGE_TOKENS", "400"))
+# Retrieved candidates per final passage, so MMR and dedup have something to choose from
+CONTEXT_CANDIDATE_FACTOR = int(os.getenv("CONTEXT_CANDIDATE_FACTOR", "2"))
+# 1.0 ranks purely by relevance, lower values favour passages unlike those already picked
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+DUPLICATE_SIMILARITY = float(os.getenv("DUPLICATE_SIMILARITY", "0.8"))
+
+# Passages shorter than this aren't worth squeezing into what is left of the budget
+_MIN_PASSAGE_TOKENS = 20
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def estimate_tokens(text: str) -> int:
+    """~4 characters per token, close enough for Gemini and English text without a tokenizer call"""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def split_sentences(text: str) -> list[str]:
+    return [sentence.strip() for sentence in _SENTENCE_RE.split(text) if sentence.strip()]
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b[term] for term, count in a.items() if term in b)
+    return dot / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+
+
+def _relevances(hits: list[dict]) -> list[float]:
+    """Hit scores rescaled to 0..1; cosine and RRF scores live on different scales"""
+    scores = [hit["score"] for hit in hits]
+    low, high = min(scores), max(scores)
+    return [1.0 if high == low else (score - low) / (high - low) for score in scores]
+
+
+def mmr_order(relevances: list[float], term_vectors: list[Counter], mmr_lambda: float = MMR_LAMBDA) -> list[int]:
+    """Indices in maximal-marginal-relevance order: relevance minus similarity to what is already picked"""
+    if mmr_lambda >= 1:
+        return sorted(range(len(relevances)), key=lambda i: relevances[i], reverse=True)
+    remaining = list(range(len(relevances)))
+    order = []
+    while remaining:
+        def marginal(i):
+            redundancy = max((_cosine(term_vectors[i], term_vectors[j]) for j in order), default=0.0)
+            return mmr_lambda * relevances[i] - (1 - mmr_lambda) * redundancy
+        best = max(remaining, key=marginal)
+        order.append(best)
+        remaining.remove(best)
+    return order
+
+
+def trim_to_relevant(sentences: list[str], query_terms: set, max_tokens: int) -> list[str]:
+    """Keep the sentences sharing most terms with the question, in their original order"""
+    ranked = sorted(range(len(sentences)),
+                    key=lambda i: len(query_terms & set(tokenize(sentences[i]))), reverse=True)
+    keep, used = set(), 0
+    for i in ranked:
+        tokens = estimate_tokens(sentences[i]) + 1
+        if used + tokens > max_tokens:
+            continue
+        keep.add(i)
+        used += tokens
+    return [sentences[i] for i in sorted(keep)]
+
+
+def build_context(question: str, hits: list[dict], budget: int = CONTEXT_TOKEN_BUDGET,
+                  max_passage_tokens: int = CONTEXT_MAX_PASSAGE_TOKENS, mmr_lambda: float = MMR_LAMBDA) -> dict:
+    """
+    Assemble the prompt context from ranked hits within a token budget.
+
+    Near-duplicate passages are dropped, the rest are taken in MMR order, sentences
+    already in the context (chunk overlap, repeated boilerplate) are skipped and long
+    passages are cut down to their most question-relevant sentences. Passage similarity
+    uses term vectors, so no extra embedding calls are made.
+    """
+    hits = [hit for hit in hits if hit.get("document")]
+    if not hits:
+        return {"context": "", "hits": [], "tokens": 0, "budget": budget, "duplicates_dropped": 0, "trimmed": 0}
+
+    term_vectors = [Counter(tokenize(hit["document"])) for hit in hits]
+    kept, duplicates = [], 0
+    for i in range(len(hits)):
+        if any(_cosine(term_vectors[i], term_vectors[j]) >= DUPLICATE_SIMILARITY for j in kept):
+            duplicates += 1
+        else:
+            kept.append(i)
+    relevances = _relevances([hits[i] for i in kept])
+    order = [kept[i] for i in mmr_order(relevances, [term_vectors[i] for i in kept], mmr_lambda)]
+
+    query_terms = set(tokenize(question))
+    seen_sentences = set()
+    passages, selected, used, trimmed = [], [], 0, 0
+    for i in order:
+        remaining = budget - used - 1
+        if remaining < _MIN_PASSAGE_TOKENS:
+            break
+        unique = {}
+        for sentence in split_sentences(hits[i]["document"]):
+            unique.setdefault(sentence.lower(), sentence)
+        sentences = [sentence for key, sentence in unique.items() if key not in seen_sentences]
+        limit = min(max_passage_tokens, remaining)
+        if estimate_tokens(" ".join(sentences)) > limit:
+            sentences = trim_to_relevant(sentences, query_terms, limit)
+            trimmed += 1
+        if not sentences:
+            continue
+        passage = " ".join(sentences)
+        seen_sentences.update(s.lower() for s in sentences)
+        passages.append(passage)
+        selected.append(hits[i])
+        used += estimate_tokens(passage) + 1
+
+    return {
+        "context": "\n\n".join(passages),
+        "hits": selected,
+        "tokens": used,
+        "budget": budget,
+        "duplicates_dropped": duplicates,
+        "trimmed": trimmed,
+    }
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# Get the project root directory (one level up from fastapi_app)
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def crawl_url(url: str) -> str:
+    """Run crawler.py for one URL in a subprocess and return the crawled text ("" on failure)"""
+    crawler_path = os.path.join(PROJECT_ROOT, "crawler.py")
+    # Each crawl writes to its own file so several can run at once
+    fd, crawled_file = tempfile.mkstemp(suffix=".md", prefix="crawled_")
+    os.close(fd)
+    os.unlink(crawled_file)
+
+    try:
+        print(f"Crawling URL: {url}")
+        result = subprocess.run(
+            [sys.executable, crawler_path, url, crawled_file],
+            cwd=PROJECT_ROOT,
+            capture_output=True,
+            text=True,
+            encoding='utf-8',
+            errors='replace'
+        )
+
+        # Log crawler output for debugging
+        if result.returncode != 0:
+            print(f"Warning: Crawler exited with non-zero code: {result.returncode}")
+
+        if result.stdout:
+            print(f"Crawler stdout: {result.stdout[:200]}...")
+        if result.stderr:
+            print(f"Crawler stderr: {result.stderr}")
+
+        if not os.path.exists(crawled_file):
+            print(f"❌ Error: Crawled content file not found at: {crawled_file}")
+            return ""
+
+        with open(crawled_file, "r", encoding="utf-8") as f:
+            text = f.read().strip()
+        if text and not text.startswith("# Failed to crawl") and not text.startswith("# Error crawling"):
+            print(f"✅ Successfully added content from {url} ({len(text)} characters)")
+            return text
+        print(f"⚠️ Failed to extract valid content from {url}")
+        return ""
+    finally:
+        if os.path.exists(crawled_file):
+            os.unlink(crawled_file)
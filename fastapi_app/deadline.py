@@ -0,0 +1,83 @@
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+
+# Model used when too little time is left for the regular one
+DEADLINE_FAST_MODEL = os.getenv("DEADLINE_FAST_MODEL", "gemini-1.5-flash-8b")
+# Time generation is expected to need; stages before it degrade to leave this much
+DEADLINE_GENERATION_MS = int(os.getenv("DEADLINE_GENERATION_MS", "1500"))
+# Time full hybrid retrieval and context building are expected to need
+DEADLINE_RETRIEVAL_MS = int(os.getenv("DEADLINE_RETRIEVAL_MS", "300"))
+# Shortest wait ever given to a stage, however little of the deadline is left
+DEADLINE_MIN_STAGE_MS = int(os.getenv("DEADLINE_MIN_STAGE_MS", "50"))
+DEADLINE_THREADS = int(os.getenv("DEADLINE_THREADS", "16"))
+
+# Provider calls that overrun are abandoned, not cancelled; they finish on this pool
+_deadline_pool = ThreadPoolExecutor(max_workers=DEADLINE_THREADS, thread_name_prefix="deadline")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    Latency budget for one request: per-stage timings plus the degradation steps taken.
+
+    Without a budget nothing is ever cut short, so the same pipeline code serves
+    requests with and without a deadline.
+    """
+
+    def __init__(self, budget_ms: int = None):
+        self.budget_ms = budget_ms
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.degraded = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def remaining_ms(self) -> float:
+        return math.inf if self.budget_ms is None else self.budget_ms - self.elapsed_ms()
+
+    def short_of(self, needed_ms: float) -> bool:
+        """True when less than needed_ms is left"""
+        return self.remaining_ms() < needed_ms
+
+    def degrade(self, step: str):
+        if step not in self.degraded:
+            self.degraded.append(step)
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = round(self.stages.get(name, 0.0) + (time.perf_counter() - started) * 1000, 1)
+
+    def call(self, fn, *args, reserve_ms: float = 0):
+        """
+        fn(*args), giving up once only reserve_ms of the budget is left.
+
+        Raises DeadlineExceeded on timeout; the abandoned call keeps its pool thread
+        until it returns.
+        """
+        if self.budget_ms is None:
+            return fn(*args)
+        timeout_ms = max(self.remaining_ms() - reserve_ms, DEADLINE_MIN_STAGE_MS)
+        future = _deadline_pool.submit(fn, *args)
+        try:
+            return future.result(timeout=timeout_ms / 1000)
+        except FutureTimeout:
+            raise DeadlineExceeded(f"{getattr(fn, '__name__', 'call')} took more than {timeout_ms:.0f} ms")
+
+    def report(self) -> dict:
+        return {
+            "deadline_ms": self.budget_ms,
+            "elapsed_ms": round(self.elapsed_ms(), 1),
+            "stages": self.stages,
+            "degraded": self.degraded,
+        }
@@ -0,0 +1,179 @@
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from maintenance import directory_bytes, remove_orphan_segments
+from manifest import load_manifest, reset_manifest, user_lock
+from resources import (STORAGE_LAYOUT, chroma_path, close_chroma_client, forget_sidecars, open_chroma_client,
+                       store_index_bytes, tenant_client)
+from retrieval import drop_collection
+
+# Attempts per deletion before it is reported failed; the wait doubles after each one
+DELETION_MAX_ATTEMPTS = int(os.getenv("DELETION_MAX_ATTEMPTS", "5"))
+DELETION_RETRY_SECONDS = float(os.getenv("DELETION_RETRY_SECONDS", "2"))
+# Finished deletions stay queryable this long
+DELETION_HISTORY_DAYS = float(os.getenv("DELETION_HISTORY_DAYS", "7"))
+
+TRASH_DIR = "_trash"
+JOBS_FILE = "deletions.json"
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def _trash_dir(user_db_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.normpath(user_db_path)), TRASH_DIR)
+
+
+def _public(job: dict) -> dict:
+    return {key: job[key] for key in ("id", "status", "attempts", "error", "collections", "reclaimed_bytes",
+                                      "requested_at", "finished_at")}
+
+
+class DeletionQueue:
+    """
+    Knowledge-base deletion in two steps: a tombstone now, the disk space later.
+
+    A request waits for any ingest, refresh or compaction of the user to finish, then
+    moves their folder into the trash (one rename) and closes their store, so queries
+    and ingests right after it see a clean slate. In the shared layout
+    the collections left in the shared store are hidden behind an empty manifest. A
+    single background worker then drops those collections and removes the files,
+    retrying with backoff while something still holds them open. Jobs are kept in
+    {DB_PATH}/_trash/deletions.json, so deletions interrupted by a restart resume.
+    """
+
+    def __init__(self):
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="deletion")
+        self._lock = threading.Lock()
+
+    def _load(self, trash_dir: str) -> dict:
+        try:
+            with open(os.path.join(trash_dir, JOBS_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save(self, trash_dir: str, jobs: dict):
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=DELETION_HISTORY_DAYS)).isoformat()
+        jobs = {job_id: job for job_id, job in jobs.items()
+                if job["status"] != "done" or job["finished_at"] >= cutoff}
+        os.makedirs(trash_dir, exist_ok=True)
+        path = os.path.join(trash_dir, JOBS_FILE)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(jobs, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def _set(self, trash_dir: str, job_id: str, **fields) -> dict:
+        with self._lock:
+            jobs = self._load(trash_dir)
+            jobs[job_id].update(fields)
+            self._save(trash_dir, jobs)
+            return jobs[job_id]
+
+    def request(self, user_db_path: str, layout: str = None) -> dict | None:
+        """Tombstone the user's knowledge base and queue its removal; None if there is nothing to delete"""
+        layout = layout or STORAGE_LAYOUT
+        trash_dir = _trash_dir(user_db_path)
+        job_id = uuid.uuid4().hex[:12]
+        path = os.path.join(trash_dir, f"{os.path.basename(os.path.normpath(user_db_path))}.{job_id}")
+        # A writer still inside the folder would recreate files in it after the rename, or lose them to it
+        with user_lock(user_db_path):
+            if not os.path.exists(user_db_path):
+                return None
+            collections = set((load_manifest(user_db_path) or {"collections": {}})["collections"])
+            if layout == "shared":
+                with open_chroma_client(user_db_path) as chroma_client:
+                    collections |= {collection.name for collection in chroma_client.list_collections()}
+            close_chroma_client(user_db_path, layout)
+            forget_sidecars(user_db_path)
+
+            os.makedirs(trash_dir, exist_ok=True)
+            try:
+                os.rename(user_db_path, path)
+                in_place = False
+            except OSError as e:
+                # Files still open where renaming them fails (Windows); delete them where they are
+                print(f"⚠️ Could not move {user_db_path} to the trash, deleting in place: {e}")
+                path, in_place = user_db_path, True
+            if layout == "shared" or in_place:
+                # Without a manifest the next request would rebuild one from what the store still holds
+                reset_manifest(user_db_path)
+
+        job = {"id": job_id, "user_db_path": user_db_path, "path": path, "layout": layout, "in_place": in_place,
+               "collections": sorted(collections), "status": "pending", "attempts": 0, "error": None,
+               "reclaimed_bytes": 0, "requested_at": _now(), "finished_at": None}
+        with self._lock:
+            jobs = self._load(trash_dir)
+            jobs[job_id] = job
+            self._save(trash_dir, jobs)
+        self._pool.submit(self._run, trash_dir, job_id)
+        return _public(job)
+
+    def _reclaim(self, job: dict) -> int:
+        user_db_path, path = job["user_db_path"], job["path"]
+        reclaimed = directory_bytes(path) if os.path.exists(path) else 0
+        if job["layout"] == "shared":
+            store_path = chroma_path(user_db_path, "shared")
+            before = store_index_bytes(store_path)
+            chroma_client = tenant_client(user_db_path)
+            for name in job["collections"]:
+                drop_collection(chroma_client, user_db_path, name)
+            remove_orphan_segments(store_path)
+            reclaimed += max(0, before - store_index_bytes(store_path))
+        else:
+            if job["in_place"]:
+                close_chroma_client(user_db_path, "per_tenant")
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        # Cached index handles still point into the moved folder and would keep its space allocated;
+        # dropping shared-layout collections also reopens the doc store, which must not outlive its file
+        forget_sidecars(user_db_path)
+        return reclaimed
+
+    def _run(self, trash_dir: str, job_id: str):
+        for attempt in range(DELETION_MAX_ATTEMPTS):
+            job = self._set(trash_dir, job_id, status="running", attempts=attempt + 1)
+            try:
+                reclaimed = self._reclaim(job)
+            except Exception as e:
+                print(f"⚠️ Deletion {job_id} attempt {attempt + 1} failed: {e}")
+                self._set(trash_dir, job_id, error=str(e))
+                time.sleep(DELETION_RETRY_SECONDS * 2 ** attempt)
+                continue
+            self._set(trash_dir, job_id, status="done", error=None, reclaimed_bytes=reclaimed, finished_at=_now())
+            print(f"🗑️ Deletion {job_id} done, reclaimed {reclaimed} bytes")
+            return
+        self._set(trash_dir, job_id, status="failed", finished_at=_now())
+
+    def resume(self, db_path: str) -> int:
+        """Requeue deletions left unfinished by a restart, failed ones included; returns how many"""
+        trash_dir = os.path.join(db_path, TRASH_DIR)
+        with self._lock:
+            unfinished = [job_id for job_id, job in self._load(trash_dir).items() if job["status"] != "done"]
+        for job_id in unfinished:
+            self._pool.submit(self._run, trash_dir, job_id)
+        return len(unfinished)
+
+    def blocks(self, user_db_path: str) -> bool:
+        """True while the user's folder is being deleted in place, when nothing may be written to it"""
+        with self._lock:
+            return any(job["in_place"] and job["status"] != "done"
+                       for job in self._load(_trash_dir(user_db_path)).values()
+                       if job["user_db_path"] == user_db_path)
+
+    def status(self, user_db_path: str) -> list[dict]:
+        """The user's deletions, newest first"""
+        with self._lock:
+            jobs = self._load(_trash_dir(user_db_path)).values()
+        return sorted((_public(job) for job in jobs if job["user_db_path"] == user_db_path),
+                      key=lambda job: job["requested_at"], reverse=True)
+
+
+DELETIONS = DeletionQueue()
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from resources import sidecars
+
+# Pruning trades recall for speed, and below tens of thousands of chunks the $in filter it needs makes
+# HNSW slower, not faster (benchmarks/bench_hierarchical.py), so both are opt-in: building the centroids
+# costs every ingest a write, and DOC_FAN_OUT or a per-query doc_fan_out only prunes collections built with them
+HIERARCHICAL_INDEX = os.getenv("HIERARCHICAL_INDEX", "false").lower() == "true"
+# Source documents whose chunks are searched per query; 0 searches every chunk
+DOC_FAN_OUT = int(os.getenv("DOC_FAN_OUT", "0"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (source TEXT PRIMARY KEY, chunks INTEGER NOT NULL, total BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chunks (chunk_id TEXT PRIMARY KEY, source TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS chunks_by_source ON chunks (source);
+"""
+
+
+def _unit(vectors) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+class DocumentIndex:
+    """
+    Top level of a two-level index: one centroid per source document, plus which chunks it owns.
+
+    A query first ranks documents by their centroid and then only searches the chunks
+    of the best few. Centroids are kept as running sums of unit chunk vectors, so adds
+    and deletes update them without re-reading the document's other chunks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._sources = []
+        self._centroids = None
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _update(self, conn, source: str, total: np.ndarray, chunks: int):
+        row = conn.execute("SELECT chunks, total FROM documents WHERE source = ?", (source,)).fetchone()
+        if row:
+            chunks += row[0]
+            total = total + np.frombuffer(row[1], dtype=np.float32)
+        if chunks <= 0:
+            conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+        else:
+            conn.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                         (source, chunks, total.astype(np.float32).tobytes()))
+
+    @staticmethod
+    def _group(vectors: np.ndarray, sources: list[str], sign: int) -> dict:
+        groups = {}
+        for vector, source in zip(vectors, sources):
+            total, chunks = groups.get(source, (0.0, 0))
+            groups[source] = (total + sign * vector, chunks + sign)
+        return groups
+
+    def add(self, ids: list[str], vectors, sources: list[str]):
+        groups = self._group(_unit(vectors), sources, 1)
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?)", zip(ids, sources))
+            for source, (total, chunks) in groups.items():
+                self._update(conn, source, total, chunks)
+
+    def delete(self, ids: list[str], vectors):
+        """Remove chunks; vectors are the ones they were added with, in the same order"""
+        vectors = _unit(vectors) if len(ids) else []
+        with self._lock, self._connect() as conn:
+            owners = {}
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                owners.update(conn.execute(
+                    f"SELECT chunk_id, source FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})", batch
+                ))
+            known = [(vector, owners[chunk_id]) for chunk_id, vector in zip(ids, vectors) if chunk_id in owners]
+            groups = self._group([vector for vector, _ in known], [source for _, source in known], -1)
+            conn.executemany("DELETE FROM chunks WHERE chunk_id = ?", ((chunk_id,) for chunk_id in owners))
+            for source, (total, chunks) in groups.items():
+                self._update(conn, source, total, chunks)
+
+    def _load(self):
+        stamp = os.stat(self.path).st_mtime_ns
+        if stamp == self._stamp:
+            return
+        with self._connect() as conn:
+            rows = conn.execute("SELECT source, total FROM documents").fetchall()
+        self._sources = [source for source, _ in rows]
+        self._centroids = _unit([np.frombuffer(total, dtype=np.float32) for _, total in rows]) if rows else None
+        self._stamp = stamp
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._sources)
+
+    def top_documents(self, query_embedding, n: int) -> list[str]:
+        """Sources of the n documents whose centroids are closest to the query"""
+        with self._lock:
+            self._load()
+            sources, centroids = self._sources, self._centroids
+        if centroids is None:
+            return []
+        scores = centroids @ _unit(query_embedding)[0]
+        n = min(n, len(sources))
+        top = np.argpartition(-scores, n - 1)[:n]
+        return [sources[i] for i in top[np.argsort(-scores[top])]]
+
+    def chunk_ids(self, sources: list[str]) -> set:
+        if not sources:
+            return set()
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT chunk_id FROM chunks WHERE source IN ({','.join('?' * len(sources))})",
+                                sources)
+            return {chunk_id for (chunk_id,) in rows}
+
+
+def document_index_path(user_db_path: str, collection_name: str) -> str:
+    return os.path.join(user_db_path, "documents", f"{collection_name}.sqlite")
+
+
+def get_document_index(user_db_path: str, collection_name: str) -> DocumentIndex:
+    path = document_index_path(user_db_path, collection_name)
+    return sidecars.get(path, lambda: DocumentIndex(path))
+
+
+def drop_document_index(user_db_path: str, collection_name: str):
+    path = document_index_path(user_db_path, collection_name)
+    sidecars.invalidate(path)
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def uses_document_index(metadata: dict) -> bool:
+    return bool((metadata or {}).get("doc_index"))
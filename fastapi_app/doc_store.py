@@ -0,0 +1,117 @@
+import os
+import sqlite3
+import threading
+
+import zstandard
+
+from resources import sidecars
+
+DOC_STORE = os.getenv("DOC_STORE", "zstd")
+DOC_STORE_LEVEL = int(os.getenv("DOC_STORE_LEVEL", "3"))
+# Train a per-user zstd dictionary once this many chunks are stored (0 disables dictionaries)
+DOC_STORE_DICT_MIN_SAMPLES = int(os.getenv("DOC_STORE_DICT_MIN_SAMPLES", "200"))
+DOC_STORE_DICT_SIZE = int(os.getenv("DOC_STORE_DICT_SIZE", str(64 * 1024)))
+
+DOC_STORE_FILE = "chunks.sqlite"
+
+
+class ChunkTextStore:
+    """
+    zstd-compressed chunk text for one user, keyed by chunk ID.
+
+    Kept outside Chroma so the vector index only holds embeddings and small metadata;
+    text is fetched in one batch for the final top-k only.
+    """
+
+    def __init__(self, user_db_path: str):
+        os.makedirs(user_db_path, exist_ok=True)
+        self.path = doc_store_path(user_db_path)
+        self._lock = threading.Lock()
+        self._dicts = {}
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, collection TEXT, dict_id INTEGER, data BLOB)")
+            conn.execute("CREATE INDEX IF NOT EXISTS chunks_collection ON chunks (collection)")
+            conn.execute("CREATE TABLE IF NOT EXISTS dictionaries (id INTEGER PRIMARY KEY, data BLOB)")
+            for dict_id, data in conn.execute("SELECT id, data FROM dictionaries"):
+                self._dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _current_dict_id(self) -> int:
+        return max(self._dicts) if self._dicts else 0
+
+    def _compressor(self, dict_id: int):
+        if dict_id:
+            return zstandard.ZstdCompressor(level=DOC_STORE_LEVEL, dict_data=self._dicts[dict_id])
+        return zstandard.ZstdCompressor(level=DOC_STORE_LEVEL)
+
+    def _decompressor(self, dict_id: int):
+        if dict_id:
+            return zstandard.ZstdDecompressor(dict_data=self._dicts[dict_id])
+        return zstandard.ZstdDecompressor()
+
+    def put(self, collection_name: str, ids: list[str], texts: list[str]):
+        with self._lock:
+            dict_id = self._current_dict_id()
+            compressor = self._compressor(dict_id)
+            rows = [(chunk_id, collection_name, dict_id, compressor.compress(text.encode("utf-8")))
+                    for chunk_id, text in zip(ids, texts)]
+            with self._connect() as conn:
+                conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)", rows)
+            if not self._dicts and DOC_STORE_DICT_MIN_SAMPLES:
+                self._maybe_train_dictionary()
+
+    def _maybe_train_dictionary(self):
+        with self._connect() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            if count < DOC_STORE_DICT_MIN_SAMPLES:
+                return
+            samples = [zstandard.ZstdDecompressor().decompress(data)
+                       for (data,) in conn.execute("SELECT data FROM chunks WHERE dict_id = 0 LIMIT 2000")]
+        try:
+            trained = zstandard.train_dictionary(DOC_STORE_DICT_SIZE, samples)
+        except zstandard.ZstdError as e:
+            print(f"⚠️ Could not train chunk dictionary: {e}")
+            return
+        with self._connect() as conn:
+            conn.execute("INSERT INTO dictionaries (id, data) VALUES (1, ?)", (trained.as_bytes(),))
+        self._dicts[1] = trained
+        print(f"Trained chunk text dictionary for {self.path} from {len(samples)} samples")
+
+    def get_many(self, ids: list[str]) -> dict:
+        """{chunk_id: text} for the ids that exist, in one query"""
+        if not ids:
+            return {}
+        texts = {}
+        decompressors = {}
+        with self._connect() as conn:
+            placeholders = ",".join("?" * len(ids))
+            for chunk_id, dict_id, data in conn.execute(
+                f"SELECT id, dict_id, data FROM chunks WHERE id IN ({placeholders})", list(ids)
+            ):
+                if dict_id not in decompressors:
+                    decompressors[dict_id] = self._decompressor(dict_id)
+                texts[chunk_id] = decompressors[dict_id].decompress(data).decode("utf-8")
+        return texts
+
+    def delete(self, ids: list[str]):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in ids])
+
+    def delete_collection(self, collection_name: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chunks WHERE collection = ?", (collection_name,))
+
+
+def doc_store_path(user_db_path: str) -> str:
+    return os.path.join(user_db_path, DOC_STORE_FILE)
+
+
+def get_doc_store(user_db_path: str) -> ChunkTextStore:
+    return sidecars.get(doc_store_path(user_db_path), lambda: ChunkTextStore(user_db_path))
+
+
+def uses_doc_store(metadata: dict) -> bool:
+    return (metadata or {}).get("doc_store") == "zstd"
@@ -0,0 +1,135 @@
+import hashlib
+import math
+import os
+import re
+import threading
+
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "gemini")
+GEMINI_EMBEDDING_MODEL = os.getenv("GEMINI_EMBEDDING_MODEL", "models/embedding-001")
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", "0"))
+HASHING_EMBEDDING_DIM = int(os.getenv("HASHING_EMBEDDING_DIM", "256"))
+
+_PROVIDERS = {}
+
+
+def register_provider(name: str):
+    """Register an embedding backend factory under `name`"""
+    def decorator(factory):
+        _PROVIDERS[name] = factory
+        return factory
+    return decorator
+
+
+def available_providers() -> list[str]:
+    return sorted(_PROVIDERS)
+
+
+def get_embedding_provider(name: str = None, api_key: str = None) -> Embeddings:
+    """
+    Build the embedding backend for a knowledge base.
+
+    `name` comes from the collection (per knowledge base) and falls back to the
+    EMBEDDING_PROVIDER env var (per deployment).
+    """
+    name = name or EMBEDDING_PROVIDER
+    if name not in _PROVIDERS:
+        raise ValueError(f"Unknown embedding provider '{name}'. Available: {', '.join(available_providers())}")
+    return _PROVIDERS[name](api_key=api_key)
+
+
+def embed_queries(embedder: Embeddings, texts: list[str]) -> list[list[float]]:
+    """Many questions in one batched provider call, embedded the way embed_query() would embed each"""
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    if isinstance(embedder, GoogleGenerativeAIEmbeddings):
+        # embed_documents defaults to the document task type; questions need the query one
+        return embedder.embed_documents(texts, task_type=embedder.task_type or "RETRIEVAL_QUERY")
+    if isinstance(embedder, (LocalSentenceTransformerEmbeddings, HashingEmbeddings)):
+        return embedder.embed_documents(texts)
+    return [embedder.embed_query(text) for text in texts]
+
+
+@register_provider("gemini")
+def _gemini_provider(api_key: str = None) -> Embeddings:
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    if not api_key:
+        raise ValueError("Gemini API key required for the gemini embedding provider")
+    return GoogleGenerativeAIEmbeddings(model=GEMINI_EMBEDDING_MODEL, google_api_key=api_key)
+
+
+class LocalSentenceTransformerEmbeddings(Embeddings):
+    """sentence-transformers model run on CPU with batched inference"""
+
+    _models = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model_name: str = LOCAL_EMBEDDING_MODEL, batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+                 threads: int = LOCAL_EMBEDDING_THREADS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+
+    def _model(self):
+        # Loading weights takes seconds, so one instance is shared per model name
+        with self._lock:
+            if self.model_name not in self._models:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError:
+                    raise ValueError("sentence-transformers is not installed; run `pip install sentence-transformers`")
+                if self.threads:
+                    import torch
+                    torch.set_num_threads(self.threads)
+                self._models[self.model_name] = SentenceTransformer(self.model_name, device="cpu")
+            return self._models[self.model_name]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = self._model().encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+@register_provider("local")
+def _local_provider(api_key: str = None) -> Embeddings:
+    return LocalSentenceTransformerEmbeddings()
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic bag-of-words feature hashing; no model, no network. Meant for tests and offline benchmarks."""
+
+    def __init__(self, dim: int = HASHING_EMBEDDING_DIM):
+        self.dim = dim
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.dim
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            sign = 1.0 if value & 1 else -1.0
+            vector[(value >> 1) % self.dim] += sign
+        norm = math.sqrt(sum(v * v for v in vector))
+        return [v / norm for v in vector] if norm else vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+@register_provider("hashing")
+def _hashing_provider(api_key: str = None) -> Embeddings:
+    return HashingEmbeddings()
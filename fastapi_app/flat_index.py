@@ -0,0 +1,271 @@
+import json
+import operator
+import os
+import shutil
+import struct
+import threading
+
+import numpy as np
+
+from resources import sidecars
+
+# Worth it where most knowledge bases stay small: brute force beats HNSW below about 5k chunks and loses
+# clearly past that (benchmarks/bench_flat_index.py); off by default since large collections gain nothing
+FLAT_INDEX = os.getenv("FLAT_INDEX", "false").lower() == "true"
+# Collections up to this many live chunks are searched by brute force instead of Chroma's HNSW;
+# past it the flat index is retired and no longer grows
+FLAT_INDEX_MAX_CHUNKS = int(os.getenv("FLAT_INDEX_MAX_CHUNKS", "5000"))
+# Rewrite the matrix without deleted rows once tombstones reach this share of it
+FLAT_INDEX_COMPACT_RATIO = float(os.getenv("FLAT_INDEX_COMPACT_RATIO", "0.25"))
+
+# Fixed .npy header size, so appends only rewrite the shape in place
+_HEADER_SIZE = 128
+
+
+def _npy_header(rows: int, dim: int) -> bytes:
+    text = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, dim)
+    text = text.ljust(_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(text)) + text.encode("latin1")
+
+
+def _normalize(vectors) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def _ordered(op):
+    def check(value, expected):
+        try:
+            return op(value, expected)
+        except TypeError:
+            return False  # A string field against a number never matches
+    return check
+
+
+_OPERATORS = {
+    "$eq": operator.eq, "$ne": operator.ne, "$gt": _ordered(operator.gt), "$gte": _ordered(operator.ge),
+    "$lt": _ordered(operator.lt), "$lte": _ordered(operator.le),
+    "$in": lambda value, expected: value in expected, "$nin": lambda value, expected: value not in expected,
+}
+
+
+def matches_where(metadata: dict, where: dict) -> bool:
+    """Whether chunk metadata passes a Chroma `where` filter; as in Chroma, a missing field never matches"""
+    for field, condition in where.items():
+        if field == "$and":
+            passed = all(matches_where(metadata, part) for part in condition)
+        elif field == "$or":
+            passed = any(matches_where(metadata, part) for part in condition)
+        elif field not in metadata:
+            passed = False
+        else:
+            conditions = condition.items() if isinstance(condition, dict) else [("$eq", condition)]
+            passed = all(_OPERATORS[op](metadata[field], expected) for op, expected in conditions)
+        if not passed:
+            return False
+    return True
+
+
+class FlatIndex:
+    """
+    Brute-force vector index for one collection: a memory-mapped .npy matrix of unit rows.
+
+    A query is one matrix-vector product plus argpartition, which for a few thousand
+    chunks beats walking an HNSW graph and needs no index build. Each chunk's metadata
+    is kept alongside, so searches and filters never wait on Chroma. Appends extend the
+    file in place; deletes are tombstones until enough pile up to rewrite the matrix.
+    Files are re-read when another process changes them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._matrix = None
+        self._ids = []
+        self._rows = {}
+        self._dead = np.zeros(0, dtype=bool)
+        self._deleted = set()
+        self._metadata = {}
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _files_stamp(self):
+        return tuple(os.stat(self._file(name)).st_mtime_ns if os.path.exists(self._file(name)) else None
+                     for name in ("vectors.npy", "ids.txt", "deleted.txt", "metadata.jsonl"))
+
+    def _load(self):
+        stamp = self._files_stamp()
+        if stamp == self._stamp:
+            return
+        matrix = np.load(self._file("vectors.npy"), mmap_mode="r") if stamp[0] else None
+        ids = []
+        if stamp[1]:
+            with open(self._file("ids.txt"), "r", encoding="utf-8") as f:
+                ids = f.read().splitlines()
+        deleted = set()
+        if stamp[2]:
+            with open(self._file("deleted.txt"), "r", encoding="utf-8") as f:
+                deleted = set(f.read().splitlines())
+        metadata = {}
+        if stamp[3]:
+            with open(self._file("metadata.jsonl"), "r", encoding="utf-8") as f:
+                metadata = dict(json.loads(line) for line in f)
+        # Vectors are written before ids, so only rows with an id are visible
+        rows = min(len(ids), 0 if matrix is None else matrix.shape[0])
+        self._matrix = None if matrix is None else matrix[:rows]
+        self._ids = ids[:rows]
+        self._rows = {chunk_id: row for row, chunk_id in enumerate(self._ids)}
+        self._deleted = deleted
+        self._metadata = metadata
+        self._dead = np.fromiter((chunk_id in deleted for chunk_id in self._ids), dtype=bool, count=rows)
+        self._stamp = stamp
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return int(len(self._ids) - self._dead.sum())
+
+    def append(self, ids: list[str], vectors, metadatas: list[dict] = None):
+        vectors = _normalize(vectors)
+        with self._lock:
+            self._load()
+            path = self._file("vectors.npy")
+            if not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(_npy_header(len(vectors), vectors.shape[1]))
+                    f.write(vectors.tobytes())
+            else:
+                rows = np.load(path, mmap_mode="r").shape[0]
+                with open(path, "r+b") as f:
+                    f.seek(0, os.SEEK_END)
+                    f.write(vectors.tobytes())
+                    f.seek(0)
+                    f.write(_npy_header(rows + len(vectors), vectors.shape[1]))
+            with open(self._file("metadata.jsonl"), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps([chunk_id, metadata or {}]) + "\n"
+                                for chunk_id, metadata in zip(ids, metadatas or [None] * len(ids))))
+            with open(self._file("ids.txt"), "a", encoding="utf-8") as f:
+                f.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+            self._stamp = None
+
+    def delete(self, ids: list[str]):
+        with self._lock:
+            self._load()
+            with open(self._file("deleted.txt"), "a", encoding="utf-8") as f:
+                f.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+            self._stamp = None
+            self._load()
+            if self._ids and self._dead.sum() >= FLAT_INDEX_COMPACT_RATIO * len(self._ids):
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the matrix and id list without tombstoned rows"""
+        alive = ~self._dead
+        vectors = np.ascontiguousarray(self._matrix[alive])
+        ids = [chunk_id for chunk_id, dead in zip(self._ids, self._dead) if not dead]
+        self._matrix = None
+        with open(self._file("vectors.npy.tmp"), "wb") as f:
+            f.write(_npy_header(len(vectors), vectors.shape[1] if vectors.ndim == 2 else 0))
+            f.write(vectors.tobytes())
+        with open(self._file("ids.txt.tmp"), "w", encoding="utf-8") as f:
+            f.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+        with open(self._file("metadata.jsonl.tmp"), "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps([chunk_id, self._metadata[chunk_id]]) + "\n"
+                            for chunk_id in ids if chunk_id in self._metadata))
+        os.replace(self._file("vectors.npy.tmp"), self._file("vectors.npy"))
+        os.replace(self._file("metadata.jsonl.tmp"), self._file("metadata.jsonl"))
+        os.replace(self._file("ids.txt.tmp"), self._file("ids.txt"))
+        os.remove(self._file("deleted.txt"))
+        self._stamp = None
+
+    @property
+    def retired(self) -> bool:
+        return os.path.exists(self._file("retired"))
+
+    def retire(self):
+        """Delete the matrix for good once the collection has outgrown the flat tier"""
+        with self._lock:
+            self._matrix = None
+            for name in ("vectors.npy", "ids.txt", "deleted.txt", "metadata.jsonl"):
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            open(self._file("retired"), "w").close()
+            self._stamp = None
+
+    def get(self, ids: list[str]) -> tuple[list[str], np.ndarray]:
+        """(found ids, their unit vectors) for the live ids present, in the order given"""
+        with self._lock:
+            self._load()
+            rows = [(chunk_id, row) for chunk_id in ids
+                    if (row := self._rows.get(chunk_id)) is not None and not self._dead[row]]
+            if not rows or self._matrix is None:
+                return [], np.zeros((0, 0), dtype=np.float32)
+            return [chunk_id for chunk_id, _ in rows], np.asarray(self._matrix[[row for _, row in rows]])
+
+    def metadata(self, ids: list[str]) -> dict:
+        """{chunk_id: metadata} for the ids whose metadata the index holds (not those added before it did)"""
+        with self._lock:
+            self._load()
+            return {chunk_id: self._metadata[chunk_id] for chunk_id in ids if chunk_id in self._metadata}
+
+    def matching(self, where: dict) -> set | None:
+        """Live ids whose metadata passes the filter; None if some chunk's metadata isn't held here"""
+        with self._lock:
+            self._load()
+            live = [chunk_id for chunk_id, dead in zip(self._ids, self._dead) if not dead]
+            metadata = self._metadata
+        if any(chunk_id not in metadata for chunk_id in live):
+            return None
+        return {chunk_id for chunk_id in live if matches_where(metadata[chunk_id], where)}
+
+    def search(self, query_embedding, k: int, allowed_ids: set = None) -> list[tuple[str, float]]:
+        """[(chunk_id, cosine similarity)] best first, optionally restricted to allowed_ids"""
+        with self._lock:
+            self._load()
+            matrix, ids, dead, row_of = self._matrix, self._ids, self._dead, self._rows
+        if matrix is None or not len(ids):
+            return []
+        if allowed_ids is not None and len(allowed_ids) * 4 < len(ids):
+            # A small allowed set (one document's chunks, a narrow filter) only touches its own rows
+            rows = np.sort(np.fromiter((row for chunk_id in allowed_ids
+                                        if (row := row_of.get(chunk_id)) is not None and not dead[row]),
+                                       dtype=np.int64))
+            if not len(rows):
+                return []
+            scores = np.asarray(matrix[rows] @ _normalize(query_embedding)[0])
+            top = np.argsort(-scores)[:k]
+            return [(ids[rows[i]], float(scores[i])) for i in top]
+        scores = np.asarray(matrix @ _normalize(query_embedding)[0])
+        excluded = dead.copy()
+        if allowed_ids is not None:
+            excluded |= np.fromiter((chunk_id not in allowed_ids for chunk_id in ids), dtype=bool, count=len(ids))
+        scores[excluded] = -np.inf
+        k = min(k, int((~excluded).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i], float(scores[i])) for i in top]
+
+
+def flat_index_path(user_db_path: str, collection_name: str) -> str:
+    return os.path.join(user_db_path, "flat", collection_name)
+
+
+def get_flat_index(user_db_path: str, collection_name: str) -> FlatIndex:
+    path = flat_index_path(user_db_path, collection_name)
+    return sidecars.get(path, lambda: FlatIndex(path))
+
+
+def drop_flat_index(user_db_path: str, collection_name: str):
+    path = flat_index_path(user_db_path, collection_name)
+    sidecars.invalidate(path)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def uses_flat_index(metadata: dict) -> bool:
+    return bool((metadata or {}).get("flat_index"))
@@ -0,0 +1,98 @@
+import os
+import threading
+from contextlib import contextmanager
+
+HNSW_SPACES = ("l2", "cosine", "ip")
+
+# Deployment defaults for new collections; unset means Chroma's own default
+HNSW_SPACE = os.getenv("HNSW_SPACE") or None
+HNSW_M = int(os.getenv("HNSW_M")) if os.getenv("HNSW_M") else None
+HNSW_CONSTRUCTION_EF = int(os.getenv("HNSW_CONSTRUCTION_EF")) if os.getenv("HNSW_CONSTRUCTION_EF") else None
+HNSW_SEARCH_EF = int(os.getenv("HNSW_SEARCH_EF")) if os.getenv("HNSW_SEARCH_EF") else None
+# What Chroma loads an index with when the collection sets no hnsw:search_ef
+CHROMA_DEFAULT_SEARCH_EF = 10
+
+
+def hnsw_metadata(space: str = None, m: int = None, construction_ef: int = None, search_ef: int = None) -> dict:
+    """Chroma `hnsw:*` collection metadata for the given index parameters; raises ValueError on bad values"""
+    space = space or HNSW_SPACE
+    m = m or HNSW_M
+    construction_ef = construction_ef or HNSW_CONSTRUCTION_EF
+    search_ef = search_ef or HNSW_SEARCH_EF
+    if space and space not in HNSW_SPACES:
+        raise ValueError(f"hnsw_space must be one of: {', '.join(HNSW_SPACES)}")
+    if m is not None and not 2 <= m <= 128:
+        raise ValueError("hnsw_m must be between 2 and 128")
+    for name, value in (("hnsw_construction_ef", construction_ef), ("hnsw_search_ef", search_ef)):
+        if value is not None and not 1 <= value <= 4096:
+            raise ValueError(f"{name} must be between 1 and 4096")
+    metadata = {"hnsw:space": space, "hnsw:M": m, "hnsw:construction_ef": construction_ef, "hnsw:search_ef": search_ef}
+    return {key: value for key, value in metadata.items() if value is not None}
+
+
+class _EfGate:
+    """Queries at the same ef share the loaded index; one at another ef waits for them to finish"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._ef = None
+        self._active = 0
+
+    @contextmanager
+    def hold(self, index, ef: int):
+        with self._cond:
+            self._cond.wait_for(lambda: self._active == 0 or self._ef == ef)
+            if index.ef != ef:
+                index.set_ef(ef)
+            self._ef = ef
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                if not self._active:
+                    self._cond.notify_all()
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def _loaded_index(collection):
+    """The hnswlib index Chroma has loaded for the collection, or None where that can't be reached"""
+    # The segment manager and the segment's _index are chromadb 0.5.23 internals
+    manager = getattr(getattr(collection, "_client", None), "_manager", None)
+    if not hasattr(manager, "get_segment"):
+        return None
+    try:
+        from chromadb.segment import VectorReader
+
+        index = getattr(manager.get_segment(collection.id, VectorReader), "_index", None)
+    except Exception as e:
+        print(f"⚠️ Could not reach the HNSW index of {collection.name}: {e}")
+        return None
+    return index if hasattr(index, "set_ef") and hasattr(index, "ef") else None
+
+
+@contextmanager
+def hnsw_search_ef(collection, search_ef: int = None):
+    """
+    Run the queries inside this block at one HNSW ef; yields whether it could be set.
+
+    Chroma reads hnsw:search_ef once when it loads the index and refuses to modify the
+    metadata of collections with a custom space, so the loaded hnswlib index, which
+    every query on the collection in this process shares, is tuned directly. Each block
+    sets the ef it resolves (the request's, else the collection's, else Chroma's
+    default), so one query's override never leaks into the next, and blocks wanting a
+    different ef take turns on the index instead of changing it under each other.
+    """
+    ef = search_ef or (collection.metadata or {}).get("hnsw:search_ef") or CHROMA_DEFAULT_SEARCH_EF
+    index = _loaded_index(collection)
+    if index is None:
+        yield False
+        return
+    with _gates_lock:
+        gate = _gates.setdefault(collection.id, _EfGate())
+    with gate.hold(index, ef):
+        yield True
@@ -0,0 +1,90 @@
+import os
+import re
+
+INTENT_FAST_PATH = os.getenv("INTENT_FAST_PATH", "true").lower() == "true"
+# Longer messages always go through retrieval, however polite they are
+INTENT_MAX_WORDS = int(os.getenv("INTENT_MAX_WORDS", "8"))
+
+# Checked in this order, so "thanks, bye" is a farewell and "hi, thanks" is thanks
+_KEYWORDS = {
+    "farewell": {"bye", "goodbye", "byebye", "cya", "farewell", "goodnight", "later", "ciao", "adios", "ttyl"},
+    "thanks": {"thanks", "thank", "thx", "ty", "cheers", "appreciate", "appreciated", "grateful"},
+    "greeting": {"hi", "hello", "hey", "hiya", "howdy", "yo", "greetings", "sup", "morning", "afternoon",
+                 "evening", "hola"},
+    "acknowledgement": {"ok", "okay", "k", "kk", "cool", "nice", "great", "awesome", "perfect", "sure",
+                        "alright", "understood", "gotcha", "got", "noted", "lol", "wow", "helpful"},
+}
+_PHRASES = {
+    "farewell": ("see you", "talk later", "have a good day", "have a nice day", "take care"),
+    "greeting": ("how are you", "how is it going", "how's it going", "what's up", "whats up", "good to see you"),
+    "thanks": ("thank you", "much appreciated"),
+}
+# Words that carry no request of their own in "thanks so much for your help" or "hi there"; on their own
+# they pass, but a trailing "?" turns them into a follow-up like "and then?" or "is it?"
+_FILLER = {"a", "again", "all", "and", "for", "good", "guys", "it", "lot", "me", "much", "my", "oh", "so", "that",
+           "the", "then", "there", "this", "to", "very", "you", "your", "help", "bot", "assistant", "crawlmind",
+           "friend", "day", "night", "now", "well", "yes", "yeah", "yep", "really", "just", "is", "was"}
+# Always a question unless part of a pleasantry phrase such as "how are you"
+_QUESTION_WORDS = {"what", "why", "how", "when", "where", "which", "who", "whom", "whose", "explain", "summarize",
+                   "summarise", "list", "tell", "show", "find"}
+_WORD_RE = re.compile(r"[a-z']+")
+
+RESPONSES = {
+    "greeting": "Hi! Ask me anything about the documents you've uploaded.",
+    "thanks": "You're welcome! Let me know if you have any other questions about your documents.",
+    "farewell": "Goodbye! Come back any time you have questions about your documents.",
+    "acknowledgement": "Great. Is there anything else you'd like to know about your documents?",
+}
+
+
+def classify(text: str) -> dict:
+    """
+    Decide whether a message is small talk that needs no retrieval.
+
+    Known pleasantry phrases are matched first, then every word is marked as small talk,
+    filler or content. A message is small talk only when it is short, every word is a
+    pleasantry or filler, no question word appears outside a pleasantry phrase, and it
+    is not filler ending in "?". Returns {"intent", "score", "fast_path"}, score being
+    the share of small-talk and filler words; intent is "question" for anything else.
+    """
+    normalized = " ".join(_WORD_RE.findall(text.lower().replace("’", "'")))
+    words = normalized.split()
+    if not words or len(words) > INTENT_MAX_WORDS:
+        return {"intent": "question", "score": 0.0, "fast_path": False}
+
+    counts = dict.fromkeys(_KEYWORDS, 0)
+    # None for content, else what covered the word: "phrase", "keyword" or "filler"
+    covered = [None] * len(words)
+    for intent, phrases in _PHRASES.items():
+        for phrase in phrases:
+            for match in re.finditer(rf"\b{re.escape(phrase)}\b", normalized):
+                counts[intent] += 1
+                start = normalized[:match.start()].count(" ")
+                for i in range(start, start + len(phrase.split())):
+                    covered[i] = "phrase"
+    for i, word in enumerate(words):
+        for intent, keywords in _KEYWORDS.items():
+            if covered[i] is None and word in keywords:
+                counts[intent] += 1
+                covered[i] = "keyword"
+                break
+        else:
+            if covered[i] is None and word in _FILLER:
+                covered[i] = "filler"
+
+    intent = next((name for name in _KEYWORDS if counts[name]), None)
+    score = sum(1 for how in covered if how) / len(words)
+    # "ok so what is it" and "nice, and the pricing" ask for something after opening politely
+    asks = (any(how is None or (word in _QUESTION_WORDS and how != "phrase") for word, how in zip(words, covered))
+            or (text.rstrip().endswith("?") and "filler" in covered))
+    if intent is None or asks:
+        return {"intent": "question", "score": round(score, 2), "fast_path": False}
+    return {"intent": intent, "score": round(score, 2), "fast_path": INTENT_FAST_PATH}
+
+
+def small_talk_reply(text: str):
+    """(canned answer, classification) for small talk on the fast path, (None, classification) otherwise"""
+    classification = classify(text)
+    if not classification["fast_path"]:
+        return None, classification
+    return RESPONSES[classification["intent"]], classification
@@ -0,0 +1,193 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+from resources import sidecars
+
+LEXICAL_INDEX = os.getenv("LEXICAL_INDEX", "true").lower() == "true"
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Query terms found in more than this share of chunks are skipped
+LEXICAL_MAX_DF_RATIO = float(os.getenv("LEXICAL_MAX_DF_RATIO", "0.5"))
+WAL_SIZE_LIMIT = 4 * 2 ** 20
+
+# Keeps identifiers like ERR_CONN_42, os.path.join or v1.2-beta as single tokens
+_TOKEN_RE = re.compile(r"[a-z0-9_]+(?:[.\-:/][a-z0-9_]+)*")
+_FILTER_COLUMNS = {"source", "domain", "filename", "ingested_at"}
+# Left out of the index and of queries: they match nearly every chunk and only make natural-language questions slow
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in into is it its me my no not of on or "
+    "our so such that the their then there these they this to was were what when where which who why will with "
+    "would you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased tokens; compound identifiers also emit their parts so `join` matches `os.path.join`"""
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        tokens.append(token)
+        parts = re.split(r"[.\-:/_]", token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+
+def index_terms(text: str) -> list[str]:
+    """tokenize() without stopwords, for the index and its queries"""
+    return [token for token in tokenize(text) if token not in STOPWORDS]
+
+
+def _where_to_sql(where: dict) -> tuple[str, list]:
+    """Translate the Chroma filters built by retrieval.build_where into SQL on the docs table"""
+    if not where:
+        return "", []
+    if "$and" in where:
+        clauses, params = [], []
+        for condition in where["$and"]:
+            clause, clause_params = _where_to_sql(condition)
+            clauses.append(clause)
+            params.extend(clause_params)
+        return " AND ".join(clauses), params
+    (field, condition), = where.items()
+    if field not in _FILTER_COLUMNS:
+        raise ValueError(f"Unsupported lexical filter field: {field}")
+    if isinstance(condition, dict):
+        (op, value), = condition.items()
+        return f"d.{field} {'>=' if op == '$gte' else '<='} ?", [value]
+    return f"d.{field} = ?", [condition]
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index for one collection, stored in SQLite next to the vectors.
+
+    Terms and chunks are mapped to integer ids, so postings are (term, doc, tf) rows of
+    three integers clustered by term, plus a (doc) index that deletes go through. Corpus
+    totals and each term's document frequency are kept up to date on adds and deletes,
+    and queries are scored inside SQLite, which returns only the top k.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE, "
+                         "df INTEGER NOT NULL DEFAULT 0)")
+            conn.execute("CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, chunk_id TEXT UNIQUE, "
+                         "length INTEGER, source TEXT, domain TEXT, filename TEXT, ingested_at INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS postings (term INTEGER, doc INTEGER, tf INTEGER, "
+                         "PRIMARY KEY (term, doc)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "doc_count INTEGER, total_length INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO stats VALUES (0, 0, 0)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        # SQLite checkpoints the WAL on its own every ~1000 pages; this truncates it back down when it does
+        conn.execute(f"PRAGMA journal_size_limit = {WAL_SIZE_LIMIT}")
+        return conn
+
+    @staticmethod
+    def _delete(conn, ids: list[str]):
+        removed, removed_length = 0, 0
+        for chunk_id in ids:
+            row = conn.execute("SELECT id, length FROM docs WHERE chunk_id = ?", (chunk_id,)).fetchone()
+            if row is None:
+                continue
+            doc, length = row
+            conn.execute("UPDATE terms SET df = df - 1 WHERE id IN (SELECT term FROM postings WHERE doc = ?)", (doc,))
+            conn.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+            conn.execute("DELETE FROM docs WHERE id = ?", (doc,))
+            removed += 1
+            removed_length += length
+        conn.execute("UPDATE stats SET doc_count = doc_count - ?, total_length = total_length - ?",
+                     (removed, removed_length))
+
+    def add(self, ids: list[str], texts: list[str], metadatas: list[dict] = None):
+        metadatas = metadatas or [{}] * len(ids)
+        postings, docs, df, total_length = [], [], Counter(), 0
+        for chunk_id, text, metadata in zip(ids, texts, metadatas):
+            counts = Counter(index_terms(text))
+            length = sum(counts.values())
+            total_length += length
+            df.update(counts.keys())
+            postings.extend((term, chunk_id, tf) for term, tf in counts.items())
+            docs.append((chunk_id, length, metadata.get("source"), metadata.get("domain"),
+                         metadata.get("filename"), metadata.get("ingested_at")))
+        with self._lock, self._connect() as conn:
+            # Re-added chunks replace their old postings instead of adding to them
+            self._delete(conn, ids)
+            conn.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", [(term,) for term in df])
+            conn.executemany("UPDATE terms SET df = df + ? WHERE term = ?", [(n, term) for term, n in df.items()])
+            conn.executemany("INSERT INTO docs (chunk_id, length, source, domain, filename, ingested_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", docs)
+            conn.executemany("INSERT INTO postings VALUES ((SELECT id FROM terms WHERE term = ?), "
+                             "(SELECT id FROM docs WHERE chunk_id = ?), ?)", postings)
+            conn.execute("UPDATE stats SET doc_count = doc_count + ?, total_length = total_length + ?",
+                         (len(docs), total_length))
+
+    def delete(self, ids: list[str]):
+        with self._lock, self._connect() as conn:
+            self._delete(conn, ids)
+
+    def search(self, query: str, k: int, where: dict = None) -> list[tuple[str, float]]:
+        """[(chunk_id, bm25 score)] best first"""
+        terms = set(index_terms(query))
+        if not terms:
+            return []
+        filter_sql, filter_params = _where_to_sql(where)
+        with self._connect() as conn:
+            doc_count, total_length = conn.execute("SELECT doc_count, total_length FROM stats").fetchone()
+            if not doc_count:
+                return []
+            found = conn.execute(f"SELECT id, df FROM terms WHERE df > 0 AND term IN ({', '.join('?' * len(terms))})",
+                                 list(terms)).fetchall()
+            if not found:
+                return []
+            # Terms in most chunks add almost nothing to the ranking but cost a scan of most postings;
+            # the rarest term is always kept so such a query still gets an answer
+            kept = ([(term_id, df) for term_id, df in found if df <= doc_count * LEXICAL_MAX_DF_RATIO]
+                    or [min(found, key=lambda row: row[1])])
+            weighted = [(term_id, math.log(1 + (doc_count - df + 0.5) / (df + 0.5))) for term_id, df in kept]
+            values = ", ".join("(?, ?)" for _ in weighted)
+            return conn.execute(
+                f"WITH q (term, idf) AS (VALUES {values}) "
+                "SELECT d.chunk_id, SUM(q.idf * p.tf * (? + 1) / (p.tf + ? * (1 - ? + ? * d.length / ?))) AS score "
+                "FROM q JOIN postings p ON p.term = q.term JOIN docs d ON d.id = p.doc "
+                f"{'WHERE ' + filter_sql if filter_sql else ''} "
+                "GROUP BY p.doc ORDER BY score DESC LIMIT ?",
+                [*(value for pair in weighted for value in pair), BM25_K1, BM25_K1, BM25_B, BM25_B,
+                 total_length / doc_count, *filter_params, k]
+            ).fetchall()
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT doc_count FROM stats").fetchone()[0]
+
+
+def lexical_index_path(user_db_path: str, collection_name: str) -> str:
+    return os.path.join(user_db_path, "lexical", f"{collection_name}.sqlite")
+
+
+def get_lexical_index(user_db_path: str, collection_name: str) -> LexicalIndex:
+    path = lexical_index_path(user_db_path, collection_name)
+    return sidecars.get(path, lambda: LexicalIndex(path))
+
+
+def drop_lexical_index(user_db_path: str, collection_name: str):
+    path = lexical_index_path(user_db_path, collection_name)
+    sidecars.invalidate(path)
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def uses_lexical_index(metadata: dict) -> bool:
+    return bool((metadata or {}).get("lexical_index"))
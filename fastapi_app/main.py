@@ -1,18 +1,41 @@
-from fastapi import FastAPI, Form, UploadFile, Depends, Request, HTTPException
+from fastapi import FastAPI, Form, UploadFile, Depends, Request, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from auth_clerk import get_current_user_id, get_current_user
+from fastapi.responses import JSONResponse, StreamingResponse
+from auth_clerk import get_current_user_id, get_current_user, verify_clerk_token
 import jwt
 import requests
 
-import os, sys, subprocess, uuid, tempfile, shutil
-from chromadb import PersistentClient
-from langchain_chroma import Chroma
-from langchain_google_genai import GoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_core.prompts import PromptTemplate
+import os, uuid, tempfile, asyncio, json, time
+from contextlib import ExitStack, asynccontextmanager, suppress
 from langchain_community.document_loaders import TextLoader, PyPDFLoader
 from dotenv import load_dotenv
 import pathlib
+from crawling import crawl_url
+from chunking import CHUNKING_MODE, CHUNKING_MODES, content_hash, split_text
+from embeddings import EMBEDDING_PROVIDER, embed_queries
+from doc_store import DOC_STORE
+from lexical import LEXICAL_INDEX, uses_lexical_index
+from flat_index import FLAT_INDEX
+from doc_index import HIERARCHICAL_INDEX
+from index_params import hnsw_metadata
+from pipeline import run_ingestion
+from quantization import compact_settings, validate_settings
+from retrieval import (DEFAULT_K, HYBRID_LEXICAL_WEIGHT, HYBRID_VECTOR_WEIGHT, add_vectors, batch_search, build_where,
+                       delete_where, embeddings_by_hash, fan_out_search, hybrid_search, source_metadata)
+from manifest import (active_collection, adjust_documents, collection_version, load_manifest, rebuild_manifest,
+                      record_ingest, user_lock)
+from answer_cache import ANSWER_CACHE, ANSWER_CACHE_ENABLED
+from context import CONTEXT_CANDIDATE_FACTOR, CONTEXT_TOKEN_BUDGET, MMR_LAMBDA, build_context, split_sentences
+from deadline import (DEADLINE_FAST_MODEL, DEADLINE_GENERATION_MS, DEADLINE_RETRIEVAL_MS, Deadline,
+                      DeadlineExceeded)
+from intent import small_talk_reply
+from chat import ChatSession
+from warmup import WARMUP
+from maintenance import MAINTENANCE_ENABLED, compact_user, run_maintenance_scheduler
+from deletion import DELETIONS
+from resources import CHAT_PROMPT, RAG_PROMPT, STORAGE_LAYOUT, cache_stats, get_embeddings, get_llm, open_chroma_client, sweep_all
+from refresh import (REFRESH_ENABLED, forget_sources, load_sources, register_source, remember_api_key,
+                     refresh_source, run_refresh_scheduler)
 
 root_env_path = pathlib.Path(__file__).parent.parent / ".env"
 load_dotenv(dotenv_path=root_env_path)
@@ -28,6 +51,35 @@ app.add_middleware(
 )
 
 DB_PATH = os.getenv("DATABASE_PATH", "./crawlmind_db")
+MAX_BATCH_QUESTIONS = int(os.getenv("MAX_BATCH_QUESTIONS", "1000"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+CHAT_AUTH_TIMEOUT_SECONDS = float(os.getenv("CHAT_AUTH_TIMEOUT_SECONDS", "10"))
+
+@app.on_event("startup")
+async def start_refresh_scheduler():
+    if REFRESH_ENABLED:
+        app.state.refresh_task = asyncio.create_task(run_refresh_scheduler(DB_PATH))
+
+@app.on_event("startup")
+async def start_maintenance_scheduler():
+    if MAINTENANCE_ENABLED:
+        app.state.maintenance_task = asyncio.create_task(run_maintenance_scheduler(DB_PATH))
+
+@app.on_event("startup")
+async def resume_deletions():
+    resumed = await asyncio.to_thread(DELETIONS.resume, DB_PATH)
+    if resumed:
+        print(f"🗑️ Resuming {resumed} unfinished deletion(s)")
+
+async def sweep_idle_resources():
+    while True:
+        await asyncio.sleep(60)
+        await asyncio.to_thread(sweep_all)
+        ANSWER_CACHE.sweep()
+
+@app.on_event("startup")
+async def start_resource_sweeper():
+    app.state.sweeper_task = asyncio.create_task(sweep_idle_resources())
 
 @app.get("/")
 def read_root():
@@ -35,7 +87,9 @@ def read_root():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy", "database_path": DB_PATH}
+    return {"status": "healthy", "database_path": DB_PATH, "storage_layout": STORAGE_LAYOUT,
+            "resource_caches": cache_stats(),
+            "answer_cache": ANSWER_CACHE.stats(), "warmup": WARMUP.stats()}
 
 @app.get("/verify-token")
 def verify_token(user: dict = Depends(get_current_user)):
@@ -61,6 +115,9 @@ def verify_token(user: dict = Depends(get_current_user)):
             profile_image = user.get(img_field)
             break
     
+    # Front ends verify right after sign-in, so this is the moment to preload the user's index
+    warmup = WARMUP.schedule(f"{DB_PATH}/{user_id}", user_id)
+
     # Return comprehensive user data
     return {
         "status": "valid",
@@ -68,6 +125,7 @@ def verify_token(user: dict = Depends(get_current_user)):
         "name": name,
         "profile_image": profile_image,
         "token_valid": True,
+        "warmup": warmup,
         "all_fields": user  # Include all fields for debugging
     }
 
@@ -92,6 +150,7 @@ async def verify_token_post(request: Request):
                 "user_id": payload.get("sub"),
                 "email": payload.get("email"),
                 "token_valid": True,
+                "warmup": WARMUP.schedule(f"{DB_PATH}/{payload.get('sub')}", payload.get("sub")),
                 "payload": payload
             }
         except Exception as e:
@@ -175,36 +234,115 @@ async def debug_token(request: Request):
         )
 
 def safe_clear_database(user_id: str):
+    """Tombstone the user's database right away; its files are removed by the background deletion worker"""
     user_db_path = f"{DB_PATH}/{user_id}"
-    if os.path.exists(user_db_path):
+    try:
+        deletion = DELETIONS.request(user_db_path)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database cleanup error: {str(e)}")
+    if deletion is None:
+        return {"success": True, "message": "No existing database to clear"}
+    ANSWER_CACHE.invalidate(user_db_path)
+    return {"success": True, "message": "Database cleared; files are being removed in the background",
+            "deletion": deletion}
+
+@app.delete("/database", status_code=202)
+def clear_database(user_id: str = Depends(get_current_user_id)):
+    """Delete all of the user's collections, indexes and files; poll GET /database/deletions for progress"""
+    return safe_clear_database(user_id)
+
+@app.get("/database/deletions")
+def deletion_status(user_id: str = Depends(get_current_user_id)):
+    """The user's knowledge-base deletions, newest first: pending, running, done (with reclaimed_bytes) or failed"""
+    return {"deletions": DELETIONS.status(f"{DB_PATH}/{user_id}")}
+
+@app.post("/maintenance/compact")
+def compact_database(
+    keep_last: int = Form(None),
+    max_age_days: float = Form(None),
+    merge: bool = Form(None),
+    dry_run: bool = Form(False),
+    user_id: str = Depends(get_current_user_id)
+):
+    """Apply the retention policy to the user's collections now; dry_run only reports what would expire"""
+    user_db_path = f"{DB_PATH}/{user_id}"
+    if not os.path.exists(user_db_path):
+        raise HTTPException(status_code=404, detail="No documents found. Please upload documents first.")
+    if (keep_last is not None and keep_last < 0) or (max_age_days is not None and max_age_days < 0):
+        raise HTTPException(status_code=400, detail="keep_last and max_age_days must be >= 0 (0 applies no limit)")
+    policy = {key: value for key, value in (("keep_last", keep_last), ("max_age_days", max_age_days),
+                                            ("merge", merge)) if value is not None}
+    try:
+        return compact_user(user_db_path, dry_run=dry_run, **policy)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Compaction error: {str(e)}")
+
+def load_file(path: str, suffix: str) -> list[tuple[str, int]]:
+    """(text, page number) for each non-empty page; page is None for plain text files"""
+    loader = PyPDFLoader(path) if suffix == "pdf" else TextLoader(path)
+    return [
+        (doc.page_content.strip(), doc.metadata.get("page") if suffix == "pdf" else None)
+        for doc in loader.load() if doc.page_content.strip()
+    ]
+
+@asynccontextmanager
+async def _holding(lock):
+    """Hold a threading lock across awaits, waiting for it off the event loop"""
+    acquiring = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # The waiting thread still takes the lock; hand it straight back
+        acquiring.add_done_callback(lambda _: lock.release())
+        raise
+    try:
+        yield
+    finally:
+        lock.release()
+
+async def load_source(source: dict) -> list[dict]:
+    """Pipeline loader: turn one URL or uploaded file into a list of pages"""
+    if source["type"] == "url":
+        url = source["url"]
         try:
-            import gc
-            import time
-            gc.collect()
-            
-            for attempt in range(3):
-                try:
-                    shutil.rmtree(user_db_path)
-                    return {"success": True, "message": "Database cleared"}
-                except PermissionError:
-                    if attempt < 2:
-                        time.sleep(1)
-                        gc.collect()
-                    else:
-                        
-                        import datetime
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        new_path = f"{user_db_path}_{timestamp}"
-                        return {"success": True, "message": f"Using new database: {new_path}", "new_path": new_path}
+            text = await asyncio.to_thread(crawl_url, url)
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Database cleanup error: {str(e)}")
-    return {"success": True, "message": "No existing database to clear"}
+            print(f"❌ Error crawling {url}: {str(e)}")
+            return []
+        return [{"text": text, "source": url, "metadata": source_metadata(url, "url")}] if text else []
+
+    file = source["file"]
+    try:
+        suffix = file.filename.split(".")[-1]
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{suffix}") as tmp_file:
+            tmp_file.write(await file.read())
+            tmp_path = tmp_file.name
+        try:
+            pages = await asyncio.to_thread(load_file, tmp_path, suffix)
+        finally:
+            os.unlink(tmp_path)
+        return [
+            {"text": text, "source": file.filename, "metadata": source_metadata(file.filename, "file", page)}
+            for text, page in pages
+        ]
+    except Exception as e:
+        print(f"Error processing file {file.filename}: {str(e)}")
+        return []
 
 @app.post("/embed")
 async def embed_docs(
     request: Request,
     urls: list[str] = Form(None),
-    gemini_api_key: str = Form(...),
+    gemini_api_key: str = Form(None),
+    embedding_provider: str = Form(None),
+    vector_storage: str = Form(None),
+    vector_dim: int = Form(None),
+    chunking: str = Form(None),
+    refresh_interval_hours: float = Form(None),
+    hnsw_space: str = Form(None),
+    hnsw_m: int = Form(None),
+    hnsw_construction_ef: int = Form(None),
+    hnsw_search_ef: int = Form(None),
     files: list[UploadFile] = None,
     user_id: str = Depends(get_current_user_id)
 ):
@@ -216,211 +354,880 @@ async def embed_docs(
         collection_name = f"{user_id}_collection_{timestamp}"
         
         print(f"Using database: {user_db_path} with collection: {collection_name}")
-        
-        # Using the GitHub repo style ChromaDB initialization - no Settings object
-        chroma_client = PersistentClient(path=user_db_path)
-        collection = chroma_client.get_or_create_collection(name=collection_name)
+        if DELETIONS.blocks(user_db_path):
+            raise HTTPException(status_code=409, detail="Your previous data is still being deleted; try again shortly")
+        remember_api_key(user_id, gemini_api_key)
 
-        embedding_function = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=gemini_api_key
-        )
+        provider_name = embedding_provider or EMBEDDING_PROVIDER
+        try:
+            embedding_function = get_embeddings(provider_name, gemini_api_key)
+            # Optional compact storage: quantized sidecar vectors + truncated index vectors
+            storage_settings = validate_settings(vector_storage, vector_dim)
+            # HNSW parameters are fixed when the collection is created (search ef can be overridden per query)
+            index_settings = hnsw_metadata(hnsw_space, hnsw_m, hnsw_construction_ef, hnsw_search_ef)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        chunking_mode = chunking or CHUNKING_MODE
+        if chunking_mode not in CHUNKING_MODES:
+            raise HTTPException(status_code=400, detail=f"chunking must be one of: {', '.join(CHUNKING_MODES)}")
 
-        all_chunks = []
+        # Compaction must not merge into or drop the collections this ingest reads and supersedes
+        async with _holding(user_lock(user_db_path)):
+            # Cached PersistentClient, leased so it can't be closed while this ingest uses it
+            with open_chroma_client(user_db_path) as chroma_client:
+                # Unchanged chunks from the previous ingest can reuse their embeddings, provided
+                # that collection was embedded and stored the same way as the new one
+                new_metadata = {"embedding_provider": provider_name, "tenant_id": user_id,
+                                **storage_settings, **index_settings}
+                if DOC_STORE == "zstd":
+                    new_metadata["doc_store"] = "zstd"
+                if LEXICAL_INDEX:
+                    # BM25 index over the chunk text, built alongside the vectors for hybrid /query
+                    new_metadata["lexical_index"] = True
+                if FLAT_INDEX and not compact_settings(new_metadata):
+                    # Memory-mapped brute-force tier, searched instead of HNSW while the collection is small;
+                    # not for compact collections, whose float32 matrix would undo the quantization
+                    new_metadata["flat_index"] = True
+                if HIERARCHICAL_INDEX:
+                    # Per-document centroids, so large collections only search the chunks of relevant documents
+                    new_metadata["doc_index"] = True
+                previous_collection = None
+                previous_name = active_collection(user_db_path)
+                if load_manifest(user_db_path) is None:
+                    previous_name = rebuild_manifest(
+                        user_db_path, chroma_client.list_collections(), f"{user_id}_collection_"
+                    )["active_collection"]
+                if previous_name:
+                    candidate = chroma_client.get_collection(previous_name)
+                    previous_metadata = candidate.metadata or {}
+                    if (previous_metadata.get("embedding_provider", "gemini") == provider_name
+                            and compact_settings(previous_metadata) == compact_settings(new_metadata)):
+                        previous_collection = candidate
 
-       
-        if urls:
-            for url in urls:
-                try:
-                    # Get the project root directory (one level up from fastapi_app)
-                    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-                    crawler_path = os.path.join(project_root, "crawler.py")
-                    
-                    # Run crawler with the correct path and capture output
-                    print(f"Crawling URL: {url}")
-                    result = subprocess.run(
-                        [sys.executable, crawler_path, url], 
-                        cwd=project_root,
-                        capture_output=True,
-                        text=True,
-                        encoding='utf-8',
-                        errors='replace'
+                # The provider is recorded on the collection so /query embeds questions the same way
+                collection = chroma_client.get_or_create_collection(
+                    name=collection_name,
+                    metadata=new_metadata
+                )
+
+                sources = [{"type": "url", "url": url} for url in (urls or [])]
+                sources += [{"type": "file", "file": file} for file in (files or [])]
+
+                previous_embeddings = {}
+                crawled_hashes = {}
+
+                async def load(source):
+                    pages = await load_source(source)
+                    if source["type"] == "url" and pages:
+                        crawled_hashes[source["url"]] = content_hash(pages[0]["text"])
+                    return pages
+
+                def chunk_page(page):
+                    source = page["source"]
+                    if previous_collection is not None and source not in previous_embeddings:
+                        try:
+                            previous_embeddings[source] = embeddings_by_hash(previous_collection, user_db_path, source)
+                        except Exception as e:
+                            print(f"Could not load previous embeddings for {source}: {e}")
+                            previous_embeddings[source] = {}
+                    chunks = []
+                    for index, text in enumerate(split_text(page["text"], chunking_mode)):
+                        item = {"id": str(uuid.uuid4()), "text": text, "source": source, "content_hash": content_hash(text)}
+                        item["metadata"] = {**page["metadata"], "chunk_index": index, "content_hash": item["content_hash"]}
+                        if item["content_hash"] in previous_embeddings.get(source, {}):
+                            item["embedding"] = previous_embeddings[source][item["content_hash"]]
+                        chunks.append(item)
+                    return chunks
+
+                dimension = {}
+
+                def write_batch(batch, embeddings):
+                    dimension.setdefault("value", len(embeddings[0]))
+                    add_vectors(
+                        collection,
+                        user_db_path,
+                        ids=[item["id"] for item in batch],
+                        embeddings=embeddings,
+                        documents=[item["text"] for item in batch],
+                        metadatas=[item["metadata"] for item in batch]
                     )
-                    
-                    # Log crawler output for debugging
-                    if result.returncode != 0:
-                        print(f"Warning: Crawler exited with non-zero code: {result.returncode}")
-                    
-                    if result.stdout:
-                        print(f"Crawler stdout: {result.stdout[:200]}...")
-                    if result.stderr:
-                        print(f"Crawler stderr: {result.stderr}")
-                    
-                    # Use the absolute path to the crawled content file
-                    crawled_file = os.path.join(project_root, "crawled_content.md")
-                    
-                    if os.path.exists(crawled_file):
-                        with open(crawled_file, "r", encoding="utf-8") as f:
-                            text = f.read().strip()
-                            if text and not text.startswith("# Failed to crawl") and not text.startswith("# Error crawling"):
-                                all_chunks.append(text)
-                                print(f"✅ Successfully added content from {url} ({len(text)} characters)")
-                            else:
-                                print(f"⚠️ Failed to extract valid content from {url}")
-                    else:
-                        print(f"❌ Error: Crawled content file not found at: {crawled_file}")
-                except Exception as e:
-                    print(f"❌ Error crawling {url}: {str(e)}")
 
-        
-        if files:
-            for file in files:
                 try:
-                    suffix = file.filename.split(".")[-1]
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{suffix}") as tmp_file:
-                        tmp_file.write(await file.read())
-                        tmp_path = tmp_file.name
-
-                    loader = PyPDFLoader(tmp_path) if suffix == "pdf" else TextLoader(tmp_path)
-                    docs = loader.load()
-                    for doc in docs:
-                        if doc.page_content.strip():
-                            all_chunks.append(doc.page_content.strip())
-                    
-                    os.unlink(tmp_path)  
+                    result = await run_ingestion(
+                        sources,
+                        load=load,
+                        chunk=chunk_page,
+                        embed=embedding_function.embed_documents,
+                        write=write_batch
+                    )
                 except Exception as e:
-                    print(f"Error processing file {file.filename}: {str(e)}")
+                    if "API_KEY_INVALID" in str(e):
+                        raise HTTPException(status_code=400, detail="Invalid Gemini API key")
+                    else:
+                        raise HTTPException(status_code=500, detail=f"Embedding error: {str(e)}")
 
-        embeddings, ids, valid_chunks = [], [], []
-        try:
-            for chunk in all_chunks:
-                emb = embedding_function.embed_query(chunk)
-                embeddings.append(emb)
-                ids.append(str(uuid.uuid4()))
-                valid_chunks.append(chunk)
-        except Exception as e:
-            if "API_KEY_INVALID" in str(e):
-                raise HTTPException(status_code=400, detail="Invalid Gemini API key")
-            else:
-                raise HTTPException(status_code=500, detail=f"Embedding error: {str(e)}")
+                for stage in result["stages"]:
+                    print(f"Stage {stage['stage']}: {stage['items_out']} items, {stage['items_per_second']} items/s")
+                reuse_ratio = round(result["reused"] / result["written"], 3) if result["written"] else 0.0
+                print(f"Reused {result['reused']}/{result['written']} embeddings from the previous ingest ({reuse_ratio:.1%})")
 
-        if valid_chunks:
-            collection.add(documents=valid_chunks, embeddings=embeddings, ids=ids)
-            
-            return JSONResponse({
-                "status": f"✅ Embedded {len(valid_chunks)} chunks for user {user_id}",
-                "chunks_added": len(valid_chunks),
-                "database_path": user_db_path,
-                "success": True
-            })
-        else:
-            if all_chunks:
-                message = "Failed to create embeddings for the content"
-                print(f"⚠️ {message}")
-                return JSONResponse({
-                    "status": f"⚠️ {message}",
-                    "chunks_added": 0,
-                    "success": False,
-                    "error": "No embeddings created despite having content"
-                }, status_code=422)
-            else:
-                message = "No valid content found to embed"
-                print(f"⚠️ {message}")
-                return JSONResponse({
-                    "status": f"⚠️ {message}",
-                    "chunks_added": 0,
-                    "success": False,
-                    "error": "No content extracted from URLs or files"
-                }, status_code=422)
+                if result["written"]:
+                    # The manifest makes this collection the one /query resolves to
+                    record_ingest(user_db_path, collection_name, result["written"], new_metadata,
+                                  dimension=dimension.get("value"), sources=len(sources))
+
+                    # Crawled URLs are kept fresh in place by the refresh scheduler
+                    for url, page_hash in crawled_hashes.items():
+                        register_source(user_db_path, url, collection_name, provider_name, chunking_mode,
+                                        page_hash, refresh_interval_hours)
+
+                    return JSONResponse({
+                        "status": f"✅ Embedded {result['written']} chunks for user {user_id}",
+                        "chunks_added": result["written"],
+                        "chunks_reused": result["reused"],
+                        "chunk_reuse_ratio": reuse_ratio,
+                        "chunking": chunking_mode,
+                        "database_path": user_db_path,
+                        "pipeline": result,
+                        "success": True
+                    })
+                else:
+                    if result["chunks"]:
+                        message = "Failed to create embeddings for the content"
+                        print(f"⚠️ {message}")
+                        return JSONResponse({
+                            "status": f"⚠️ {message}",
+                            "chunks_added": 0,
+                            "success": False,
+                            "error": "No embeddings created despite having content"
+                        }, status_code=422)
+                    else:
+                        message = "No valid content found to embed"
+                        print(f"⚠️ {message}")
+                        return JSONResponse({
+                            "status": f"⚠️ {message}",
+                            "chunks_added": 0,
+                            "success": False,
+                            "error": "No content extracted from URLs or files"
+                        }, status_code=422)
     
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+def _resolve_active_collection(chroma_client, user_db_path: str, user_id: str) -> str:
+    """The manifest names the active collection, so no listing or sorting per query"""
+    collection_name = active_collection(user_db_path)
+    if load_manifest(user_db_path) is None:
+        # Databases from before the manifest: scan once and remember the result
+        collection_name = rebuild_manifest(
+            user_db_path, chroma_client.list_collections(), f"{user_id}_collection_"
+        )["active_collection"]
+    if not collection_name:
+        raise HTTPException(status_code=404, detail="No documents found. Please upload documents first.")
+    return collection_name
+
+def _select_collections(user_db_path: str, active: str, collections: str) -> list[str]:
+    """Collection names to search: the active one, "all" of the user's, or a comma-separated subset"""
+    if not collections:
+        return [active]
+    known = list((load_manifest(user_db_path) or {}).get("collections", {}))
+    if collections.strip().lower() == "all":
+        return known
+    names = [name.strip() for name in collections.split(",") if name.strip()]
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown collection(s): {', '.join(unknown)}")
+    return names
+
+def _prepare_query(user_id: str, question: str, gemini_api_key: str, settings: dict, use_cache: bool,
+                   collections: str = None, deadline: Deadline = None) -> dict:
+    """
+    Retrieval shared by /query and /query/stream.
+
+    Returns {"cached": response} when the answer cache can serve the question, otherwise
+    the hits and context plus what is needed to cache the answer once generated. With a
+    deadline, each stage is timed and retrieval degrades rather than eat into the time
+    generation needs: a late question embedding falls back to BM25 alone, and when time
+    is short fusion, the extra MMR candidates and MMR itself are skipped and the
+    context is halved.
+    """
+    deadline = deadline or Deadline()
+    user_db_path = f"{DB_PATH}/{user_id}"
+    if not os.path.exists(user_db_path):
+        raise HTTPException(status_code=404, detail="No documents found. Please upload documents first.")
+
+    # Cached client/model handles: repeat queries skip opening SQLite/HNSW and building clients
+    with ExitStack() as leases:
+        with deadline.stage("open"):
+            chroma_client = leases.enter_context(open_chroma_client(user_db_path))
+        try:
+            collection_name = _resolve_active_collection(chroma_client, user_db_path, user_id)
+            names = _select_collections(user_db_path, collection_name, collections)
+
+            # Cached answers are only valid for these versions of the collections and these settings
+            use_cache = use_cache and ANSWER_CACHE_ENABLED
+            cache_scope = (user_db_path, ",".join(names),
+                           tuple(collection_version(user_db_path, name) for name in names),
+                           repr(sorted(settings.items())))
+            if use_cache and (cached := ANSWER_CACHE.lookup_exact(cache_scope, question)):
+                return {"cached": cached}
+
+            targets = [chroma_client.get_collection(name) for name in names]
+            print(f"Using collection(s): {', '.join(names)}")
+
+            # Collections created before providers were recorded were embedded with Gemini
+            providers = [(target.metadata or {}).get("embedding_provider", "gemini") for target in targets]
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Error finding collection: {e}")
+            raise HTTPException(status_code=500, detail=f"Error accessing database: {str(e)}")
+
+        # One question embedding per provider, however many collections share it
+        query_embeddings = {}
+        with deadline.stage("embed"):
+            try:
+                for provider_name in providers:
+                    if provider_name not in query_embeddings:
+                        query_embeddings[provider_name] = deadline.call(
+                            get_embeddings(provider_name, gemini_api_key).embed_query, question,
+                            reserve_ms=DEADLINE_GENERATION_MS + DEADLINE_RETRIEVAL_MS
+                        )
+            except DeadlineExceeded as e:
+                print(f"Deadline: {e}; falling back to lexical search")
+                deadline.degrade("lexical_only")
+                query_embeddings = {}
+        query_embedding = query_embeddings.get(providers[0])
+        # Paraphrases of a question answered before skip retrieval and the LLM call
+        if use_cache and query_embedding is not None and (
+                cached := ANSWER_CACHE.lookup_similar(cache_scope, query_embedding)):
+            return {"cached": cached}
+
+        options = _search_options(settings)
+        k = DEFAULT_K * CONTEXT_CANDIDATE_FACTOR
+        if "lexical_only" in deadline.degraded:
+            targets = [target for target in targets if uses_lexical_index(target.metadata)]
+            options.update(vector_weight=0.0, lexical_weight=options["lexical_weight"] or 1.0)
+        elif deadline.short_of(DEADLINE_GENERATION_MS + DEADLINE_RETRIEVAL_MS):
+            k = DEFAULT_K
+            deadline.degrade("reduced_k")
+            if options["vector_weight"] and options["lexical_weight"]:
+                options["lexical_weight"] = 0.0
+                deadline.degrade("vector_only")
+
+        # Vector and BM25 rankings fused with RRF; plain vector search for collections without a lexical index
+        collection_stats = None
+        with deadline.stage("search"):
+            if not targets:
+                hits = []
+            elif not collections:
+                hits = hybrid_search(targets[0], user_db_path, query_embedding, question, k=k, **options)
+            else:
+                hits, collection_stats = fan_out_search(
+                    [(target, query_embeddings.get(provider)) for target, provider in zip(targets, providers)],
+                    user_db_path, question, k=k, **options
+                )
+    # Deduplicated, MMR-ordered and trimmed passages that fit the token budget
+    budget, mmr_lambda = settings["context_tokens"], MMR_LAMBDA
+    if deadline.short_of(DEADLINE_GENERATION_MS + DEADLINE_RETRIEVAL_MS):
+        budget, mmr_lambda = max(budget // 2, 100), 1.0
+        deadline.degrade("short_context")
+    with deadline.stage("context"):
+        built = build_context(question, hits, budget=budget, mmr_lambda=mmr_lambda)
+    return {
+        "cached": None,
+        "hits": built["hits"],
+        "context": built["context"] or "No relevant context found.",
+        "context_tokens": built["tokens"],
+        "collections": collection_stats,
+        "pruned": _pruned(hits),
+        # Degraded answers are worse than what a later request could get, so they are not cached
+        "use_cache": use_cache and query_embedding is not None and not deadline.degraded,
+        "cache_scope": cache_scope,
+        "query_embedding": query_embedding,
+    }
+
+def _query_settings(source, domain, filename, ingested_after, ingested_before, vector_weight, lexical_weight,
+                    context_tokens, search_ef, doc_fan_out=None) -> dict:
+    """Validated retrieval settings from the /query form fields"""
+    vector_weight = HYBRID_VECTOR_WEIGHT if vector_weight is None else vector_weight
+    lexical_weight = HYBRID_LEXICAL_WEIGHT if lexical_weight is None else lexical_weight
+    if vector_weight < 0 or lexical_weight < 0 or not (vector_weight or lexical_weight):
+        raise HTTPException(status_code=400, detail="vector_weight and lexical_weight must be >= 0 and not both 0")
+    context_tokens = CONTEXT_TOKEN_BUDGET if context_tokens is None else context_tokens
+    if context_tokens < 100:
+        raise HTTPException(status_code=400, detail="context_tokens must be at least 100")
+    if search_ef is not None and not 1 <= search_ef <= 4096:
+        raise HTTPException(status_code=400, detail="search_ef must be between 1 and 4096")
+    if doc_fan_out is not None and doc_fan_out < 0:
+        raise HTTPException(status_code=400, detail="doc_fan_out must be >= 0 (0 searches every chunk)")
+    try:
+        where = build_where(source, domain, filename, ingested_after, ingested_before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {str(e)}")
+    return {"where": where, "vector_weight": vector_weight, "lexical_weight": lexical_weight,
+            "context_tokens": context_tokens, "search_ef": search_ef, "doc_fan_out": doc_fan_out}
+
+def _search_options(settings: dict) -> dict:
+    """hybrid_search keyword arguments from the query settings"""
+    return {key: settings[key] for key in ("where", "vector_weight", "lexical_weight", "search_ef", "doc_fan_out")}
+
+def _pruned(hits: list[dict]) -> list[dict]:
+    """Collections whose search was narrowed to their closest documents (doc_fan_out), and by how much"""
+    return list({hit["pruned"]["collection"]: hit["pruned"] for hit in hits if hit.get("pruned")}.values())
+
+def _query_response(prepared: dict, answer: str) -> dict:
+    context = prepared["context"]
+    response = {
+        "answer": answer,
+        "context_used": context[:500] + "..." if len(context) > 500 else context,
+        "sources_count": len(prepared["hits"]),
+        "context_tokens": prepared["context_tokens"]
+    }
+    if prepared["collections"]:
+        response["collections"] = prepared["collections"]
+    if prepared["pruned"]:
+        response["pruned"] = prepared["pruned"]
+    if prepared["use_cache"]:
+        ANSWER_CACHE.store(prepared["cache_scope"], prepared["question"], prepared["query_embedding"], response)
+    return response
+
 @app.post("/query")
 async def query_docs(
     request: Request,
     question: str = Form(...),
     gemini_api_key: str = Form(...),
+    source: str = Form(None),
+    domain: str = Form(None),
+    filename: str = Form(None),
+    ingested_after: str = Form(None),
+    ingested_before: str = Form(None),
+    vector_weight: float = Form(None),
+    lexical_weight: float = Form(None),
+    context_tokens: int = Form(None),
+    search_ef: int = Form(None),
+    doc_fan_out: int = Form(None),
+    collections: str = Form(None),
+    use_cache: bool = Form(True),
+    deadline_ms: int = Form(None),
     user_id: str = Depends(get_current_user_id)
 ):
-    try:
+    """
+    Answer a question from the user's documents.
 
-        embedding_function = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=gemini_api_key
+    With deadline_ms the pipeline degrades instead of running late: see _prepare_query
+    for retrieval, then a faster model when little time is left, and the best passage
+    instead of a generated answer if the model still overruns. `degraded` says whether
+    any of that happened and `timings` which steps were taken and where the time went.
+    """
+    if deadline_ms is not None and deadline_ms <= 0:
+        raise HTTPException(status_code=400, detail="deadline_ms must be positive")
+    deadline = Deadline(deadline_ms)
+    try:
+        remember_api_key(user_id, gemini_api_key)
+        settings = _query_settings(
+            source, domain, filename, ingested_after, ingested_before, vector_weight, lexical_weight, context_tokens,
+            search_ef, doc_fan_out
         )
+        # Pleasantries are answered locally before anything is embedded or retrieved
+        reply, intent = small_talk_reply(question)
+        if reply:
+            return JSONResponse(_small_talk_response(reply, intent))
+        # Embedding, store open and search block, so they run off the event loop
+        prepared = await asyncio.to_thread(
+            _prepare_query, user_id, question, gemini_api_key, settings, use_cache, collections, deadline
+        )
+        if prepared["cached"]:
+            return JSONResponse({**prepared["cached"], "intent": intent, "degraded": False,
+                                 "timings": deadline.report()})
+        prepared["question"] = question
 
+        if deadline.short_of(DEADLINE_GENERATION_MS):
+            llm = get_llm(gemini_api_key, DEADLINE_FAST_MODEL)
+            deadline.degrade("fast_model")
+        else:
+            llm = get_llm(gemini_api_key)
+        with deadline.stage("generate"):
+            try:
+                answer = await asyncio.to_thread(
+                    deadline.call, llm.invoke, RAG_PROMPT.format(context=prepared["context"], question=question)
+                )
+            except DeadlineExceeded as e:
+                print(f"Deadline: {e}; answering with the best passage")
+                deadline.degrade("extractive_answer")
+                answer = _extractive_answer(prepared["hits"])
+        prepared["use_cache"] = prepared["use_cache"] and not deadline.degraded
+
+        return JSONResponse({**_query_response(prepared, answer), "cached": False, "intent": intent,
+                             "degraded": bool(deadline.degraded), "timings": deadline.report()})
     
-        user_db_path = f"{DB_PATH}/{user_id}"
-        if not os.path.exists(user_db_path):
-            raise HTTPException(status_code=404, detail="No documents found. Please upload documents first.")
-            
-        # Find the most recent collection for this user
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Query processing error: {str(e)}")
+
+def _extractive_answer(hits: list[dict], max_sentences: int = 3) -> str:
+    """Fallback when generation misses the deadline: the opening of the best passage"""
+    if not hits:
+        return "I couldn't find an answer in time. Please try again."
+    passage = " ".join(split_sentences(hits[0]["document"])[:max_sentences])
+    return f"I ran out of time to write a full answer. The most relevant passage says: {passage}"
+
+def _small_talk_response(answer: str, intent: dict) -> dict:
+    """Canned reply for greetings, thanks and farewells: no embedding, search or LLM call"""
+    return {"answer": answer, "context_used": "", "sources_count": 0, "context_tokens": 0, "cached": False,
+            "intent": intent}
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/query/stream")
+async def query_stream(
+    request: Request,
+    question: str = Form(...),
+    gemini_api_key: str = Form(...),
+    source: str = Form(None),
+    domain: str = Form(None),
+    filename: str = Form(None),
+    ingested_after: str = Form(None),
+    ingested_before: str = Form(None),
+    vector_weight: float = Form(None),
+    lexical_weight: float = Form(None),
+    context_tokens: int = Form(None),
+    search_ef: int = Form(None),
+    doc_fan_out: int = Form(None),
+    collections: str = Form(None),
+    use_cache: bool = Form(True),
+    user_id: str = Depends(get_current_user_id)
+):
+    """
+    /query as Server-Sent Events: a `metadata` event with the retrieved sources, `token`
+    events while the answer is generated, then a `done` summary (or an `error` event).
+    """
+    started = time.perf_counter()
+    try:
+        remember_api_key(user_id, gemini_api_key)
+        settings = _query_settings(
+            source, domain, filename, ingested_after, ingested_before, vector_weight, lexical_weight, context_tokens,
+            search_ef, doc_fan_out
+        )
+        reply, intent = small_talk_reply(question)
+        # Retrieval runs before the response starts, so its failures are still plain HTTP errors
+        prepared = None if reply else await asyncio.to_thread(
+            _prepare_query, user_id, question, gemini_api_key, settings, use_cache, collections
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Query processing error: {str(e)}")
+
+    async def events():
+        if reply:
+            yield _sse("metadata", {"sources": [], "sources_count": 0, "cached": False, "intent": intent})
+            yield _sse("token", {"text": reply})
+            yield _sse("done", {"cached": False, "tokens": 1, "intent": intent,
+                                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+            return
+
+        prepared["question"] = question
+        cached = prepared["cached"]
+        if cached:
+            yield _sse("metadata", {"sources": [], "sources_count": cached["sources_count"], "cached": True,
+                                    "cache_match": cached["cache_match"], "intent": intent})
+            yield _sse("token", {"text": cached["answer"]})
+            yield _sse("done", {"cached": True, "tokens": 1,
+                                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+            return
+
+        sources = [{"id": hit["id"], "source": hit["metadata"].get("source"), "page": hit["metadata"].get("page"),
+                    "collection": hit.get("collection"), "score": round(hit["score"], 4)} for hit in prepared["hits"]]
+        yield _sse("metadata", {"sources": sources, "sources_count": len(sources), "cached": False,
+                                "context_tokens": prepared["context_tokens"], "collections": prepared["collections"],
+                                "pruned": prepared["pruned"],
+                                "intent": intent, "retrieval_ms": round((time.perf_counter() - started) * 1000, 1)})
+
+        llm = get_llm(gemini_api_key)
+        tokens = iter(llm.stream(RAG_PROMPT.format(context=prepared["context"], question=question)))
+        parts = []
+        first_token_ms = None
+        finished = object()
         try:
-            chroma_client = PersistentClient(path=user_db_path)
-            collections = chroma_client.list_collections()
-            
-            # Filter collections that belong to this user and sort by timestamp
-            user_collections = [c for c in collections if c.name.startswith(f"{user_id}_collection_")]
-            
-            if not user_collections:
-                raise HTTPException(status_code=404, detail="No documents found. Please upload documents first.")
-                
-            # Get the most recent collection (assuming the timestamp format sorts correctly)
-            latest_collection = sorted(user_collections, key=lambda c: c.name, reverse=True)[0]
-            collection_name = latest_collection.name
-            
-            print(f"Using most recent collection: {collection_name}")
-            
-            # Using the GitHub repo style ChromaDB initialization for the query
-            db = Chroma(
-                client=PersistentClient(path=user_db_path),
-                collection_name=collection_name,
-                embedding_function=embedding_function
-            )
+            while True:
+                # Stop pulling from the model as soon as the client goes away
+                if await request.is_disconnected():
+                    print(f"Client disconnected after {len(parts)} tokens; stopping generation")
+                    return
+                token = await asyncio.to_thread(next, tokens, finished)
+                if token is finished:
+                    break
+                if first_token_ms is None:
+                    first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                parts.append(token)
+                yield _sse("token", {"text": token})
         except Exception as e:
-            print(f"Error finding collection: {e}")
-            raise HTTPException(status_code=500, detail=f"Error accessing database: {str(e)}")
+            yield _sse("error", {"detail": f"Generation error: {str(e)}"})
+            return
+        finally:
+            close = getattr(tokens, "close", None)
+            if close:
+                with suppress(ValueError):
+                    close()
+
+        _query_response(prepared, "".join(parts))
+        yield _sse("done", {"cached": False, "tokens": len(parts), "sources_count": len(sources),
+                            "time_to_first_token_ms": first_token_ms,
+                            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
 
-        retriever = db.as_retriever()
-        docs = retriever.invoke(question)
-        context = "\n\n".join([doc.page_content for doc in docs]) or "No relevant context found."
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-        llm = GoogleGenerativeAI(
-            model="gemini-1.5-flash",
-            google_api_key=gemini_api_key,
-            temperature=0.3
+@app.post("/query/batch")
+async def query_batch(
+    questions: list[str] = Form(...),
+    gemini_api_key: str = Form(...),
+    source: str = Form(None),
+    domain: str = Form(None),
+    filename: str = Form(None),
+    ingested_after: str = Form(None),
+    ingested_before: str = Form(None),
+    vector_weight: float = Form(None),
+    lexical_weight: float = Form(None),
+    context_tokens: int = Form(None),
+    search_ef: int = Form(None),
+    doc_fan_out: int = Form(None),
+    use_cache: bool = Form(True),
+    user_id: str = Depends(get_current_user_id)
+):
+    """
+    Answer many questions against the active collection in one call; results keep question order.
+
+    Questions are embedded in one batched provider call, searched concurrently, and answered
+    with at most BATCH_LLM_CONCURRENCY generations in flight. A failed generation is reported
+    on its own result instead of failing the batch.
+    """
+    started = time.perf_counter()
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUESTIONS} questions per batch")
+    try:
+        remember_api_key(user_id, gemini_api_key)
+        settings = _query_settings(
+            source, domain, filename, ingested_after, ingested_before, vector_weight, lexical_weight, context_tokens,
+            search_ef, doc_fan_out
         )
+        user_db_path = f"{DB_PATH}/{user_id}"
+        if not os.path.exists(user_db_path):
+            raise HTTPException(status_code=404, detail="No documents found. Please upload documents first.")
+
+        timings = {}
+        results = [None] * len(questions)
+        with open_chroma_client(user_db_path) as chroma_client:
+            collection_name = _resolve_active_collection(chroma_client, user_db_path, user_id)
+            use_cache = use_cache and ANSWER_CACHE_ENABLED
+            cache_scope = (user_db_path, collection_name, (collection_version(user_db_path, collection_name),),
+                           repr(sorted(settings.items())))
+            pending = []
+            intents = {}
+            for i, question in enumerate(questions):
+                reply, intents[i] = small_talk_reply(question)
+                if reply:
+                    results[i] = {"question": question, **_small_talk_response(reply, intents[i])}
+                elif use_cache and (cached := ANSWER_CACHE.lookup_exact(cache_scope, question)):
+                    results[i] = {"question": question, **cached, "intent": intents[i]}
+                else:
+                    pending.append(i)
 
-        rag_prompt = PromptTemplate.from_template("""
-        You are CrawlMind AI assistant for question-answering tasks.
-        Use the retrieved context below to answer the question.
-        If you don't know the answer based on the context, say you don't know.
-        If the user says bye or goodbye, respond appropriately and end the conversation.
+            if pending:
+                collection = chroma_client.get_collection(collection_name)
+                provider_name = (collection.metadata or {}).get("embedding_provider", "gemini")
+                stage_started = time.perf_counter()
+                query_embeddings = await asyncio.to_thread(
+                    embed_queries, get_embeddings(provider_name, gemini_api_key), [questions[i] for i in pending]
+                )
+                timings["embed_ms"] = round((time.perf_counter() - stage_started) * 1000, 1)
+                embedding_by_index = dict(zip(pending, query_embeddings))
 
-        Context:
-        {context}
+                if use_cache:
+                    still_pending = []
+                    for i in pending:
+                        if cached := ANSWER_CACHE.lookup_similar(cache_scope, embedding_by_index[i]):
+                            results[i] = {"question": questions[i], **cached, "intent": intents[i]}
+                        else:
+                            still_pending.append(i)
+                    pending = still_pending
 
-        Question:
-        {question}
+                stage_started = time.perf_counter()
+                hits_by_question = await asyncio.to_thread(
+                    lambda: batch_search(collection, user_db_path, [embedding_by_index[i] for i in pending],
+                                         [questions[i] for i in pending], DEFAULT_K * CONTEXT_CANDIDATE_FACTOR,
+                                         **_search_options(settings))
+                )
+                timings["search_ms"] = round((time.perf_counter() - stage_started) * 1000, 1)
 
-        Answer in 2-3 clear sentences.
-        """)
+        llm = get_llm(gemini_api_key)
+        semaphore = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+        async def answer(i, hits):
+            async with semaphore:
+                # Tokenizing and packing context is CPU work; off the event loop, a few questions at a time
+                built = await asyncio.to_thread(build_context, questions[i], hits, budget=settings["context_tokens"])
+                prepared = {
+                    "question": questions[i],
+                    "hits": built["hits"],
+                    "context": built["context"] or "No relevant context found.",
+                    "context_tokens": built["tokens"],
+                    "collections": None,
+                    "pruned": _pruned(hits),
+                    "use_cache": use_cache,
+                    "cache_scope": cache_scope,
+                    "query_embedding": embedding_by_index[i],
+                }
+                try:
+                    text = await asyncio.to_thread(
+                        llm.invoke, RAG_PROMPT.format(context=prepared["context"], question=questions[i])
+                    )
+                except Exception as e:
+                    results[i] = {"question": questions[i], "error": f"Generation error: {str(e)}", "cached": False}
+                    return
+            results[i] = {"question": questions[i], **_query_response(prepared, text), "cached": False,
+                          "intent": intents[i]}
 
-        answer = llm.invoke(rag_prompt.format(context=context, question=question))
+        if pending:
+            stage_started = time.perf_counter()
+            await asyncio.gather(*(answer(i, hits) for i, hits in zip(pending, hits_by_question)))
+            timings["generate_ms"] = round((time.perf_counter() - stage_started) * 1000, 1)
 
         return JSONResponse({
-            "answer": answer,
-            "context_used": context[:500] + "..." if len(context) > 500 else context,
-            "sources_count": len(docs)
+            "results": results,
+            "count": len(results),
+            "cached": sum(1 for result in results if result.get("cached")),
+            "errors": sum(1 for result in results if "error" in result),
+            "small_talk": sum(1 for intent in intents.values() if intent["fast_path"]),
+            "timings": {**timings, "total_ms": round((time.perf_counter() - started) * 1000, 1)}
         })
-    
+
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Query processing error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Batch query error: {str(e)}")
+
+@app.websocket("/chat/ws")
+async def chat_socket(websocket: WebSocket):
+    """
+    Multi-turn chat over one WebSocket.
+
+    The first message authenticates and configures the session: {"token", "gemini_api_key"}
+    plus any of the /query filters and settings, answered with {"type": "ready"}. Every
+    {"question": ...} after that gets a `metadata` message, `token` messages while the
+    answer is generated and a `done` summary, or an `error` after which the session goes
+    on. Auth and the model clients are resolved once per session, and follow-ups reuse or
+    top up the previous turn's chunks when they ask about the same thing (see ChatSession).
+    The database is leased per turn, so idle sessions keep no store open. Deleting the knowledge base ends the session at its
+    next turn.
+    """
+    await websocket.accept()
+    try:
+        auth = await asyncio.wait_for(websocket.receive_json(), CHAT_AUTH_TIMEOUT_SECONDS)
+        user = await asyncio.to_thread(verify_clerk_token, auth.get("token") or "")
+        user_id = user.get("user_id") or user.get("sub") or user.get("id")
+        if not user_id:
+            raise HTTPException(status_code=401, detail="Invalid token: missing user ID")
+        gemini_api_key = auth.get("gemini_api_key")
+        settings = _query_settings(
+            auth.get("source"), auth.get("domain"), auth.get("filename"), auth.get("ingested_after"),
+            auth.get("ingested_before"), auth.get("vector_weight"), auth.get("lexical_weight"),
+            auth.get("context_tokens"), auth.get("search_ef"), auth.get("doc_fan_out")
+        )
+    except WebSocketDisconnect:
+        return
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=str(e.detail)[:120])
+        return
+    except Exception as e:
+        await websocket.close(code=1008, reason=f"Authentication failed: {str(e)}"[:120])
+        return
+
+    remember_api_key(user_id, gemini_api_key)
+    user_db_path = f"{DB_PATH}/{user_id}"
+
+    def collection_embedder(collection_name: str):
+        with open_chroma_client(user_db_path) as chroma_client:
+            metadata = chroma_client.get_collection(collection_name).metadata or {}
+        return get_embeddings(metadata.get("embedding_provider", "gemini"), gemini_api_key)
+
+    def open_session():
+        deletions_seen = {job["id"] for job in DELETIONS.status(user_db_path)}
+        if not os.path.exists(user_db_path):
+            raise HTTPException(status_code=404, detail="No documents found. Please upload documents first.")
+        with open_chroma_client(user_db_path) as chroma_client:
+            collection_name = _resolve_active_collection(chroma_client, user_db_path, user_id)
+        return collection_name, collection_embedder(collection_name), get_llm(gemini_api_key), deletions_seen
+
+    def search_turn(collection_name: str, embedding, retrieval_text: str, k: int) -> list[dict]:
+        # Leased for this turn only; the cache keeps the client open between turns unless it needs the room
+        with open_chroma_client(user_db_path) as chroma_client:
+            collection = chroma_client.get_collection(collection_name)
+            return hybrid_search(collection, user_db_path, embedding, retrieval_text, k=k, **_search_options(settings))
+
+    try:
+        collection_name, embedder, llm, deletions_seen = await asyncio.to_thread(open_session)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else f"Error accessing database: {str(e)}"
+        await websocket.send_json({"type": "error", "detail": detail})
+        await websocket.close(code=1008 if isinstance(e, HTTPException) else 1011)
+        return
+
+    session = ChatSession()
+    await websocket.send_json({"type": "ready", "user_id": user_id, "collection": collection_name})
+
+    def knowledge_base_deleted() -> bool:
+        # Also after a new upload: the conversation so far is about documents that are gone
+        return (active_collection(user_db_path) is None
+                or any(job["id"] not in deletions_seen for job in DELETIONS.status(user_db_path)))
+
+    async def stream_answer(prompt: str, started: float) -> tuple[str, int, float]:
+        tokens = iter(llm.stream(prompt))
+        parts, first_token_ms = [], None
+        finished = object()
+        try:
+            while (token := await asyncio.to_thread(next, tokens, finished)) is not finished:
+                if first_token_ms is None:
+                    first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                parts.append(token)
+                await websocket.send_json({"type": "token", "text": token})
+        finally:
+            close = getattr(tokens, "close", None)
+            if close:
+                with suppress(ValueError):
+                    close()
+        return "".join(parts), len(parts), first_token_ms
+
+    async def answer_turn(question: str):
+        nonlocal collection_name, embedder
+        started = time.perf_counter()
+        reply, intent = small_talk_reply(question)
+        if reply:
+            await websocket.send_json({"type": "metadata", "sources": [], "sources_count": 0,
+                                       "retrieval": "skipped", "intent": intent})
+            await websocket.send_json({"type": "token", "text": reply})
+            session.record(question, reply, "skipped")
+            await websocket.send_json({"type": "done", "tokens": 1, "session": dict(session.stats),
+                                       "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+            return
+
+        # A new ingest moves the session to the new active collection; old chunks no longer apply
+        if (latest := active_collection(user_db_path)) and latest != collection_name:
+            collection_name, embedder = latest, await asyncio.to_thread(collection_embedder, latest)
+            session.hits, session.last_embedding = [], None
+
+        retrieval_text = session.retrieval_text(question)
+        embedding = await asyncio.to_thread(embedder.embed_query, retrieval_text)
+        action, similarity = session.plan(embedding)
+        if action == "reuse":
+            hits = session.hits
+        else:
+            k = DEFAULT_K if action == "extend" else DEFAULT_K * CONTEXT_CANDIDATE_FACTOR
+            found = await asyncio.to_thread(search_turn, collection_name, embedding, retrieval_text, k)
+            hits = session.merge(found) if action == "extend" else found
+        built = await asyncio.to_thread(build_context, retrieval_text, hits, budget=settings["context_tokens"])
+
+        sources = [{"id": hit["id"], "source": hit["metadata"].get("source"), "page": hit["metadata"].get("page"),
+                    "score": round(hit["score"], 4)} for hit in built["hits"]]
+        await websocket.send_json({
+            "type": "metadata", "sources": sources, "sources_count": len(sources), "retrieval": action,
+            "similarity": round(similarity, 4), "retrieval_query": retrieval_text,
+            "context_tokens": built["tokens"], "intent": intent,
+            "retrieval_ms": round((time.perf_counter() - started) * 1000, 1)
+        })
+        prompt = CHAT_PROMPT.format(context=built["context"] or "No relevant context found.",
+                                    history=session.history(), question=question)
+        try:
+            answer, token_count, first_token_ms = await stream_answer(prompt, started)
+        except WebSocketDisconnect:
+            raise
+        except Exception as e:
+            await websocket.send_json({"type": "error", "detail": f"Generation error: {str(e)}"})
+            return
+        session.record(question, answer, action, embedding, hits)
+        await websocket.send_json({"type": "done", "tokens": token_count, "sources_count": len(sources),
+                                   "time_to_first_token_ms": first_token_ms, "session": dict(session.stats),
+                                   "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+
+    while True:
+        try:
+            message = await websocket.receive_json()
+            question = (message.get("question") or "").strip() if isinstance(message, dict) else ""
+            if not question:
+                await websocket.send_json({"type": "error", "detail": "Expected {\"question\": ...}"})
+                continue
+            if await asyncio.to_thread(knowledge_base_deleted):
+                await websocket.send_json({"type": "error", "detail": "Your documents were deleted. "
+                                                                      "Upload documents and start a new chat."})
+                await websocket.close(code=1008)
+                return
+            await answer_turn(question)
+        except WebSocketDisconnect:
+            print(f"Chat session for {user_id} closed after {sum(session.stats.values())} turns: {dict(session.stats)}")
+            return
+        except ValueError:
+            await websocket.send_json({"type": "error", "detail": "Messages must be JSON"})
+        except Exception as e:
+            await websocket.send_json({"type": "error", "detail": f"Query processing error: {str(e)}"})
+
+@app.get("/sources")
+def list_sources(user_id: str = Depends(get_current_user_id)):
+    """Refresh status of every URL this user has ingested"""
+    sources = load_sources(f"{DB_PATH}/{user_id}")
+    return {"sources": list(sources.values()), "count": len(sources)}
+
+@app.delete("/sources")
+def delete_sources(
+    source: str = None,
+    domain: str = None,
+    filename: str = None,
+    user_id: str = Depends(get_current_user_id)
+):
+    """Delete a source's chunks from all of the user's collections, matched on chunk metadata"""
+    where = build_where(source, domain, filename)
+    if where is None:
+        raise HTTPException(status_code=400, detail="Provide source, domain or filename")
+    user_db_path = f"{DB_PATH}/{user_id}"
+    if not os.path.exists(user_db_path):
+        return {"deleted_chunks": 0, "collections": {}}
+
+    deleted = {}
+    with open_chroma_client(user_db_path) as chroma_client:
+        for collection in chroma_client.list_collections():
+            if collection.name.startswith(f"{user_id}_collection_"):
+                count = delete_where(collection, user_db_path, where)
+                if count:
+                    deleted[collection.name] = count
+                    adjust_documents(user_db_path, collection.name, -count)
+    removed_sources = forget_sources(user_db_path, source=source, domain=domain)
+    return {"deleted_chunks": sum(deleted.values()), "collections": deleted, "sources_removed": removed_sources}
+
+@app.post("/sources/refresh")
+async def refresh_sources(
+    url: str = Form(None),
+    gemini_api_key: str = Form(None),
+    user_id: str = Depends(get_current_user_id)
+):
+    """Recrawl now instead of waiting for the schedule (one URL, or all of the user's sources)"""
+    remember_api_key(user_id, gemini_api_key)
+    user_db_path = f"{DB_PATH}/{user_id}"
+    sources = load_sources(user_db_path)
+    if url:
+        if url not in sources:
+            raise HTTPException(status_code=404, detail=f"Source not found: {url}")
+        entries = [sources[url]]
+    else:
+        entries = list(sources.values())
+
+    results = []
+    for entry in entries:
+        results.append(await asyncio.to_thread(refresh_source, user_db_path, entry, gemini_api_key))
+    return {"sources": results, "count": len(results)}
 
 @app.get("/debug/jwks")
 def debug_jwks():
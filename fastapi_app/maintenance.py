@@ -0,0 +1,249 @@
+import asyncio
+import datetime
+import os
+import shutil
+import sqlite3
+
+from doc_store import DOC_STORE_FILE
+from manifest import adjust_documents, forget_collection, load_manifest, user_lock
+from quantization import compact_settings
+from refresh import load_sources, update_source
+from resources import chroma_path, open_chroma_client, segment_dirs
+from retrieval import add_vectors, chunk_vectors, drop_collection, fetch_documents
+
+# Retention deletes collections, so nothing runs on a schedule or expires until it is configured
+MAINTENANCE_ENABLED = os.getenv("MAINTENANCE_ENABLED", "false").lower() == "true"
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+# A collection expires once it is outside the newest RETENTION_KEEP_LAST and older than RETENTION_MAX_AGE_DAYS;
+# a limit left at 0 is not applied, and with both at 0 every collection is kept
+RETENTION_KEEP_LAST = int(os.getenv("RETENTION_KEEP_LAST", "0"))
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+# Expired collections with sources no kept collection has are merged into the active one instead of skipped
+RETENTION_MERGE = os.getenv("RETENTION_MERGE", "false").lower() == "true"
+# Collections missing from the manifest are left this long first, in case another worker is still ingesting into them
+ORPHAN_GRACE_HOURS = float(os.getenv("ORPHAN_GRACE_HOURS", "1"))
+
+MERGE_BATCH = 500
+
+
+def directory_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # Removed while walking
+    return total
+
+
+def _created_at(name: str, info: dict) -> datetime.datetime:
+    if info.get("created_at"):
+        return datetime.datetime.fromisoformat(info["created_at"])
+    # Collections from before the manifest recorded it: {user_id}_collection_{YYYYmmdd_HHMMSS}
+    try:
+        return datetime.datetime.strptime(name.rsplit("_collection_", 1)[1], "%Y%m%d_%H%M%S")
+    except (IndexError, ValueError):
+        return datetime.datetime.min
+
+
+def plan_retention(manifest: dict, keep_last: int = RETENTION_KEEP_LAST,
+                   max_age_days: float = RETENTION_MAX_AGE_DAYS, now: datetime.datetime = None) -> tuple[list, list]:
+    """(kept, expired) collection names, newest first; the active collection is always kept"""
+    now = now or datetime.datetime.now()
+    newest_first = sorted(manifest["collections"], reverse=True,
+                          key=lambda name: (_created_at(name, manifest["collections"][name]), name))
+    if not keep_last and not max_age_days:
+        return newest_first, []
+    cutoff = now - datetime.timedelta(days=max_age_days) if max_age_days else datetime.datetime.max
+    kept = [name for i, name in enumerate(newest_first)
+            if (keep_last and i < keep_last) or name == manifest["active_collection"]
+            or _created_at(name, manifest["collections"][name]) >= cutoff]
+    return kept, [name for name in newest_first if name not in kept]
+
+
+def _chunk_metadata(collection) -> dict:
+    """{chunk id: metadata} for every chunk in the collection"""
+    result = collection.get(include=["metadatas"])
+    return {chunk_id: metadata or {} for chunk_id, metadata in zip(result["ids"], result["metadatas"])}
+
+
+def _sources(collection) -> set:
+    return {metadata["source"] for metadata in _chunk_metadata(collection).values() if metadata.get("source")}
+
+
+def _held(target, ids: list[str]) -> set:
+    return set(target.get(ids=ids, include=[])["ids"]) if ids else set()
+
+
+def _merge_chunks(collection, target, user_db_path: str, metadatas: dict) -> tuple[int, int]:
+    """
+    Copy the chunks in `metadatas` that target lacks from collection into it, vectors and all.
+
+    Returns (how many of them target holds afterwards, how many were added). Both are
+    read back from target, so a chunk that failed to copy keeps its collection from
+    being dropped, and a rerun after an interrupted merge only copies what is missing.
+    """
+    ids = sorted(metadatas)
+    held = _held(target, ids)
+    missing = [chunk_id for chunk_id in ids if chunk_id not in held]
+    for start in range(0, len(missing), MERGE_BATCH):
+        found, vectors = chunk_vectors(collection, user_db_path, missing[start:start + MERGE_BATCH])
+        hits = fetch_documents(collection, user_db_path, [{"id": chunk_id, "document": None} for chunk_id in found])
+        add_vectors(target, user_db_path, ids=found, embeddings=[vector.tolist() for vector in vectors],
+                    documents=[hit["document"] for hit in hits], metadatas=[metadatas[chunk_id] for chunk_id in found])
+    holds = len(_held(target, ids))
+    return holds, holds - len(held)
+
+
+def _orphans(existing: set, manifest: dict, user_db_path: str) -> list[str]:
+    """Collections in the user's store that never reached the manifest: ingests that failed or found no content"""
+    prefix = f"{os.path.basename(os.path.normpath(user_db_path))}_collection_"
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=ORPHAN_GRACE_HOURS)
+    return sorted(name for name in existing if name.startswith(prefix) and name not in manifest["collections"]
+                  and _created_at(name, {}) < cutoff)
+
+
+def vacuum(path: str) -> bool:
+    """VACUUM one SQLite file; skipped (False) while another connection holds a write lock"""
+    try:
+        with sqlite3.connect(path, timeout=5) as conn:
+            conn.execute("VACUUM")
+        return True
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not vacuum {path}: {e}")
+        return False
+
+
+def remove_orphan_segments(store_path: str) -> list[str]:
+    """
+    Delete HNSW segment directories Chroma no longer knows about.
+
+    Chroma drops a deleted collection's segment rows but leaves its segment directory
+    (the bulk of the bytes) on disk. A directory is only created on the first write to a
+    segment whose row already exists, so one without a row is safe to remove.
+    """
+    chroma_file = os.path.join(store_path, "chroma.sqlite3")
+    if not os.path.exists(chroma_file):
+        return []
+    with sqlite3.connect(chroma_file, timeout=30) as conn:
+        live = {segment_id for (segment_id,) in conn.execute("SELECT id FROM segments")}
+    removed = [name for name in segment_dirs(store_path) if name not in live]
+    for name in removed:
+        shutil.rmtree(os.path.join(store_path, name), ignore_errors=True)
+    return removed
+
+
+def compact_user(user_db_path: str, keep_last: int = RETENTION_KEEP_LAST,
+                 max_age_days: float = RETENTION_MAX_AGE_DAYS, merge: bool = RETENTION_MERGE,
+                 dry_run: bool = False) -> dict:
+    """
+    Enforce the retention policy for one user and report what it freed.
+
+    Expired collections whose sources all live on in a kept collection are superseded
+    and deleted with their sidecars. Ones holding the only copy of some source have
+    those chunks merged into the active collection first (when it was embedded the same
+    way), and are only deleted once the active collection holds every one of them;
+    otherwise they are left alone, as are collections with chunks that carry no source.
+    Collections left behind by failed ingests, which the manifest never recorded, are
+    deleted too. SQLite files are vacuumed afterwards so the freed pages go back to the
+    filesystem.
+    """
+    if load_manifest(user_db_path) is None:
+        return {"kept": [], "deleted": [], "merged": {}, "skipped": {}, "reclaimed_bytes": 0}
+    if dry_run:
+        manifest = load_manifest(user_db_path)
+        kept, expired = plan_retention(manifest, keep_last, max_age_days)
+        with open_chroma_client(user_db_path) as chroma_client:
+            existing = {collection.name for collection in chroma_client.list_collections()}
+        return {"kept": kept, "deleted": [], "merged": {}, "skipped": {}, "reclaimed_bytes": 0,
+                "expired": expired, "orphaned": _orphans(existing, manifest, user_db_path)}
+
+    store_path = chroma_path(user_db_path)
+    measured = {user_db_path, store_path}
+    before = sum(directory_bytes(path) for path in measured)
+    with user_lock(user_db_path), open_chroma_client(user_db_path) as chroma_client:
+        # Planned under the lock, so an ingest that just finished has its collection in the manifest
+        manifest = load_manifest(user_db_path)
+        kept, expired = plan_retention(manifest, keep_last, max_age_days)
+        active = manifest["active_collection"]
+        report = {"kept": kept, "deleted": [], "merged": {}, "skipped": {}, "reclaimed_bytes": 0}
+        existing = {collection.name for collection in chroma_client.list_collections()}
+        report["orphaned"] = _orphans(existing, manifest, user_db_path)
+        for name in report["orphaned"]:
+            drop_collection(chroma_client, user_db_path, name)
+            report["deleted"].append(name)
+        kept_sources = set()
+        for name in kept:
+            if name in existing:
+                kept_sources |= _sources(chroma_client.get_collection(name))
+
+        for name in expired:
+            if name in existing:
+                collection = chroma_client.get_collection(name)
+                metadatas = _chunk_metadata(collection)
+                unsourced = sum(1 for metadata in metadatas.values() if not metadata.get("source"))
+                if unsourced:
+                    report["skipped"][name] = f"{unsourced} chunk(s) without a source, which nothing else can cover"
+                    continue
+                unique = {metadata["source"] for metadata in metadatas.values()} - kept_sources
+                if unique:
+                    target = chroma_client.get_collection(active) if active in existing else None
+                    same_embeddings = target is not None and (
+                        (collection.metadata or {}).get("embedding_provider", "gemini")
+                        == (target.metadata or {}).get("embedding_provider", "gemini")
+                        and compact_settings(collection.metadata) == compact_settings(target.metadata)
+                    )
+                    if not merge or not same_embeddings:
+                        report["skipped"][name] = (f"{len(unique)} source(s) found nowhere else"
+                                                   + ("" if merge else "; merging is disabled"))
+                        continue
+                    chunks = {chunk_id: metadata for chunk_id, metadata in metadatas.items()
+                              if metadata["source"] in unique}
+                    copied, added = _merge_chunks(collection, target, user_db_path, chunks)
+                    adjust_documents(user_db_path, active, added)
+                    report["merged"][name] = {"sources": len(unique), "chunks": copied}
+                    if copied < len(chunks):
+                        report["skipped"][name] = f"copied {copied} of {len(chunks)} chunk(s) into {active}"
+                        continue
+                    kept_sources |= unique
+            drop_collection(chroma_client, user_db_path, name)
+            forget_collection(user_db_path, name)
+            report["deleted"].append(name)
+
+        # Refresh entries follow their chunks into the active collection
+        for url, entry in load_sources(user_db_path).items():
+            if entry.get("collection") in report["deleted"]:
+                update_source(user_db_path, url, collection=active)
+
+    report["orphan_segments_removed"] = len(remove_orphan_segments(store_path))
+    if report["deleted"]:
+        files = {"chroma.sqlite3": os.path.join(store_path, "chroma.sqlite3"),
+                 DOC_STORE_FILE: os.path.join(user_db_path, DOC_STORE_FILE)}
+        report["vacuumed"] = [name for name, path in files.items() if os.path.exists(path) and vacuum(path)]
+    report["reclaimed_bytes"] = max(0, before - sum(directory_bytes(path) for path in measured))
+    return report
+
+
+async def run_maintenance_scheduler(db_path: str):
+    """Background loop: apply the retention policy to every user's database, one at a time"""
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL_HOURS * 3600)
+        if not os.path.isdir(db_path):
+            continue
+        reclaimed = 0
+        for user_id in os.listdir(db_path):
+            user_db_path = os.path.join(db_path, user_id)
+            # Reserved folders (the shared store, deletion trash) start with an underscore
+            if user_id.startswith("_") or not os.path.isdir(user_db_path):
+                continue
+            try:
+                report = await asyncio.to_thread(compact_user, user_db_path)
+            except Exception as e:
+                print(f"❌ Maintenance failed for {user_id}: {e}")
+                continue
+            if report["deleted"]:
+                print(f"🧹 {user_id}: deleted {len(report['deleted'])} collection(s), "
+                      f"merged {len(report['merged'])}, reclaimed {report['reclaimed_bytes']} bytes")
+            reclaimed += report["reclaimed_bytes"]
+        print(f"🧹 Maintenance pass done, reclaimed {reclaimed} bytes")
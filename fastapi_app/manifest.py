@@ -0,0 +1,156 @@
+import datetime
+import json
+import os
+import threading
+
+MANIFEST_FILE = "manifest.json"
+
+_lock = threading.Lock()
+# user_db_path -> (mtime_ns, manifest); the mtime check picks up writes from other worker processes
+_cache = {}
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+
+def user_lock(user_db_path: str) -> threading.Lock:
+    """Held by anything that adds, moves or drops a user's collections: ingests, refreshes, compaction"""
+    with _user_locks_lock:
+        return _user_locks.setdefault(user_db_path, threading.Lock())
+
+
+def _path(user_db_path: str) -> str:
+    return os.path.join(user_db_path, MANIFEST_FILE)
+
+
+def _empty() -> dict:
+    return {"active_collection": None, "collections": {}}
+
+
+def load_manifest(user_db_path: str) -> dict | None:
+    """The user's manifest, served from memory unless the file changed; None if there is none yet"""
+    path = _path(user_db_path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _cache.get(user_db_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    _cache[user_db_path] = (mtime, manifest)
+    return manifest
+
+
+def _save(user_db_path: str, manifest: dict):
+    os.makedirs(user_db_path, exist_ok=True)
+    path = _path(user_db_path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    # Readers see either the old or the new manifest, never a partial one
+    os.replace(tmp_path, path)
+    _cache[user_db_path] = (os.stat(path).st_mtime_ns, manifest)
+
+
+def _update(user_db_path: str, change) -> dict:
+    with _lock:
+        manifest = json.loads(json.dumps(load_manifest(user_db_path) or _empty()))
+        change(manifest)
+        _save(user_db_path, manifest)
+        return manifest
+
+
+def reset_manifest(user_db_path: str):
+    """Start the user over with no collections, without looking at what the store still holds"""
+    with _lock:
+        _save(user_db_path, _empty())
+
+
+def active_collection(user_db_path: str) -> str | None:
+    manifest = load_manifest(user_db_path)
+    return manifest["active_collection"] if manifest else None
+
+
+def collection_info(user_db_path: str, collection_name: str) -> dict:
+    manifest = load_manifest(user_db_path) or _empty()
+    return manifest["collections"].get(collection_name, {})
+
+
+def collection_version(user_db_path: str, collection_name: str) -> int:
+    """Bumped on every ingest, refresh or deletion that changes the collection's chunks"""
+    return collection_info(user_db_path, collection_name).get("version", 0)
+
+
+def record_ingest(user_db_path: str, collection_name: str, documents: int, metadata: dict,
+                  dimension: int = None, sources: int = 0) -> dict:
+    """Register a finished ingest and make its collection the one /query searches"""
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+
+    def change(manifest):
+        previous = manifest["collections"].get(collection_name, {})
+        manifest["collections"][collection_name] = {
+            "version": previous.get("version", 0) + 1,
+            "documents": documents,
+            "sources": sources,
+            "embedding_provider": metadata.get("embedding_provider", "gemini"),
+            "dimension": dimension,
+            "metadata": metadata,
+            "created_at": now,
+            "last_ingest": now,
+        }
+        manifest["active_collection"] = collection_name
+        manifest["last_ingest"] = now
+
+    return _update(user_db_path, change)
+
+
+def adjust_documents(user_db_path: str, collection_name: str, delta: int, changed: bool = None):
+    """Keep chunk counts and the version right after refreshes and deletions"""
+    def change(manifest):
+        info = manifest["collections"].get(collection_name)
+        if info is not None:
+            info["documents"] = max(0, info.get("documents", 0) + delta)
+            info["version"] = info.get("version", 0) + 1
+            info["last_ingest"] = datetime.datetime.now().isoformat(timespec="seconds")
+
+    # A refresh can swap chunks one for one: the count stays, the content (and version) doesn't
+    if delta if changed is None else changed:
+        _update(user_db_path, change)
+
+
+def forget_collection(user_db_path: str, collection_name: str) -> dict:
+    """Drop a deleted collection; if it was the active one, the newest remaining collection takes over"""
+    def change(manifest):
+        manifest["collections"].pop(collection_name, None)
+        if manifest["active_collection"] == collection_name:
+            remaining = sorted(manifest["collections"].items(),
+                               key=lambda item: (item[1].get("created_at") or "", item[0]))
+            manifest["active_collection"] = remaining[-1][0] if remaining else None
+
+    return _update(user_db_path, change)
+
+
+def rebuild_manifest(user_db_path: str, collections: list, prefix: str) -> dict:
+    """One-off scan for databases that predate the manifest"""
+    def change(manifest):
+        manifest.update(_empty())
+        for collection in sorted(collections, key=lambda c: c.name):
+            if not collection.name.startswith(prefix):
+                continue
+            metadata = collection.metadata or {}
+            manifest["collections"][collection.name] = {
+                "version": 1,
+                "documents": collection.count(),
+                "sources": None,
+                "embedding_provider": metadata.get("embedding_provider", "gemini"),
+                "dimension": None,
+                "metadata": metadata,
+                "created_at": None,
+                "last_ingest": None,
+            }
+            if manifest["collections"][collection.name]["documents"]:
+                # Timestamped names sort chronologically; the newest non-empty one is active
+                manifest["active_collection"] = collection.name
+
+    return _update(user_db_path, change)
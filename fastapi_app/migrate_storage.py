@@ -0,0 +1,98 @@
+"""
+Move users' collections between the per-tenant and shared storage layouts.
+
+Run it with the API stopped, then start the API with STORAGE_LAYOUT set to the new layout:
+
+    python fastapi_app/migrate_storage.py --to shared
+    python fastapi_app/migrate_storage.py --to per_tenant --user user_2abc
+
+Collections keep their names, ids, vectors, documents and metadata, so the sidecars in
+each user's folder (manifest, lexical, flat and document indexes, document store) stay
+valid as they are. A collection is only deleted from the old layout once its copy holds
+the same number of chunks, and copies are upserts, so an interrupted run can be repeated.
+"""
+import argparse
+import os
+import shutil
+
+from chromadb import PersistentClient
+
+from maintenance import remove_orphan_segments, vacuum
+from resources import chroma_clients, segment_dirs, shared_store_path, tenant_client
+
+LAYOUTS = ("per_tenant", "shared")
+COPY_BATCH = 500
+
+
+def _copy_collection(collection, target_client) -> int:
+    copy = target_client.get_or_create_collection(collection.name, metadata=collection.metadata)
+    total = collection.count()
+    for offset in range(0, total, COPY_BATCH):
+        batch = collection.get(include=["embeddings", "documents", "metadatas"], limit=COPY_BATCH, offset=offset)
+        documents = batch["documents"]
+        copy.upsert(ids=batch["ids"], embeddings=batch["embeddings"], metadatas=batch["metadatas"],
+                    # Collections with a document store keep their text outside Chroma
+                    documents=documents if documents and all(doc is not None for doc in documents) else None)
+    if copy.count() != total:
+        raise RuntimeError(f"{collection.name}: copied {copy.count()} of {total} chunks")
+    return total
+
+
+def migrate_user(user_db_path: str, to_layout: str) -> dict:
+    """Move one user's collections into to_layout; returns {collection name: chunks moved}"""
+    own_store = os.path.join(user_db_path, "chroma.sqlite3")
+    if to_layout == "shared" and not os.path.exists(own_store):
+        return {}
+    moved = {}
+    with chroma_clients.lease(user_db_path, lambda: PersistentClient(path=user_db_path)) as own_client:
+        shared_client = tenant_client(user_db_path)
+        source, target = (own_client, shared_client) if to_layout == "shared" else (shared_client, own_client)
+        for collection in source.list_collections():
+            moved[collection.name] = _copy_collection(collection, target)
+            source.delete_collection(collection.name)
+
+    chroma_clients.invalidate(user_db_path)
+    if to_layout == "shared":
+        # The user's own store is closed, so it can go; the shared store is cleaned up once at the end
+        for name in segment_dirs(user_db_path):
+            shutil.rmtree(os.path.join(user_db_path, name), ignore_errors=True)
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(own_store + suffix):
+                os.remove(own_store + suffix)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", choices=LAYOUTS, required=True, help="layout to move collections into")
+    parser.add_argument("--db-path", default=os.getenv("DATABASE_PATH", "./crawlmind_db"))
+    parser.add_argument("--user", action="append", help="only these user ids (repeatable); default all")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.db_path):
+        parser.error(f"{args.db_path} does not exist")
+    users = args.user or sorted(name for name in os.listdir(args.db_path)
+                                if not name.startswith("_") and os.path.isdir(os.path.join(args.db_path, name)))
+    failed = 0
+    for user_id in users:
+        try:
+            moved = migrate_user(os.path.join(args.db_path, user_id), args.to)
+        except Exception as e:
+            failed += 1
+            print(f"❌ {user_id}: {e}")
+            continue
+        print(f"✅ {user_id}: {len(moved)} collection(s), {sum(moved.values())} chunks")
+
+    if args.to == "per_tenant":
+        store_path = shared_store_path(args.db_path)
+        removed = remove_orphan_segments(store_path)
+        if os.path.exists(os.path.join(store_path, "chroma.sqlite3")):
+            vacuum(os.path.join(store_path, "chroma.sqlite3"))
+        print(f"🧹 Removed {len(removed)} segment folder(s) from the shared store")
+    print(f"Migrated {len(users) - failed} of {len(users)} user(s) to the {args.to} layout")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import time
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+LOAD_CONCURRENCY = int(os.getenv("LOAD_CONCURRENCY", "2"))
+
+_DONE = object()
+
+
+class StageStats:
+    """Item counts and timings for one pipeline stage"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+
+    def as_dict(self) -> dict:
+        wall = 0.0
+        if self.started_at is not None:
+            wall = (self.finished_at or time.perf_counter()) - self.started_at
+        return {
+            "stage": self.name,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "wall_seconds": round(wall, 3),
+            "items_per_second": round(self.items_out / self.busy_seconds, 2) if self.busy_seconds else None,
+        }
+
+
+async def run_ingestion(
+    sources: list,
+    load,
+    chunk,
+    embed,
+    write,
+    queue_size: int = INGEST_QUEUE_SIZE,
+    batch_size: int = EMBED_BATCH_SIZE,
+    load_concurrency: int = LOAD_CONCURRENCY,
+) -> dict:
+    """
+    Run crawl/parse -> chunk -> embed -> write as concurrent stages joined by bounded queues.
+
+    `load(source)` is async and returns a list of page dicts with at least a "text" key.
+    `chunk(page)` returns a list of chunk dicts with "id" and "text"; a chunk that already
+    carries an "embedding" (unchanged since the last ingest) skips the embed call.
+    `chunk`, `embed(texts)` and `write(chunks, embeddings)` are blocking and run in worker threads.
+    Only `queue_size` items sit between any two stages, so memory stays flat however
+    large the crawl is, and a slow stage back-pressures the ones before it.
+    """
+    stats = {name: StageStats(name) for name in ("load", "chunk", "embed", "write")}
+    source_q = asyncio.Queue()
+    page_q = asyncio.Queue(maxsize=queue_size)
+    chunk_q = asyncio.Queue(maxsize=queue_size * batch_size)
+    write_q = asyncio.Queue(maxsize=queue_size)
+    for source in sources:
+        source_q.put_nowait(source)
+
+    async def load_worker():
+        st = stats["load"]
+        while True:
+            try:
+                source = source_q.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            st.start()
+            st.items_in += 1
+            started = time.perf_counter()
+            pages = await load(source)
+            st.busy_seconds += time.perf_counter() - started
+            for page in pages:
+                await page_q.put(page)
+                st.items_out += 1
+
+    async def load_stage():
+        await asyncio.gather(*(load_worker() for _ in range(max(1, load_concurrency))))
+        stats["load"].finish()
+        await page_q.put(_DONE)
+
+    async def chunk_stage():
+        st = stats["chunk"]
+        while (page := await page_q.get()) is not _DONE:
+            st.start()
+            st.items_in += 1
+            started = time.perf_counter()
+            chunks = await asyncio.to_thread(chunk, page)
+            st.busy_seconds += time.perf_counter() - started
+            for item in chunks:
+                await chunk_q.put(item)
+                st.items_out += 1
+        st.finish()
+        await chunk_q.put(_DONE)
+
+    reused = 0
+
+    async def embed_stage():
+        nonlocal reused
+        st = stats["embed"]
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < batch_size:
+                item = await chunk_q.get()
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+            if not batch:
+                break
+            st.start()
+            st.items_in += len(batch)
+            started = time.perf_counter()
+            pending = [item for item in batch if "embedding" not in item]
+            fresh = iter(await asyncio.to_thread(embed, [item["text"] for item in pending]) if pending else [])
+            embeddings = [item["embedding"] if "embedding" in item else next(fresh) for item in batch]
+            reused += len(batch) - len(pending)
+            st.busy_seconds += time.perf_counter() - started
+            st.items_out += len(batch)
+            await write_q.put((batch, embeddings))
+        st.finish()
+        await write_q.put(_DONE)
+
+    async def write_stage():
+        st = stats["write"]
+        while (item := await write_q.get()) is not _DONE:
+            batch, embeddings = item
+            st.start()
+            st.items_in += len(batch)
+            started = time.perf_counter()
+            await asyncio.to_thread(write, batch, embeddings)
+            st.busy_seconds += time.perf_counter() - started
+            st.items_out += len(batch)
+        st.finish()
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(coro) for coro in (load_stage(), chunk_stage(), embed_stage(), write_stage())]
+    try:
+        # Fail fast: one broken stage would otherwise leave the others blocked on full queues
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        "pages": stats["load"].items_out,
+        "chunks": stats["chunk"].items_out,
+        "written": stats["write"].items_out,
+        "reused": reused,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+        "stages": [s.as_dict() for s in stats.values()],
+    }
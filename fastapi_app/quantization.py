@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+VECTOR_STORAGE_MODES = ("float32", "float16", "int8")
+# Index dimensions used when quantization is on but no vector_dim was given
+COMPACT_INDEX_DIM = int(os.getenv("COMPACT_INDEX_DIM", "128"))
+
+
+def compact_settings(metadata: dict) -> dict | None:
+    """Read the compact-storage settings from collection metadata (None when vectors are stored as-is)"""
+    metadata = metadata or {}
+    mode = metadata.get("vector_storage", "float32")
+    dim = metadata.get("vector_dim")
+    if mode == "float32" and not dim:
+        return None
+    return {"mode": mode, "index_dim": int(dim or COMPACT_INDEX_DIM)}
+
+
+def validate_settings(vector_storage: str = None, vector_dim: int = None) -> dict:
+    """Turn /embed form values into collection metadata, raising ValueError on bad input"""
+    metadata = {}
+    if vector_storage:
+        if vector_storage not in VECTOR_STORAGE_MODES:
+            raise ValueError(f"vector_storage must be one of: {', '.join(VECTOR_STORAGE_MODES)}")
+        metadata["vector_storage"] = vector_storage
+    if vector_dim:
+        if vector_dim < 8:
+            raise ValueError("vector_dim must be at least 8")
+        metadata["vector_dim"] = int(vector_dim)
+    return metadata
+
+
+def truncate(vectors, dim: int) -> np.ndarray:
+    """Keep the leading `dim` components and re-normalize to unit length"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    head = vectors[..., :dim]
+    norms = np.linalg.norm(head, axis=-1, keepdims=True)
+    return head / np.where(norms == 0, 1.0, norms)
+
+
+def encode(vectors, mode: str) -> tuple[np.ndarray, np.ndarray | None]:
+    """Quantize rows; int8 uses a symmetric per-vector scale"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if mode == "float32":
+        return vectors, None
+    if mode == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def decode(codes: np.ndarray, scales: np.ndarray | None = None) -> np.ndarray:
+    vectors = codes.astype(np.float32)
+    if scales is not None:
+        vectors *= scales[:, None]
+    return vectors
+
+
+def bytes_per_vector(dim: int, mode: str) -> int:
+    return dim * np.dtype(mode).itemsize + (4 if mode == "int8" else 0)
+
+
+class CompactVectorStore:
+    """
+    Append-only sidecar holding full-dimension quantized vectors for one collection.
+
+    Rows live in a flat binary file that is memory-mapped on read, so only the rows
+    fetched for re-scoring are paged in.
+    """
+
+    def __init__(self, path: str, mode: str):
+        self.path = path
+        self.mode = mode
+        self.dtype = np.dtype(mode)
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._count = 0
+        self.dim = None
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        meta_file = self._file("meta.json")
+        if not os.path.exists(meta_file):
+            return
+        with open(meta_file, "r", encoding="utf-8") as f:
+            self.dim = json.load(f)["dim"]
+        row_bytes = self.dim * self.dtype.itemsize
+        stored = os.path.getsize(self._file("vectors.bin")) // row_bytes if os.path.exists(self._file("vectors.bin")) else 0
+        if os.path.exists(self._file("ids.txt")):
+            with open(self._file("ids.txt"), "r", encoding="utf-8") as f:
+                for row, chunk_id in enumerate(f.read().splitlines()[:stored]):
+                    self._rows[chunk_id] = row
+                    self._count = row + 1
+        if os.path.exists(self._file("deleted.txt")):
+            with open(self._file("deleted.txt"), "r", encoding="utf-8") as f:
+                for chunk_id in f.read().splitlines():
+                    self._rows.pop(chunk_id, None)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def append(self, ids: list[str], vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes, scales = encode(vectors, self.mode)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self._file("meta.json"), "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim, "mode": self.mode}, f)
+            # Vectors are written before ids so a crash never leaves an id without its row
+            with open(self._file("vectors.bin"), "ab") as f:
+                f.write(np.ascontiguousarray(codes).tobytes())
+            if scales is not None:
+                with open(self._file("scales.bin"), "ab") as f:
+                    f.write(scales.tobytes())
+            with open(self._file("ids.txt"), "a", encoding="utf-8") as f:
+                f.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+            for chunk_id in ids:
+                self._rows[chunk_id] = self._count
+                self._count += 1
+
+    def delete(self, ids: list[str]):
+        """Tombstone rows; their bytes stay in vectors.bin but the ids are never returned again"""
+        with self._lock:
+            with open(self._file("deleted.txt"), "a", encoding="utf-8") as f:
+                f.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+            for chunk_id in ids:
+                self._rows.pop(chunk_id, None)
+
+    def get(self, ids: list[str]) -> tuple[list[str], np.ndarray]:
+        """Return the ids that were found and their dequantized vectors"""
+        found = [chunk_id for chunk_id in ids if chunk_id in self._rows]
+        if not found or self.dim is None:
+            return [], np.zeros((0, self.dim or 0), dtype=np.float32)
+        rows = np.array([self._rows[chunk_id] for chunk_id in found])
+        codes = np.memmap(self._file("vectors.bin"), dtype=self.dtype, mode="r").reshape(-1, self.dim)[rows]
+        scales = None
+        if self.mode == "int8":
+            scales = np.memmap(self._file("scales.bin"), dtype=np.float32, mode="r")[rows]
+        return found, decode(codes, scales)
@@ -0,0 +1,295 @@
+import asyncio
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+
+from chunking import CHUNKING_MODE, content_hash, split_text
+from crawling import crawl_url
+from manifest import adjust_documents, load_manifest, user_lock
+from resources import get_embeddings, open_chroma_client
+from retrieval import add_vectors, delete_vectors, source_metadata
+
+# Off by default: the scheduler crawls third-party sites and spends users' embedding quota unattended
+REFRESH_ENABLED = os.getenv("REFRESH_ENABLED", "false").lower() == "true"
+REFRESH_INTERVAL_HOURS = float(os.getenv("REFRESH_INTERVAL_HOURS", "24"))
+REFRESH_POLL_SECONDS = int(os.getenv("REFRESH_POLL_SECONDS", "300"))
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", "2"))
+# API keys are forgotten this long after the user's last request, and beyond this many users (oldest first)
+API_KEY_TTL_HOURS = float(os.getenv("API_KEY_TTL_HOURS", "48"))
+MAX_REMEMBERED_API_KEYS = int(os.getenv("MAX_REMEMBERED_API_KEYS", "1000"))
+
+SOURCES_FILE = "sources.json"
+
+_registry_lock = threading.Lock()
+# API keys are only ever held in memory; a user's gemini-backed sources wait for their next request after a restart
+# or once the key expired. user_id -> (api_key, time remembered), least recently remembered first
+_api_keys = OrderedDict()
+_api_keys_lock = threading.Lock()
+
+
+def remember_api_key(user_id: str, api_key: str):
+    if not api_key:
+        return
+    with _api_keys_lock:
+        _api_keys[user_id] = (api_key, time.monotonic())
+        _api_keys.move_to_end(user_id)
+        while len(_api_keys) > MAX_REMEMBERED_API_KEYS:
+            _api_keys.popitem(last=False)
+
+
+def remembered_api_key(user_id: str) -> str | None:
+    with _api_keys_lock:
+        api_key, remembered = _api_keys.get(user_id, (None, 0.0))
+        if api_key and time.monotonic() - remembered > API_KEY_TTL_HOURS * 3600:
+            del _api_keys[user_id]
+            return None
+        return api_key
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def load_sources(user_db_path: str) -> dict:
+    path = os.path.join(user_db_path, SOURCES_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_sources(user_db_path: str, sources: dict):
+    path = os.path.join(user_db_path, SOURCES_FILE)
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(sources, f, indent=2)
+        os.replace(tmp_path, path)
+    except FileNotFoundError:
+        # The user's folder was deleted (DELETE /database) mid-write; recreating it would undo that
+        pass
+
+
+def update_source(user_db_path: str, url: str, **fields):
+    with _registry_lock:
+        sources = load_sources(user_db_path)
+        sources.setdefault(url, {"url": url}).update(fields)
+        _save_sources(user_db_path, sources)
+
+
+def forget_sources(user_db_path: str, source: str = None, domain: str = None) -> list[str]:
+    """Stop refreshing deleted sources; returns the URLs removed from the registry"""
+    with _registry_lock:
+        sources = load_sources(user_db_path)
+        removed = [url for url in sources
+                   if url == source or (domain and urlparse(url).netloc.lower() == domain.lower())]
+        for url in removed:
+            del sources[url]
+        if removed:
+            _save_sources(user_db_path, sources)
+        return removed
+
+
+def register_source(user_db_path: str, url: str, collection_name: str, embedding_provider: str,
+                    chunking: str, page_hash: str, interval_hours: float = None):
+    """Remember a URL ingested by /embed so the scheduler can keep it fresh"""
+    update_source(
+        user_db_path, url,
+        collection=collection_name,
+        embedding_provider=embedding_provider,
+        chunking=chunking,
+        interval_hours=REFRESH_INTERVAL_HOURS if interval_hours is None else interval_hours,
+        content_hash=page_hash,
+        etag=None,
+        last_modified=None,
+        last_refresh=_now(),
+        last_status="ingested",
+        last_error=None
+    )
+
+
+def _current_entry(user_db_path: str, url: str) -> dict | None:
+    """
+    The source's registry entry, or None once it, its collection or the user's knowledge base
+    was deleted. Only reliable under user_lock, which deletions take to tombstone a user.
+    """
+    if not os.path.exists(user_db_path):
+        return None
+    entry = load_sources(user_db_path).get(url)
+    manifest = load_manifest(user_db_path)
+    # No manifest yet is a database from before manifests, not a deleted one
+    if entry is None or (manifest is not None and entry.get("collection") not in manifest["collections"]):
+        return None
+    return entry
+
+
+def _record(user_db_path: str, url: str, **status) -> bool:
+    """update_source() unless the source was deleted meanwhile, which the update would undo"""
+    with user_lock(user_db_path):
+        if _current_entry(user_db_path, url) is None:
+            return False
+        update_source(user_db_path, url, **status)
+        return True
+
+
+def _is_due(entry: dict) -> bool:
+    interval = entry.get("interval_hours") or 0
+    if interval <= 0:
+        return False
+    last = entry.get("last_refresh")
+    if not last:
+        return True
+    elapsed = datetime.datetime.now() - datetime.datetime.fromisoformat(last)
+    return elapsed.total_seconds() >= interval * 3600
+
+
+def check_modified(url: str, etag: str = None, last_modified: str = None) -> tuple[bool, str, str]:
+    """Conditional GET; returns (changed, etag, last_modified) without downloading the body"""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        with requests.get(url, headers=headers, timeout=20, stream=True) as response:
+            if response.status_code == 304:
+                return False, etag, last_modified
+            return True, response.headers.get("ETag"), response.headers.get("Last-Modified")
+    except requests.RequestException:
+        # Can't tell; let the crawl and content hash decide
+        return True, None, None
+
+
+def refresh_source(user_db_path: str, entry: dict, api_key: str = None) -> dict:
+    """
+    Recrawl one source and apply only the difference to its collection.
+
+    Chunks whose content hash survived are kept as-is, new ones are embedded and
+    added, and chunks that disappeared from the page are deleted.
+    """
+    url = entry["url"]
+    started = time.perf_counter()
+    try:
+        changed, etag, last_modified = check_modified(url, entry.get("etag"), entry.get("last_modified"))
+        if not changed:
+            status = {"last_status": "unchanged (not modified)"}
+        else:
+            text = crawl_url(url)
+            if not text:
+                raise RuntimeError("crawl returned no content")
+            page_hash = content_hash(text)
+            if page_hash == entry.get("content_hash"):
+                status = {"last_status": "unchanged"}
+            else:
+                with user_lock(user_db_path):
+                    # Compaction may have moved the source into another collection since entry was read
+                    current = _current_entry(user_db_path, url)
+                    if current is None:
+                        print(f"🗑️ Not refreshing {url}: it was deleted while being crawled")
+                        return {**entry, "last_status": "deleted"}
+                    entry = {**entry, **current}
+                    status = _apply_delta(user_db_path, entry, text, api_key)
+                status["content_hash"] = page_hash
+            status.update(etag=etag, last_modified=last_modified)
+        status.update(last_error=None)
+    except Exception as e:
+        print(f"❌ Refresh failed for {url}: {e}")
+        status = {"last_status": "error", "last_error": str(e)}
+
+    status.update(last_refresh=_now(), last_duration_seconds=round(time.perf_counter() - started, 3))
+    if not _record(user_db_path, url, **status):
+        return {**entry, **status, "last_status": "deleted"}
+    return {**entry, **status}
+
+
+def _apply_delta(user_db_path: str, entry: dict, text: str, api_key: str) -> dict:
+    with open_chroma_client(user_db_path) as chroma_client:
+        return _apply_delta_to(chroma_client.get_collection(entry["collection"]), user_db_path, entry, text, api_key)
+
+
+def _apply_delta_to(collection, user_db_path: str, entry: dict, text: str, api_key: str) -> dict:
+    url = entry["url"]
+
+    existing = collection.get(where={"source": url}, include=["metadatas"])
+    old_ids_by_hash = {}
+    for chunk_id, metadata in zip(existing["ids"], existing["metadatas"]):
+        old_ids_by_hash.setdefault((metadata or {}).get("content_hash"), []).append(chunk_id)
+
+    new_chunks = []
+    kept = 0
+    for index, chunk in enumerate(split_text(text, entry.get("chunking") or CHUNKING_MODE)):
+        chunk_hash = content_hash(chunk)
+        if old_ids_by_hash.get(chunk_hash):
+            old_ids_by_hash[chunk_hash].pop()
+            kept += 1
+        else:
+            new_chunks.append((chunk, chunk_hash, index))
+    vanished = [chunk_id for ids in old_ids_by_hash.values() for chunk_id in ids]
+
+    if new_chunks:
+        embedding_function = get_embeddings(entry.get("embedding_provider") or "gemini", api_key)
+        embeddings = embedding_function.embed_documents([chunk for chunk, _, _ in new_chunks])
+        page_metadata = source_metadata(url, "url")
+        add_vectors(
+            collection,
+            user_db_path,
+            ids=[str(uuid.uuid4()) for _ in new_chunks],
+            embeddings=embeddings,
+            documents=[chunk for chunk, _, _ in new_chunks],
+            metadatas=[{**page_metadata, "chunk_index": index, "content_hash": chunk_hash}
+                       for _, chunk_hash, index in new_chunks]
+        )
+    delete_vectors(collection, user_db_path, vanished)
+    adjust_documents(user_db_path, collection.name, len(new_chunks) - len(vanished),
+                     changed=bool(new_chunks or vanished))
+
+    print(f"🔄 Refreshed {url}: {len(new_chunks)} added, {len(vanished)} deleted, {kept} kept")
+    return {"last_status": "updated", "chunks_added": len(new_chunks), "chunks_deleted": len(vanished), "chunks_kept": kept}
+
+
+def due_sources(db_path: str) -> list[tuple[str, str, dict]]:
+    """(user_id, user_db_path, entry) for every registered source whose interval has elapsed"""
+    due = []
+    if not os.path.isdir(db_path):
+        return due
+    for user_id in os.listdir(db_path):
+        user_db_path = os.path.join(db_path, user_id)
+        if not os.path.exists(os.path.join(user_db_path, SOURCES_FILE)):
+            continue
+        for entry in load_sources(user_db_path).values():
+            if _is_due(entry):
+                due.append((user_id, user_db_path, entry))
+    return due
+
+
+async def run_refresh_scheduler(db_path: str):
+    """Background loop: periodically refresh every due source with bounded concurrency"""
+    semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+    async def refresh_one(user_id, user_db_path, entry):
+        async with semaphore:
+            provider = entry.get("embedding_provider") or "gemini"
+            api_key = remembered_api_key(user_id)
+            if provider == "gemini" and not api_key:
+                # Stamped like a refresh, so the source waits out its interval instead of every poll
+                await asyncio.to_thread(_record, user_db_path, entry["url"], last_status="waiting for API key",
+                                        last_refresh=_now())
+                return
+            await asyncio.to_thread(refresh_source, user_db_path, entry, api_key)
+
+    while True:
+        try:
+            due = await asyncio.to_thread(due_sources, db_path)
+            if due:
+                print(f"🔄 Refreshing {len(due)} due source(s)")
+                await asyncio.gather(*(refresh_one(*item) for item in due))
+        except Exception as e:
+            print(f"❌ Refresh scheduler error: {e}")
+        await asyncio.sleep(REFRESH_POLL_SECONDS)
@@ -0,0 +1,417 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from chromadb import AdminClient, PersistentClient
+from chromadb.api.shared_system_client import SharedSystemClient
+from chromadb.config import DEFAULT_DATABASE, Settings
+from chromadb.errors import NotFoundError
+from langchain_core.prompts import PromptTemplate
+from langchain_google_genai import GoogleGenerativeAI
+
+from embeddings import get_embedding_provider
+
+MAX_OPEN_CLIENTS = int(os.getenv("MAX_OPEN_CLIENTS", "32"))
+# "per_tenant": a Chroma store in each user's folder; "shared": one store under DB_PATH, a Chroma tenant per user
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "per_tenant")
+SHARED_STORE_DIR = "_shared"
+# Vector indexes kept loaded at once, across open per-tenant stores or inside the shared one
+CHROMA_MEMORY_MB = int(os.getenv("CHROMA_MEMORY_MB", "2048"))
+MAX_CACHED_MODELS = int(os.getenv("MAX_CACHED_MODELS", "128"))
+# Open sidecar handles (lexical, flat, document and compact indexes, doc stores) across all users
+MAX_OPEN_SIDECARS = int(os.getenv("MAX_OPEN_SIDECARS", "256"))
+RESOURCE_IDLE_SECONDS = int(os.getenv("RESOURCE_IDLE_SECONDS", "900"))
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+
+
+class _Entry:
+    __slots__ = ("value", "last_used", "refs", "weight")
+
+    def __init__(self, value, weight: int = 0):
+        self.value = value
+        self.last_used = time.monotonic()
+        self.refs = 0
+        self.weight = weight
+
+
+class ResourceCache:
+    """
+    Thread-safe LRU of expensive handles with idle expiry.
+
+    Values that need closing are only closed once no lease holds them: an entry
+    evicted while in use is parked and closed by its last release, or revived if
+    the same key is asked for again before that (unless it was invalidated with
+    revive=False). With `weigh` (key -> bytes) and
+    max_weight, entries are also evicted while their total weight is over budget.
+
+    Values are built outside the cache lock, so opening one store never holds up
+    requests for another; concurrent misses on the same key wait for a single build.
+    """
+
+    def __init__(self, name: str, max_size: int, idle_seconds: int, close=None, weigh=None, max_weight: int = 0):
+        self.name = name
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.max_weight = max_weight
+        self._close = close
+        self._weigh = weigh
+        self._entries = OrderedDict()
+        self._parked = {}
+        self._retired = set()
+        # Key -> Future of a build in progress, and key -> revive for builds invalidated meanwhile
+        self._building = {}
+        self._invalidated = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _acquire(self, key, factory):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None and key in self._parked:
+                    entry = self._entries[key] = self._parked.pop(key)
+                if entry is not None:
+                    self.hits += 1
+                    return self._use_locked(key, entry)
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = Future()
+                    break
+            # Someone else is building it: take theirs, or their error
+            building.result()
+
+        try:
+            entry = _Entry(factory(), self._weight_of(key))
+        except BaseException as e:
+            with self._lock:
+                del self._building[key]
+                self._invalidated.pop(key, None)
+            building.set_exception(e)
+            raise
+        with self._lock:
+            del self._building[key]
+            self.misses += 1
+            revive = self._invalidated.pop(key, None)
+            if revive is None:
+                self._entries[key] = entry
+                entry = self._use_locked(key, entry)
+            else:
+                # Invalidated while it was being built: only this caller gets it
+                entry.refs += 1
+                self.evictions += 1
+                if revive:
+                    self._parked[key] = entry
+                else:
+                    self._retired.add(entry)
+        building.set_result(None)
+        return entry
+
+    def _use_locked(self, key, entry):
+        self._entries.move_to_end(key)
+        entry.last_used = time.monotonic()
+        entry.refs += 1
+        self._evict_locked()
+        return entry
+
+    def _release(self, key, entry):
+        with self._lock:
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            if entry.refs == 0 and self._parked.get(key) is entry:
+                del self._parked[key]
+                self._close_value(key, entry.value)
+            elif entry.refs == 0 and entry in self._retired:
+                self._retired.discard(entry)
+                self._close_value(key, entry.value)
+
+    def get(self, key, factory):
+        """For values that never need closing (models, prompt objects)"""
+        entry = self._acquire(key, factory)
+        self._release(key, entry)
+        return entry.value
+
+    @contextmanager
+    def lease(self, key, factory):
+        entry = self._acquire(key, factory)
+        try:
+            yield entry.value
+        finally:
+            self._release(key, entry)
+
+    def _weight_of(self, key) -> int:
+        if self._weigh is None:
+            return 0
+        try:
+            return self._weigh(key)
+        except OSError:
+            return 0
+
+    def _evict_locked(self, now: float = None):
+        now = now or time.monotonic()
+        weight = sum(entry.weight for entry in self._entries.values())
+        newest = next(reversed(self._entries), None)
+        for key in list(self._entries):
+            entry = self._entries[key]
+            # The entry just used is never evicted for weight, or one store over budget would be reopened every time
+            over_weight = bool(self.max_weight) and weight > self.max_weight and key != newest
+            over_capacity = len(self._entries) > self.max_size or over_weight
+            idle = now - entry.last_used > self.idle_seconds
+            if not over_capacity and not idle:
+                # Entries are in LRU order, so nothing later is idle either
+                break
+            if entry.refs and not over_capacity:
+                continue
+            weight -= entry.weight
+            self._remove_locked(key)
+
+    def _remove_locked(self, key):
+        entry = self._entries.pop(key)
+        self.evictions += 1
+        if entry.refs:
+            self._parked[key] = entry
+        else:
+            self._close_value(key, entry.value)
+
+    def _close_value(self, key, value):
+        if self._close is None:
+            return
+        try:
+            self._close(value)
+        except Exception as e:
+            print(f"⚠️ Error closing cached {self.name} {key}: {e}")
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def sweep(self):
+        """Drop entries idle for longer than idle_seconds, re-weighing the rest first"""
+        if self._weigh is not None:
+            with self._lock:
+                keys = list(self._entries)
+            weights = {key: self._weight_of(key) for key in keys}
+            with self._lock:
+                for key, weight in weights.items():
+                    if key in self._entries:
+                        self._entries[key].weight = weight
+        with self._lock:
+            self._evict_locked()
+
+    def invalidate(self, key, revive: bool = True) -> bool:
+        """
+        Evict key now; False if it wasn't cached. With revive=False a value still leased is
+        closed on release and never handed out again.
+        """
+        with self._lock:
+            held = key in self._entries or key in self._parked or key in self._building
+            if key in self._building:
+                self._invalidated[key] = self._invalidated.get(key, True) and revive
+            if key in self._entries:
+                self._remove_locked(key)
+            if not revive and key in self._parked:
+                self._retired.add(self._parked.pop(key))
+            return held
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._entries),
+                "parked": len(self._parked),
+                "max_size": self.max_size,
+                "weight_mb": round(sum(entry.weight for entry in self._entries.values()) / 2 ** 20, 1),
+                "max_weight_mb": round(self.max_weight / 2 ** 20, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def _system_cache() -> dict:
+    # Chroma's private path -> System cache (chromadb 0.5.23); empty if a release renamed it
+    cache = getattr(SharedSystemClient, "_identifier_to_system", None)
+    return cache if isinstance(cache, dict) else {}
+
+
+def _close_chroma_client(client):
+    # Chroma shares one System per persist directory; stopping it and dropping it from
+    # Chroma's own cache is what actually releases the SQLite and HNSW file handles
+    # Through the server, since client._system looks the path up in a cache close_chroma_client may have cleared
+    system = getattr(getattr(client, "_server", None), "_system", None)
+    if system is None or not hasattr(system, "stop"):
+        # Internals this code doesn't know: the client is just dropped and its handles close with it
+        return
+    cache = _system_cache()
+    for identifier, cached in list(cache.items()):
+        if cached is system:
+            cache.pop(identifier, None)
+    system.stop()
+
+
+def segment_dirs(store_path: str) -> list[str]:
+    """Names of the per-segment (HNSW) directories in a Chroma store"""
+    names = []
+    for name in os.listdir(store_path):
+        try:
+            uuid.UUID(name)
+        except ValueError:
+            continue
+        if os.path.isdir(os.path.join(store_path, name)):
+            names.append(name)
+    return names
+
+
+def store_index_bytes(store_path: str) -> int:
+    """On-disk size of a store's vector segments, which is what loading them costs in memory"""
+    total = 0
+    for name in segment_dirs(store_path):
+        for entry in os.scandir(os.path.join(store_path, name)):
+            if entry.is_file():
+                total += entry.stat().st_size
+    return total
+
+
+chroma_clients = ResourceCache("chroma client", MAX_OPEN_CLIENTS, RESOURCE_IDLE_SECONDS, close=_close_chroma_client,
+                               weigh=store_index_bytes, max_weight=CHROMA_MEMORY_MB * 2 ** 20)
+# Shared layout: tenant-scoped clients over one store; cheap, and closing one must not stop the others' system
+chroma_tenants = ResourceCache("chroma tenant", MAX_CACHED_MODELS, RESOURCE_IDLE_SECONDS)
+embedding_models = ResourceCache("embedding model", MAX_CACHED_MODELS, RESOURCE_IDLE_SECONDS)
+llms = ResourceCache("llm", MAX_CACHED_MODELS, RESOURCE_IDLE_SECONDS)
+# Keyed by file or folder path. A dropped handle stays usable by whoever still holds it; its
+# SQLite connections and memory maps are released once nothing references it
+sidecars = ResourceCache("sidecar", MAX_OPEN_SIDECARS, RESOURCE_IDLE_SECONDS)
+
+
+def _key_digest(api_key: str) -> str:
+    # Cache keys hold a digest, not the raw API key
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+def shared_store_path(db_path: str) -> str:
+    return os.path.join(db_path, SHARED_STORE_DIR)
+
+
+def chroma_path(user_db_path: str, layout: str = None) -> str:
+    """Folder holding the Chroma store with the user's collections; sidecars always stay in user_db_path"""
+    if (layout or STORAGE_LAYOUT) == "shared":
+        return shared_store_path(os.path.dirname(os.path.normpath(user_db_path)))
+    return user_db_path
+
+
+def tenant_client(user_db_path: str) -> PersistentClient:
+    """Client scoped to the user's tenant in the shared store, creating the tenant on first use"""
+    store_path = chroma_path(user_db_path, "shared")
+    tenant = os.path.basename(os.path.normpath(user_db_path))
+    # One System per store, whose segment cache keeps loaded indexes within the memory budget
+    settings = Settings(chroma_segment_cache_policy="LRU", chroma_memory_limit_bytes=CHROMA_MEMORY_MB * 2 ** 20,
+                        anonymized_telemetry=False)
+    client = PersistentClient(path=store_path, settings=settings)
+    admin = AdminClient(client.get_settings())
+    try:
+        admin.get_tenant(tenant)
+    except NotFoundError:
+        admin.create_tenant(tenant)
+        admin.create_database(DEFAULT_DATABASE, tenant=tenant)
+    os.makedirs(user_db_path, exist_ok=True)
+    return PersistentClient(path=store_path, settings=settings, tenant=tenant)
+
+
+def open_chroma_client(user_db_path: str):
+    """Lease the user's PersistentClient: `with open_chroma_client(path) as client:`"""
+    if STORAGE_LAYOUT == "shared":
+        return chroma_tenants.lease(user_db_path, lambda: tenant_client(user_db_path))
+    return chroma_clients.lease(user_db_path, lambda: PersistentClient(path=user_db_path))
+
+
+def close_chroma_client(user_db_path: str, layout: str = None):
+    """
+    Release the user's store handles, e.g. before moving or removing their folder.
+
+    A client still leased by a request is closed when that request ends; new leases get
+    a fresh client rather than one whose files may have moved.
+    """
+    if (layout or STORAGE_LAYOUT) == "shared":
+        chroma_tenants.invalidate(user_db_path)
+        return
+    # Without this Chroma would hand the still-open System to the next client for the path
+    system = _system_cache().pop(user_db_path, None)
+    if not chroma_clients.invalidate(user_db_path, revive=False) and system is not None:
+        system.stop()  # Opened outside the cache (the Streamlit app)
+
+
+def forget_sidecars(user_db_path: str):
+    """Drop every cached sidecar handle under the user's folder, e.g. once it is moved or deleted"""
+    prefix = os.path.join(user_db_path, "")
+    for key in sidecars.keys():
+        if key == user_db_path or key.startswith(prefix):
+            sidecars.invalidate(key)
+
+
+def chroma_client_open(user_db_path: str) -> bool:
+    return user_db_path in (chroma_tenants if STORAGE_LAYOUT == "shared" else chroma_clients)
+
+
+def get_embeddings(provider: str, api_key: str = None):
+    return embedding_models.get((provider, _key_digest(api_key)), lambda: get_embedding_provider(provider, api_key))
+
+
+def get_llm(api_key: str, model: str = LLM_MODEL, temperature: float = 0.3):
+    return llms.get(
+        (_key_digest(api_key), model, temperature),
+        lambda: GoogleGenerativeAI(model=model, google_api_key=api_key, temperature=temperature)
+    )
+
+
+RAG_PROMPT = PromptTemplate.from_template("""
+        You are CrawlMind AI assistant for question-answering tasks.
+        Use the retrieved context below to answer the question.
+        If you don't know the answer based on the context, say you don't know.
+        If the user says bye or goodbye, respond appropriately and end the conversation.
+
+        Context:
+        {context}
+
+        Question:
+        {question}
+
+        Answer in 2-3 clear sentences.
+        """)
+
+
+CHAT_PROMPT = PromptTemplate.from_template("""
+        You are CrawlMind AI assistant, in a conversation about the user's documents.
+        Use the retrieved context below to answer the latest question; the conversation
+        so far tells you what follow-up questions refer to.
+        If you don't know the answer based on the context, say you don't know.
+
+        Context:
+        {context}
+
+        Conversation so far:
+        {history}
+
+        Question:
+        {question}
+
+        Answer in 2-3 clear sentences.
+        """)
+
+
+def sweep_all():
+    for cache in (chroma_clients, chroma_tenants, embedding_models, llms, sidecars):
+        cache.sweep()
+
+
+def cache_stats() -> list[dict]:
+    return [cache.stats() for cache in (chroma_clients, chroma_tenants, embedding_models, llms, sidecars)]
@@ -0,0 +1,446 @@
+import datetime
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+
+from doc_index import DOC_FAN_OUT, drop_document_index, get_document_index, uses_document_index
+from doc_store import DOC_STORE_FILE, get_doc_store, uses_doc_store
+from flat_index import FLAT_INDEX_MAX_CHUNKS, drop_flat_index, get_flat_index, uses_flat_index
+from index_params import hnsw_search_ef
+from lexical import drop_lexical_index, get_lexical_index, uses_lexical_index
+from quantization import CompactVectorStore, compact_settings, truncate
+from resources import sidecars
+
+DEFAULT_K = int(os.getenv("RETRIEVAL_K", "4"))
+# How many index candidates per result are re-scored when a collection uses compact vectors
+RESCORE_FACTOR = int(os.getenv("RESCORE_FACTOR", "4"))
+# Reciprocal rank fusion of vector and BM25 rankings; a weight of 0 switches that retriever off
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Candidates taken from each ranking per fused result
+HYBRID_CANDIDATE_FACTOR = int(os.getenv("HYBRID_CANDIDATE_FACTOR", "3"))
+SEARCH_THREADS = int(os.getenv("SEARCH_THREADS", "8"))
+# Collections searched at once by one request
+FANOUT_THREADS = int(os.getenv("FANOUT_THREADS", "4"))
+# Batch questions searched at once, across all /query/batch requests
+BATCH_SEARCH_THREADS = int(os.getenv("BATCH_SEARCH_THREADS", "4"))
+
+_search_pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="search")
+# Separate pool: fan-out tasks wait on lexical lookups in _search_pool and must not starve it
+_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_THREADS, thread_name_prefix="fanout")
+# And batches get their own, so a thousand-question batch can't queue ahead of interactive fan-outs
+_batch_pool = ThreadPoolExecutor(max_workers=BATCH_SEARCH_THREADS, thread_name_prefix="batch")
+
+def compact_store_path(user_db_path: str, collection_name: str) -> str:
+    return os.path.join(user_db_path, "compact", collection_name)
+
+
+def get_compact_store(user_db_path: str, collection_name: str, mode: str) -> CompactVectorStore:
+    path = compact_store_path(user_db_path, collection_name)
+    return sidecars.get(path, lambda: CompactVectorStore(path, mode))
+
+
+def source_metadata(source: str, source_type: str, page: int = None) -> dict:
+    """Per-page metadata shared by every chunk cut from it"""
+    metadata = {"source": source, "source_type": source_type, "ingested_at": int(time.time())}
+    if source_type == "url":
+        metadata["domain"] = urlparse(source).netloc.lower()
+    else:
+        metadata["filename"] = source
+    if page is not None:
+        metadata["page"] = int(page)
+    return metadata
+
+
+def _to_timestamp(value: str) -> int:
+    """Accept epoch seconds or an ISO date/datetime"""
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+
+
+def build_where(source: str = None, domain: str = None, filename: str = None,
+                ingested_after: str = None, ingested_before: str = None) -> dict | None:
+    """Chroma `where` filter from /query and /sources filter fields; raises ValueError on bad dates"""
+    conditions = []
+    if source:
+        conditions.append({"source": source})
+    if domain:
+        conditions.append({"domain": domain.lower()})
+    if filename:
+        conditions.append({"filename": filename})
+    if ingested_after:
+        conditions.append({"ingested_at": {"$gte": _to_timestamp(ingested_after)}})
+    if ingested_before:
+        conditions.append({"ingested_at": {"$lte": _to_timestamp(ingested_before)}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def distance_to_score(distance: float, space: str = "l2") -> float:
+    """Map a Chroma distance to a similarity where higher is better (cosine for unit vectors)"""
+    if space == "l2":
+        # Chroma reports squared L2, which is 2 - 2*cos for unit-length embeddings
+        return 1.0 - distance / 2.0
+    return 1.0 - distance
+
+
+def active_flat_index(collection, user_db_path: str):
+    """The collection's flat index, or None if it has none, has outgrown it or stores compact vectors"""
+    # Compact collections made before flat indexes were skipped for them go through HNSW and rescoring
+    if not uses_flat_index(collection.metadata) or compact_settings(collection.metadata):
+        return None
+    flat = get_flat_index(user_db_path, collection.name)
+    return None if flat.retired else flat
+
+
+def add_vectors(collection, user_db_path: str, ids: list[str], embeddings, documents: list[str] = None, **kwargs):
+    """collection.add() that honours the collection's compact-storage, doc-store, lexical, flat and document indexes"""
+    if documents is not None and uses_lexical_index(collection.metadata):
+        get_lexical_index(user_db_path, collection.name).add(ids, documents, kwargs.get("metadatas"))
+    flat = active_flat_index(collection, user_db_path)
+    if flat is not None:
+        if len(flat) + len(ids) > FLAT_INDEX_MAX_CHUNKS:
+            # HNSW serves it from here on; appending would grow the matrix without bound
+            flat.retire()
+        else:
+            flat.append(ids, embeddings, kwargs.get("metadatas"))
+    if uses_document_index(collection.metadata):
+        sources = [(metadata or {}).get("source", "") for metadata in kwargs.get("metadatas") or [None] * len(ids)]
+        get_document_index(user_db_path, collection.name).add(ids, embeddings, sources)
+    settings = compact_settings(collection.metadata)
+    if settings:
+        get_compact_store(user_db_path, collection.name, settings["mode"]).append(ids, embeddings)
+        embeddings = truncate(embeddings, settings["index_dim"]).tolist()
+    if documents is not None and uses_doc_store(collection.metadata):
+        # Text goes to the compressed store; Chroma keeps only vectors and metadata
+        get_doc_store(user_db_path).put(collection.name, ids, documents)
+        documents = None
+    collection.add(ids=ids, embeddings=embeddings, documents=documents, **kwargs)
+
+
+def fetch_documents(collection, user_db_path: str, hits: list[dict]) -> list[dict]:
+    """Fill in hit["document"] for the final hits from the compressed store (or Chroma), in one batch"""
+    missing = [hit["id"] for hit in hits if hit["document"] is None]
+    if not missing:
+        return hits
+    if uses_doc_store(collection.metadata):
+        texts = get_doc_store(user_db_path).get_many(missing)
+    else:
+        result = collection.get(ids=missing, include=["documents"])
+        texts = dict(zip(result["ids"], result["documents"]))
+    for hit in hits:
+        if hit["document"] is None:
+            hit["document"] = texts.get(hit["id"]) or ""
+    return hits
+
+
+def chunk_vectors(collection, user_db_path: str, ids: list[str]) -> tuple[list[str], np.ndarray]:
+    """(found ids, full-dimension vectors) from the flat index, the compact sidecar or Chroma, whichever holds them"""
+    flat = active_flat_index(collection, user_db_path)
+    if flat is not None:
+        return flat.get(ids)
+    settings = compact_settings(collection.metadata)
+    if settings:
+        return get_compact_store(user_db_path, collection.name, settings["mode"]).get(ids)
+    result = collection.get(ids=ids, include=["embeddings"])
+    return result["ids"], np.asarray(result["embeddings"], dtype=np.float32)
+
+
+def delete_vectors(collection, user_db_path: str, ids: list[str]):
+    if not ids:
+        return
+    if uses_document_index(collection.metadata):
+        # Centroids subtract the deleted vectors, so read them before anything is removed
+        get_document_index(user_db_path, collection.name).delete(*chunk_vectors(collection, user_db_path, ids))
+    collection.delete(ids=ids)
+    settings = compact_settings(collection.metadata)
+    if settings:
+        get_compact_store(user_db_path, collection.name, settings["mode"]).delete(ids)
+    if uses_doc_store(collection.metadata):
+        get_doc_store(user_db_path).delete(ids)
+    if uses_lexical_index(collection.metadata):
+        get_lexical_index(user_db_path, collection.name).delete(ids)
+    flat = active_flat_index(collection, user_db_path)
+    if flat is not None:
+        flat.delete(ids)
+
+
+def delete_where(collection, user_db_path: str, where: dict) -> int:
+    """Delete every chunk matching a metadata filter; returns how many were removed"""
+    ids = collection.get(where=where, include=[])["ids"]
+    delete_vectors(collection, user_db_path, ids)
+    return len(ids)
+
+
+def drop_collection(chroma_client, user_db_path: str, collection_name: str):
+    """Delete a collection from Chroma together with every sidecar index and store built for it"""
+    try:
+        chroma_client.delete_collection(collection_name)
+    except ValueError:
+        pass  # Already gone from Chroma; the sidecars may still be there
+    drop_sidecars(user_db_path, collection_name)
+
+
+def drop_sidecars(user_db_path: str, collection_name: str):
+    """Delete a collection's sidecar indexes and stores, and forget any handles cached for them"""
+    sidecars.invalidate(compact_store_path(user_db_path, collection_name))
+    shutil.rmtree(compact_store_path(user_db_path, collection_name), ignore_errors=True)
+    if os.path.exists(os.path.join(user_db_path, DOC_STORE_FILE)):
+        get_doc_store(user_db_path).delete_collection(collection_name)
+    drop_lexical_index(user_db_path, collection_name)
+    drop_flat_index(user_db_path, collection_name)
+    drop_document_index(user_db_path, collection_name)
+
+
+def embeddings_by_hash(collection, user_db_path: str, source: str) -> dict:
+    """Full-precision embeddings of a source's chunks in `collection`, keyed by content hash"""
+    result = collection.get(where={"source": source}, include=["embeddings", "metadatas"])
+    if not result["ids"]:
+        return {}
+    hashes = dict(zip(result["ids"], [(m or {}).get("content_hash") for m in result["metadatas"]]))
+    settings = compact_settings(collection.metadata)
+    if settings:
+        ids, vectors = get_compact_store(user_db_path, collection.name, settings["mode"]).get(result["ids"])
+    else:
+        ids, vectors = result["ids"], result["embeddings"]
+    return {hashes[chunk_id]: np.asarray(vector).tolist() for chunk_id, vector in zip(ids, vectors) if hashes[chunk_id]}
+
+
+def sample_chunk(collection, user_db_path: str) -> tuple[list[float], str] | None:
+    """(full-dimension embedding, text) of one chunk in the collection, or None when it is empty"""
+    result = collection.get(limit=1, include=["embeddings", "documents"])
+    if not result["ids"]:
+        return None
+    embedding = result["embeddings"][0]
+    settings = compact_settings(collection.metadata)
+    if settings:
+        _, vectors = get_compact_store(user_db_path, collection.name, settings["mode"]).get(result["ids"])
+        embedding = vectors[0]
+    document = result["documents"][0]
+    if document is None and uses_doc_store(collection.metadata):
+        document = get_doc_store(user_db_path).get_many(result["ids"]).get(result["ids"][0])
+    return np.asarray(embedding, dtype=np.float32).tolist(), document or ""
+
+
+def flat_search(collection, user_db_path: str, index, query_embedding: list[float], k: int = DEFAULT_K,
+                where: dict = None, allowed_ids: set = None) -> list[dict]:
+    """
+    search() over the memory-mapped flat index. Filters and metadata come from the index
+    and text from the doc store; Chroma is only asked for what those don't hold (chunks
+    indexed before the flat index kept metadata, text of collections without a doc store).
+    """
+    allowed = allowed_ids
+    if where:
+        allowed = index.matching(where)
+        if allowed is None:
+            allowed = set(collection.get(where=where, include=[])["ids"])
+    ranked = index.search(query_embedding, k, allowed)
+    if not ranked:
+        return []
+    ids = [chunk_id for chunk_id, _ in ranked]
+    found = index.metadata(ids)
+    missing = [chunk_id for chunk_id in ids if chunk_id not in found]
+    if missing:
+        result = collection.get(ids=missing, include=["metadatas"])
+        found.update(zip(result["ids"], result["metadatas"]))
+    hits = [{"id": chunk_id, "document": None, "metadata": found[chunk_id] or {}, "score": score}
+            for chunk_id, score in ranked if chunk_id in found]
+    return fetch_documents(collection, user_db_path, hits)
+
+
+def search(collection, user_db_path: str, query_embedding: list[float], k: int = DEFAULT_K,
+           where: dict = None, search_ef: int = None, doc_fan_out: int = None) -> list[dict]:
+    """
+    Top-k chunks for a query vector as dicts of id, document, metadata and score.
+
+    `where` is handed to Chroma, which restricts the HNSW search to matching chunks
+    instead of filtering the top-k afterwards. Small collections with a flat index
+    skip HNSW altogether. Larger ones with a document index first pick the
+    `doc_fan_out` source documents closest to the query and only search their chunks,
+    by exact scan of their flat-index rows when there are any; those hits carry a
+    "pruned" entry saying how many documents were searched. `search_ef` overrides
+    the collection's hnsw:search_ef.
+    """
+    metadata = collection.metadata or {}
+    flat = active_flat_index(collection, user_db_path)
+    if flat is not None and len(flat) <= FLAT_INDEX_MAX_CHUNKS:
+        return flat_search(collection, user_db_path, flat, query_embedding, k, where)
+    doc_fan_out = DOC_FAN_OUT if doc_fan_out is None else doc_fan_out
+    pruned = None
+    # Filters already narrow the search, and may point at documents the centroids would skip
+    if doc_fan_out and not where and uses_document_index(metadata):
+        documents = get_document_index(user_db_path, collection.name)
+        if len(documents) > doc_fan_out:
+            sources = documents.top_documents(query_embedding, doc_fan_out)
+            pruned = {"collection": collection.name, "documents_searched": len(sources), "documents": len(documents)}
+            if flat is not None:
+                hits = flat_search(collection, user_db_path, flat, query_embedding, k,
+                                   allowed_ids=documents.chunk_ids(sources))
+                return [{**hit, "pruned": pruned} for hit in hits]
+            where = {"source": {"$in": sources}}
+    space = metadata.get("hnsw:space", "l2")
+    settings = compact_settings(metadata)
+    n_results = k * RESCORE_FACTOR if settings else k
+    index_query = truncate(query_embedding, settings["index_dim"]).tolist() if settings else query_embedding
+
+    external_docs = uses_doc_store(metadata)
+    with hnsw_search_ef(collection, search_ef):
+        result = collection.query(
+            query_embeddings=[index_query],
+            n_results=n_results,
+            where=where,
+            include=["metadatas", "distances"] if external_docs else ["documents", "metadatas", "distances"]
+        )
+    documents = result["documents"][0] if not external_docs else [None] * len(result["ids"][0])
+    hits = [
+        {"id": chunk_id, "document": document, "metadata": chunk_metadata or {},
+         "score": distance_to_score(distance, space), **({"pruned": pruned} if pruned else {})}
+        for chunk_id, document, chunk_metadata, distance in zip(
+            result["ids"][0], documents, result["metadatas"][0], result["distances"][0]
+        )
+    ]
+    if not settings or not hits:
+        return fetch_documents(collection, user_db_path, hits[:k])
+
+    # Re-score the candidates against the full-dimension vectors in the sidecar
+    store = get_compact_store(user_db_path, collection.name, settings["mode"])
+    found, vectors = store.get([hit["id"] for hit in hits])
+    query = np.asarray(query_embedding, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(query) or 1.0)
+    scores = dict(zip(found, (vectors @ query) / np.where(norms == 0, 1.0, norms)))
+    for hit in hits:
+        if hit["id"] in scores:
+            hit["score"] = float(scores[hit["id"]])
+    return fetch_documents(collection, user_db_path, sorted(hits, key=lambda hit: hit["score"], reverse=True)[:k])
+
+
+def lexical_search(collection, user_db_path: str, question: str, k: int = DEFAULT_K,
+                   where: dict = None) -> list[dict]:
+    """Top-k chunks by BM25 over the collection's inverted index; documents are left for fetch_documents"""
+    if not uses_lexical_index(collection.metadata):
+        return []
+    ranked = get_lexical_index(user_db_path, collection.name).search(question, k, where=where)
+    if not ranked:
+        return []
+    ids = [chunk_id for chunk_id, _ in ranked]
+    result = collection.get(ids=ids, include=["metadatas"])
+    metadatas = dict(zip(result["ids"], result["metadatas"]))
+    return [{"id": chunk_id, "document": None, "metadata": metadatas.get(chunk_id) or {}, "score": score}
+            for chunk_id, score in ranked if chunk_id in metadatas]
+
+
+def fuse_rankings(rankings: list[tuple[list[dict], float]], k: int, rrf_k: int = RRF_K) -> list[dict]:
+    """
+    Reciprocal rank fusion: each ranking adds weight / (rrf_k + rank) to its hits.
+
+    Only ranks are combined, so cosine similarities and unbounded BM25 scores never
+    have to be put on the same scale.
+    """
+    fused = {}
+    for hits, weight in rankings:
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.setdefault(hit["id"], {**hit, "score": 0.0})
+            if entry["document"] is None and hit["document"] is not None:
+                entry["document"] = hit["document"]
+            entry["score"] += weight / (rrf_k + rank)
+    return sorted(fused.values(), key=lambda hit: hit["score"], reverse=True)[:k]
+
+
+def hybrid_search(collection, user_db_path: str, query_embedding: list[float], question: str,
+                  k: int = DEFAULT_K, where: dict = None, vector_weight: float = HYBRID_VECTOR_WEIGHT,
+                  lexical_weight: float = HYBRID_LEXICAL_WEIGHT, search_ef: int = None,
+                  doc_fan_out: int = None) -> list[dict]:
+    """
+    Vector and BM25 search run side by side, fused with RRF.
+
+    Exact identifiers, error codes and API names that embeddings blur together are
+    caught by the lexical side. Collections without a lexical index, or a zero
+    lexical weight, fall back to plain vector search.
+    """
+    if not lexical_weight or not uses_lexical_index(collection.metadata):
+        return search(collection, user_db_path, query_embedding, k, where, search_ef, doc_fan_out)
+    candidates = k * HYBRID_CANDIDATE_FACTOR
+    lexical = _search_pool.submit(lexical_search, collection, user_db_path, question, candidates, where)
+    vector_hits = (search(collection, user_db_path, query_embedding, candidates, where, search_ef, doc_fan_out)
+                   if vector_weight else [])
+    lexical_hits = lexical.result()
+    fused = fuse_rankings([(vector_hits, vector_weight), (lexical_hits, lexical_weight)], k)
+    return fetch_documents(collection, user_db_path, fused)
+
+
+def cosine_rescore(collection, user_db_path: str, query_embedding: list[float], hits: list[dict]) -> list[dict]:
+    """Replace each hit's score with the cosine similarity of its stored vector to the query"""
+    if not hits:
+        return hits
+    ids, vectors = chunk_vectors(collection, user_db_path, [hit["id"] for hit in hits])
+    if not len(ids):
+        return hits
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_embedding)
+    scores = dict(zip(ids, (vectors @ np.asarray(query_embedding, dtype=np.float32)) / np.where(norms == 0, 1.0, norms)))
+    for hit in hits:
+        # A hit without a stored vector can't be placed on the common scale, so it ranks last
+        hit["score"] = float(scores.get(hit["id"], -1.0))
+    return hits
+
+
+def fan_out_search(searches: list[tuple], user_db_path: str, question: str, k: int = DEFAULT_K,
+                   where: dict = None, vector_weight: float = HYBRID_VECTOR_WEIGHT,
+                   lexical_weight: float = HYBRID_LEXICAL_WEIGHT, search_ef: int = None,
+                   doc_fan_out: int = None) -> tuple[list[dict], dict]:
+    """
+    hybrid_search over several (collection, query_embedding) pairs at once, merged on one scale.
+
+    Each collection's own ranking (RRF or cosine) only picks its candidates; they are
+    then re-scored by cosine similarity to the query, since RRF scores are per-collection
+    ranks that can't be compared with each other or with cosine. Without a question
+    embedding (a deadline fell back to BM25) there is nothing to re-score against, so
+    each collection is searched by BM25 alone and merged on BM25 score. Returns the global
+    top-k (each hit tagged with its collection) and per-collection latency and hit
+    counts; a collection that fails is reported instead of failing the whole search.
+    """
+    def run(collection, query_embedding):
+        started = time.perf_counter()
+        if query_embedding is None:
+            hits = fetch_documents(collection, user_db_path, lexical_search(collection, user_db_path, question, k, where))
+        else:
+            hits = hybrid_search(collection, user_db_path, query_embedding, question, k, where,
+                                 vector_weight, lexical_weight, search_ef, doc_fan_out)
+            hits = cosine_rescore(collection, user_db_path, query_embedding, hits)
+        for hit in hits:
+            hit["collection"] = collection.name
+        return hits, (time.perf_counter() - started) * 1000
+
+    futures = {collection.name: _fanout_pool.submit(run, collection, query_embedding)
+               for collection, query_embedding in searches}
+    merged, stats = [], {}
+    for name, future in futures.items():
+        try:
+            hits, latency_ms = future.result()
+        except Exception as e:
+            print(f"Search failed for collection {name}: {e}")
+            stats[name] = {"error": str(e)}
+            continue
+        stats[name] = {"latency_ms": round(latency_ms, 1), "hits": len(hits)}
+        merged.extend(hits)
+    return sorted(merged, key=lambda hit: hit["score"], reverse=True)[:k], stats
+
+
+def batch_search(collection, user_db_path: str, query_embeddings: list, questions: list[str], k: int = DEFAULT_K,
+                 where: dict = None, vector_weight: float = HYBRID_VECTOR_WEIGHT,
+                 lexical_weight: float = HYBRID_LEXICAL_WEIGHT, search_ef: int = None,
+                 doc_fan_out: int = None) -> list[list[dict]]:
+    """hybrid_search for many questions against one collection, run concurrently; results in question order"""
+    return list(_batch_pool.map(
+        lambda pair: hybrid_search(collection, user_db_path, pair[0], pair[1], k, where,
+                                   vector_weight, lexical_weight, search_ef, doc_fan_out),
+        zip(query_embeddings, questions)
+    ))
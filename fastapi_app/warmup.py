@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import active_collection, load_manifest, rebuild_manifest
+from quantization import compact_settings
+from refresh import remembered_api_key
+from resources import chroma_client_open, get_embeddings, get_llm, open_chroma_client
+from retrieval import active_flat_index, hybrid_search, sample_chunk
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+# Users warmed at once; warm-ups compete with live queries for disk and CPU
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "2"))
+# Logins beyond this many waiting warm-ups are not warmed at all
+WARMUP_MAX_PENDING = int(os.getenv("WARMUP_MAX_PENDING", "32"))
+# Estimated index memory all warmed users together may hold
+WARMUP_MEMORY_MB = int(os.getenv("WARMUP_MEMORY_MB", "1024"))
+
+
+def estimate_index_bytes(collection, user_db_path: str, stored_dim: int, full_dim: int) -> int:
+    """Resident size of a loaded collection: HNSW vectors and links, plus the flat index matrix if it has one"""
+    count = collection.count()
+    m = (collection.metadata or {}).get("hnsw:M", 16)
+    size = count * (stored_dim * 4 + m * 2 * 4)
+    if active_flat_index(collection, user_db_path) is not None:
+        size += count * full_dim * 4
+    return size
+
+
+class Warmup:
+    """
+    Preloads a user's manifest, index and model clients right after they sign in.
+
+    Warm-ups run on a small pool, outside any request, and only while the estimated
+    memory of everything warmed stays within the budget. Users whose Chroma client has
+    since been evicted from the resource cache no longer count against it.
+    """
+
+    def __init__(self, concurrency: int = WARMUP_CONCURRENCY, memory_mb: int = WARMUP_MEMORY_MB,
+                 max_pending: int = WARMUP_MAX_PENDING):
+        self.memory_budget = memory_mb * 2 ** 20
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="warmup")
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._warmed = OrderedDict()
+        self._outcomes = Counter()
+        self._last_ms = None
+
+    def _warmed_bytes_locked(self) -> int:
+        for path in [path for path in self._warmed if not chroma_client_open(path)]:
+            del self._warmed[path]
+        return sum(self._warmed.values())
+
+    def schedule(self, user_db_path: str, user_id: str) -> str:
+        """Queue a warm-up; returns "scheduled", or why nothing was queued"""
+        if not WARMUP_ENABLED:
+            return "disabled"
+        if not os.path.exists(user_db_path):
+            return "no_data"
+        with self._lock:
+            self._warmed_bytes_locked()
+            if user_db_path in self._pending:
+                return "in_progress"
+            if user_db_path in self._warmed:
+                return "warm"
+            if len(self._pending) >= self.max_pending:
+                self._outcomes["busy"] += 1
+                return "busy"
+            self._pending.add(user_db_path)
+        self._pool.submit(self._run, user_db_path, user_id)
+        return "scheduled"
+
+    def _run(self, user_db_path: str, user_id: str):
+        started = time.perf_counter()
+        try:
+            outcome = self._warm(user_db_path, user_id)
+        except Exception as e:
+            print(f"⚠️ Warm-up failed for {user_db_path}: {e}")
+            outcome = "failed"
+            with self._lock:
+                self._warmed.pop(user_db_path, None)
+        with self._lock:
+            self._pending.discard(user_db_path)
+            self._outcomes[outcome] += 1
+            self._last_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    def _warm(self, user_db_path: str, user_id: str) -> str:
+        with open_chroma_client(user_db_path) as chroma_client:
+            collection_name = active_collection(user_db_path)
+            if load_manifest(user_db_path) is None:
+                collection_name = rebuild_manifest(
+                    user_db_path, chroma_client.list_collections(), f"{user_id}_collection_"
+                )["active_collection"]
+            if not collection_name:
+                return "no_data"
+            collection = chroma_client.get_collection(collection_name)
+            sample = sample_chunk(collection, user_db_path)
+            if sample is None:
+                return "no_data"
+            embedding, text = sample
+            settings = compact_settings(collection.metadata)
+            stored_dim = settings["index_dim"] if settings else len(embedding)
+            size = estimate_index_bytes(collection, user_db_path, stored_dim, len(embedding))
+            with self._lock:
+                if self._warmed_bytes_locked() + size > self.memory_budget:
+                    return "over_budget"
+                # Reserved before loading, so concurrent warm-ups can't overshoot the budget together
+                self._warmed[user_db_path] = size
+            # One real search pages in whatever the first query would: HNSW segment or flat
+            # matrix, compact sidecar, lexical index and document store
+            hybrid_search(collection, user_db_path, embedding, text[:200], k=1)
+
+        provider = (collection.metadata or {}).get("embedding_provider", "gemini")
+        api_key = remembered_api_key(user_id)
+        # Gemini clients need the user's key, which is only known once they have queried before
+        if provider != "gemini" or api_key:
+            get_embeddings(provider, api_key)
+        if api_key:
+            get_llm(api_key)
+        return "warm"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "warmed": len(self._warmed),
+                "warmed_mb": round(self._warmed_bytes_locked() / 2 ** 20, 1),
+                "memory_budget_mb": round(self.memory_budget / 2 ** 20, 1),
+                "outcomes": dict(self._outcomes),
+                "last_ms": self._last_ms,
+            }
+
+
+WARMUP = Warmup()
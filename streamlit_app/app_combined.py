@@ -3,11 +3,8 @@ import sys
 import subprocess
 import tempfile
 import uuid
-import shutil
 import base64
 import pathlib
-import time
-import gc
 import datetime
 from dotenv import load_dotenv
 
@@ -22,10 +19,17 @@ import jwt
 # Use simple ChromaDB import without Settings (matching GitHub repo)
 from chromadb import PersistentClient
 from langchain_chroma import Chroma
-from langchain_google_genai import GoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_google_genai import GoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate
 from langchain_community.document_loaders import TextLoader, PyPDFLoader
 
+# Share backend helpers (embedding providers etc.) with the FastAPI app
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "fastapi_app"))
+from embeddings import EMBEDDING_PROVIDER, get_embedding_provider
+from deletion import DELETIONS
+from intent import small_talk_reply
+from manifest import active_collection, load_manifest, rebuild_manifest, record_ingest
+
 st.set_page_config(
     page_title="CrawlMind AI Assistant",
     page_icon="🔵",
@@ -405,12 +409,12 @@ def process_documents():
         # Initialize ChromaDB with the GitHub repo approach (no Settings)
         with st.spinner("Initializing database..."):
             chroma_client = PersistentClient(path=db_path)
-            collection = chroma_client.get_or_create_collection(name=collection_name)
+            collection = chroma_client.get_or_create_collection(
+                name=collection_name,
+                metadata={"embedding_provider": EMBEDDING_PROVIDER}
+            )
 
-        embedding_function = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=st.session_state.gemini_api_key
-        )
+        embedding_function = get_embedding_provider(EMBEDDING_PROVIDER, st.session_state.gemini_api_key)
 
         all_chunks = []
         
@@ -517,6 +521,8 @@ def process_documents():
 
             if valid_chunks:
                 collection.add(documents=valid_chunks, embeddings=embeddings, ids=ids)
+                record_ingest(db_path, collection_name, len(valid_chunks), collection.metadata or {},
+                              dimension=len(embeddings[0]))
                 st.session_state.collection = collection
                 st.session_state.embeddings_created = True
                 # Store both the database path and collection name in session state for later use
@@ -545,13 +551,13 @@ def query_documents(question: str) -> str:
     
     if not st.session_state.gemini_api_key:
         return "❌ Gemini API key required."
+
+    # Greetings, thanks and farewells get a canned reply without retrieval or an LLM call
+    reply, _ = small_talk_reply(question)
+    if reply:
+        return reply
     
     try:
-        embedding_function = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=st.session_state.gemini_api_key
-        )
-
         # Use the database path from the crawl & embed step if available
         db_path = getattr(st.session_state, "db_path", "./crawlmind_db")
         
@@ -562,21 +568,26 @@ def query_documents(question: str) -> str:
                     collection_name = st.session_state.collection_name
                     # Removed notification
                 else:
-                    # Find the most recent collection
-                    chroma_client = PersistentClient(path=db_path)
-                    collections = chroma_client.list_collections()
-                    
-                    # Filter collections that match our naming pattern and sort by timestamp
-                    relevant_collections = [c for c in collections if c.name.startswith("crawlmind_collection_")]
-                    
-                    if not relevant_collections:
+                    # The manifest remembers the active collection; only older databases need a scan
+                    collection_name = active_collection(db_path)
+                    if load_manifest(db_path) is None:
+                        chroma_client = PersistentClient(path=db_path)
+                        collection_name = rebuild_manifest(
+                            db_path, chroma_client.list_collections(), "crawlmind_collection_"
+                        )["active_collection"]
+
+                    if not collection_name:
                         st.error("❌ No collections found in the database. Please run the 'Crawl & Embed' step first.")
                         return
-                        
-                    # Get the most recent collection (assuming the timestamp format sorts correctly)
-                    latest_collection = sorted(relevant_collections, key=lambda c: c.name, reverse=True)[0]
-                    collection_name = latest_collection.name
                     # Removed notification
+
+            # Embed the question with the provider the collection was built with
+            chroma_client = PersistentClient(path=db_path)
+            collection_metadata = chroma_client.get_collection(collection_name).metadata or {}
+            embedding_function = get_embedding_provider(
+                collection_metadata.get("embedding_provider", "gemini"),
+                st.session_state.gemini_api_key
+            )
             
             db = Chroma(
                 client=PersistentClient(path=db_path),
@@ -1009,35 +1020,11 @@ def render_user_profile_header():
     st.markdown(footer_social_html, unsafe_allow_html=True)
 
 def safe_clear_database(db_path):
-    """Safely clear the ChromaDB database with retries and proper cleanup"""
-    if not os.path.exists(db_path):
+    """Tombstone the ChromaDB database right away; its files are removed in the background"""
+    deletion = DELETIONS.request(db_path, layout="per_tenant")
+    if deletion is None:
         return {"success": True, "message": "No existing database to clear"}
-    
-    try:
-        # Force garbage collection to release any file handles
-        gc.collect()
-        
-        for attempt in range(3):  # Try up to 3 times
-            try:
-                shutil.rmtree(db_path)
-                return {"success": True, "message": "✅ Previous database cleared successfully"}
-            except PermissionError:
-                if attempt < 2:  # If not the last attempt
-                    st.warning(f"⚠️ Database files in use. Retrying... (attempt {attempt + 1}/3)")
-                    time.sleep(1)  # Wait a bit before retry
-                    gc.collect()  # Try to free resources
-                else:
-                    # On last attempt failure, use a new path instead
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                    new_path = f"{db_path}_{timestamp}"
-                    st.warning(f"⚠️ Could not clear previous database. Using new path: {new_path}")
-                    return {"success": True, "message": f"Using new database: {new_path}", "new_path": new_path}
-    except Exception as e:
-        st.error(f"❌ Database cleanup error: {str(e)}")
-        # On error, use a new path to avoid conflicts
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_path = f"{db_path}_{timestamp}"
-        return {"success": False, "message": f"Error: {str(e)}. Using new path: {new_path}", "new_path": new_path}
+    return {"success": True, "message": "✅ Previous database cleared", "deletion": deletion}
 
 def main():
     initialize_session_state()
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from chromadb import PersistentClient
+
+from retrieval import add_vectors, build_where, search
+
+SOURCES = ["a.txt", "b.txt", "https://docs.example.com/page"]
+
+
+@pytest.fixture
+def collection(tmp_path):
+    user_db_path = str(tmp_path / "user_t")
+    client = PersistentClient(path=user_db_path)
+    collection = client.create_collection("user_t_collection_flat", metadata={"flat_index": True, "doc_store": "zstd"})
+    rng = np.random.default_rng(0)
+    metadatas = [{"source": SOURCES[i % 3], "filename": SOURCES[i % 3], "ingested_at": 1000 + i} for i in range(30)]
+    for i in range(0, 30, 10):
+        add_vectors(collection, user_db_path, ids=[f"c{j}" for j in range(i, i + 10)],
+                    embeddings=rng.random((10, 8)).tolist(), documents=[f"chunk {j}" for j in range(i, i + 10)],
+                    metadatas=metadatas[i:i + 10])
+    return collection, user_db_path
+
+
+@pytest.mark.parametrize("where", [None, build_where(source="b.txt"), build_where(ingested_after="1970-01-01T00:16:50"),
+                                   {"$and": [{"ingested_at": {"$gte": 1005}}, {"source": {"$in": SOURCES[:2]}}]},
+                                   {"$or": [{"source": {"$ne": "a.txt"}}, {"ingested_at": {"$lt": 1003}}]}])
+def test_flat_search_serves_filters_metadata_and_text_without_chroma(collection, where, monkeypatch):
+    collection, user_db_path = collection
+    expected = set(collection.get(where=where, include=[])["ids"]) if where else None
+    monkeypatch.setattr(type(collection), "get", lambda *args, **kwargs: pytest.fail("asked Chroma"))
+
+    hits = search(collection, user_db_path, np.ones(8).tolist(), k=30, where=where)
+
+    assert hits and (expected is None or {hit["id"] for hit in hits} == expected)
+    for hit in hits:
+        row = int(hit["id"][1:])
+        assert hit["document"] == f"chunk {row}"
+        assert hit["metadata"] == {"source": SOURCES[row % 3], "filename": SOURCES[row % 3], "ingested_at": 1000 + row}
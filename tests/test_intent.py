@@ -0,0 +1,18 @@
+import pytest
+
+from intent import classify
+
+
+@pytest.mark.parametrize("text", ["ok so what is it", "Nice, and the pricing?", "ok and the pricing", "and then?",
+                                  "hi, what is the refund policy?", "thanks! tell me more"])
+def test_requests_after_pleasantries_go_through_retrieval(text):
+    classification = classify(text)
+    assert classification["intent"] == "question"
+    assert classification["fast_path"] is False
+
+
+@pytest.mark.parametrize("text, intent", [("hi there", "greeting"), ("how are you?", "greeting"),
+                                          ("thank you very much for your help", "thanks"),
+                                          ("ok thanks, bye", "farewell"), ("great, that is helpful", "acknowledgement")])
+def test_pure_small_talk_takes_the_fast_path(text, intent):
+    assert classify(text) == {"intent": intent, "score": 1.0, "fast_path": True}
@@ -0,0 +1,77 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from resources import ResourceCache, forget_sidecars, sidecars
+
+
+def test_slow_build_does_not_block_other_keys():
+    cache = ResourceCache("test", 8, 60)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    with ThreadPoolExecutor(1) as pool:
+        pending = pool.submit(cache.get, "a", slow)
+        assert started.wait(5)
+        begin = time.monotonic()
+        assert cache.get("b", lambda: "fast") == "fast"
+        assert time.monotonic() - begin < 1
+        release.set()
+        assert pending.result(5) == "slow"
+
+
+def test_concurrent_misses_build_once():
+    cache = ResourceCache("test", 8, 60)
+    builds = []
+
+    def build():
+        builds.append(1)
+        time.sleep(0.1)
+        return object()
+
+    with ThreadPoolExecutor(8) as pool:
+        values = list(pool.map(lambda _: cache.get("a", build), range(8)))
+    assert len(builds) == 1
+    assert all(value is values[0] for value in values)
+    assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 7
+
+
+def test_value_invalidated_while_building_is_closed_after_use():
+    closed = []
+    cache = ResourceCache("test", 8, 60, close=closed.append)
+    started, release, done = threading.Event(), threading.Event(), threading.Event()
+
+    def build():
+        started.set()
+        release.wait(5)
+        return "stale"
+
+    def use():
+        with cache.lease("a", build) as value:
+            done.wait(5)
+            return value
+
+    with ThreadPoolExecutor(1) as pool:
+        pending = pool.submit(use)
+        assert started.wait(5)
+        assert cache.invalidate("a", revive=False)
+        release.set()
+        with cache.lease("a", lambda: "fresh") as value:
+            assert value == "fresh"
+        assert closed == []
+        done.set()
+        assert pending.result(5) == "stale"
+    assert closed == ["stale"]
+
+
+def test_forget_sidecars_only_drops_that_users_handles(tmp_path):
+    kept, other = str(tmp_path / "user_a"), str(tmp_path / "user_ab")
+    keys = [f"{kept}/chunks.sqlite", f"{kept}/lexical/c.sqlite", f"{other}/chunks.sqlite"]
+    for key in keys:
+        sidecars.get(key, object)
+    forget_sidecars(kept)
+    assert [key in sidecars for key in keys] == [False, False, True]
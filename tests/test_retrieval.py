@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from chromadb import PersistentClient
+
+from retrieval import add_vectors, fan_out_search
+
+TEXTS = {
+    "old": ["The ERR_CONN_42 error occurs when the crawler cannot reach the host.",
+            "Billing is handled monthly through Stripe invoices."],
+    "new": ["ERR_CONN_42 ERR_CONN_42: retry once the host is reachable again.",
+            "Kubernetes pods restart when liveness probes fail."],
+}
+
+
+@pytest.fixture
+def collections(tmp_path):
+    user_db_path = str(tmp_path / "user_t")
+    client = PersistentClient(path=user_db_path)
+    rng = np.random.default_rng(0)
+    created = []
+    for name, texts in TEXTS.items():
+        collection = client.create_collection(f"user_t_collection_{name}", metadata={"lexical_index": True})
+        add_vectors(collection, user_db_path, ids=[f"{name}-{i}" for i in range(len(texts))],
+                    embeddings=rng.random((len(texts), 8)).tolist(), documents=texts,
+                    metadatas=[{"source": f"{name}.txt"}] * len(texts))
+        created.append(collection)
+    return user_db_path, created
+
+
+def test_fan_out_without_question_embedding_merges_on_bm25(collections):
+    # What /query does when the deadline makes it fall back to lexical search
+    user_db_path, targets = collections
+    hits, stats = fan_out_search([(target, None) for target in targets], user_db_path, "ERR_CONN_42",
+                                 k=4, vector_weight=0.0, lexical_weight=1.0)
+
+    assert all("error" not in entry for entry in stats.values())
+    assert [hit["id"] for hit in hits] == ["new-0", "old-0"]
+    assert hits[0]["score"] > hits[1]["score"] > 0
+    assert hits[0]["document"] == TEXTS["new"][0]
+    assert {hit["collection"] for hit in hits} == {target.name for target in targets}
+
+
+def test_fan_out_with_question_embedding_rescores_by_cosine(collections):
+    user_db_path, targets = collections
+    query = targets[1].get(ids=["new-1"], include=["embeddings"])["embeddings"][0]
+    hits, stats = fan_out_search([(target, list(query)) for target in targets], user_db_path, "liveness probes", k=4)
+
+    assert all("error" not in entry for entry in stats.values())
+    assert hits[0]["id"] == "new-1"
+    assert hits[0]["score"] == pytest.approx(1.0, abs=1e-5)
+    assert all(-1.0 <= hit["score"] <= 1.0 + 1e-6 for hit in hits)